@@ -0,0 +1,149 @@
+# Throughput benchmarks for the training hot paths. Runs on CPU with a tiny randomly
+# initialised HookedTransformer and random tokens, so it needs no downloads.
+# Run from the repo root:
+#   python -m benchmarks.hot_paths --out bench.jsonl
+#   python -m benchmarks.hot_paths --compare bench.jsonl   # flags anything that got slower
+# Every result is one json line. "key" identifies a benchmark and its grid point.
+import contextlib
+import io
+import itertools
+import json
+import statistics
+import sys
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from buffer import Buffer
+from calculations_on_sae import get_recons_loss
+from sae import AutoEncoder, AutoEncoderConfig
+from setup_utils import get_random_model, get_random_tokens
+
+
+def get_cfg(act_size, dict_mult, batch_size, device="cpu", seq_len=64, buffer_mult=64, subshuffle=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return AutoEncoderConfig(site="resid_pre", layer=1, act_size=act_size, dict_mult=dict_mult,
+                                 batch_size=batch_size, seq_len=seq_len, buffer_mult=buffer_mult,
+                                 flatten_heads=False, device=device, subshuffle=subshuffle,
+                                 buffer_refresh_ratio=0.25, num_to_resample=32, gram_shmidt_trail=32)
+
+
+def timeit(fn, repeats, warmup=1, setup=None):
+    times = []
+    for i in range(warmup + repeats):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+        if i >= warmup:
+            times.append(time.perf_counter() - t0)
+    return times
+
+
+def bench_grid_point(act_size, dict_mult, batch_size, repeats, device):
+    cfg = get_cfg(act_size, dict_mult, batch_size, device)
+    model = get_random_model(cfg)
+    tokens = get_random_tokens(cfg, cfg.buffer_batches * 8, d_vocab=model.cfg.d_vocab)
+    with contextlib.redirect_stdout(io.StringIO()):
+        buffer = Buffer(cfg, tokens, model=model)
+        encoder = AutoEncoder(cfg)
+    params = {"act_size": act_size, "dict_mult": dict_mult, "batch_size": batch_size, "device": device}
+    results = []
+
+    def record(name, times, items, unit):
+        results.append({
+            "name": name,
+            **params,
+            "key": f"{name}/a{act_size}/m{dict_mult}/b{batch_size}/{device}",
+            "median_s": statistics.median(times),
+            "min_s": min(times),
+            "repeats": len(times),
+            f"{unit}_per_s": items / statistics.median(times),
+        })
+
+    def reset_token_pointer():
+        buffer.token_pointer = 0
+
+    n_refresh_seqs = len(range(0, int(cfg.buffer_batches * cfg.buffer_refresh_ratio), cfg.model_batch_size)) * cfg.model_batch_size
+    n_refresh_rows = n_refresh_seqs * cfg.seq_len
+    record("buffer_refresh", timeit(buffer.refresh, repeats, setup=reset_token_pointer), n_refresh_rows, "acts")
+    record("buffer_shuffle", timeit(buffer.shuffle, repeats), cfg.buffer_size, "acts")
+    buffer.cfg = get_cfg(act_size, dict_mult, batch_size, device, subshuffle=16)
+    record("buffer_subshuffle16", timeit(buffer.shuffle, repeats), cfg.buffer_size, "acts")
+    buffer.cfg = cfg
+
+    acts = buffer.next()
+
+    def forward_backward():
+        encoder(acts, record_activation_frequency=True)
+        encoder.get_loss().backward()
+    encoder.zero_grad()
+    record("ae_forward_backward", timeit(forward_backward, repeats, setup=encoder.zero_grad), batch_size, "acts")
+
+    record("decoder_unit_norm", timeit(encoder.make_decoder_weights_and_grad_unit_norm, repeats, setup=forward_backward),
+           cfg.dict_size, "features")
+
+    x_diff = acts.float() - encoder(acts).float()
+    n_resample = min(batch_size, cfg.act_size // 2, cfg.num_to_resample)
+    def mark_neurons():
+        to_be_reset = torch.zeros(cfg.dict_size, dtype=torch.bool, device=device)
+        to_be_reset[:n_resample] = True
+        encoder.neurons_to_reset(to_be_reset)
+    record("resample_gram_shmidt_topk",
+           timeit(lambda: encoder.re_init_neurons_gram_shmidt_precise_topk(x_diff), repeats, setup=mark_neurons),
+           n_resample, "neurons")
+
+    n_tokens = cfg.model_batch_size * cfg.seq_len
+    record("get_recons_loss", timeit(lambda: get_recons_loss(model, encoder, buffer, num_batches=1), repeats),
+           n_tokens, "tokens")
+    return results
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {r["key"]: r for r in map(json.loads, f) if r}
+    regressions = []
+    for r in results:
+        if r["key"] not in baseline:
+            continue
+        ratio = r["median_s"] / baseline[r["key"]]["median_s"]
+        flag = ratio > 1 + tolerance
+        if flag:
+            regressions.append(r["key"])
+        print(f"{r['key']:>55}: {ratio:5.2f}x baseline {'REGRESSION' if flag else ''}")
+    return regressions
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--act_sizes", type=int, nargs="+", default=[128, 512])
+    parser.add_argument("--dict_mults", type=int, nargs="+", default=[4, 16])
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--out", type=str, default=None, help="write the results as json lines")
+    parser.add_argument("--compare", type=str, default=None, help="json lines file from an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown vs --compare")
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = []
+    for act_size, dict_mult, batch_size in itertools.product(args.act_sizes, args.dict_mults, args.batch_sizes):
+        for r in bench_grid_point(act_size, dict_mult, batch_size, args.repeats, args.device):
+            print(json.dumps(r))
+            results.append(r)
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            for r in results:
+                f.write(json.dumps(r) + "\n")
+    if args.compare is not None and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
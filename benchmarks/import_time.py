@@ -0,0 +1,71 @@
+# Import-time benchmark for the entry points.
+# Run from the repo root:
+#   python -m benchmarks.import_time
+# Each module is imported in a fresh interpreter. The script exits non-zero if one of the
+# light modules pulls in a heavy dependency, or if its import is too much slower than
+# importing torch on its own.
+import json
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# modules that loading / running an autoencoder goes through. These must only need torch.
+LIGHT_MODULES = ["sae", "sae_config", "buffer", "calculations_on_sae", "train_sae"]
+HEAVY_DEPENDENCIES = ["transformer_lens", "datasets", "wandb", "transformers"]
+
+PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+t1 = time.perf_counter()
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps([t1 - t0, heavy]))
+"""
+
+
+def time_import(module, repeats=3):
+    best = float("inf")
+    heavy = []
+    for _ in range(repeats):
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_DEPENDENCIES)],
+            cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+        )
+        t, heavy = json.loads(out.stdout.strip().splitlines()[-1])
+        best = min(best, t)
+    return best, heavy
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max_overhead", type=float, default=1.0,
+                        help="seconds a module may take on top of a bare `import torch`")
+    parser.add_argument("--out", type=str, default=None, help="write the results as json")
+    args = parser.parse_args()
+
+    baseline, _ = time_import("torch", args.repeats)
+    results = {"torch": {"seconds": baseline, "heavy_imports": []}}
+    failed = []
+    for module in LIGHT_MODULES:
+        t, heavy = time_import(module, args.repeats)
+        results[module] = {"seconds": t, "heavy_imports": heavy}
+        ok = not heavy and t - baseline < args.max_overhead
+        if not ok:
+            failed.append(module)
+        print(f"{module:>22}: {t:.3f}s (torch {baseline:.3f}s) {'ok' if ok else 'FAIL'} {heavy if heavy else ''}")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump({"time": time.time(), "results": results}, f, indent=2)
+    if failed:
+        print("import time regressions in:", failed)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 from sae_config import AutoEncoderConfig
+from profiler import NULL_PROFILER
+from device_utils import model_autocast
 
 
 import einops
@@ -17,15 +19,47 @@ class Buffer():
     It'll automatically run the model to generate more when it gets halfway empty.
     """
     def __init__(self, cfg, tokens, model):
-        self.buffer = torch.zeros((cfg.buffer_size, cfg.act_size), dtype=torch.float16, requires_grad=False).to(cfg.device)
+        self.buffer = torch.zeros((cfg.buffer_size, cfg.act_size), dtype=torch.float16, requires_grad=False, device=cfg.device)
         self.cfg :AutoEncoderConfig = cfg
         self.token_pointer = 0
         self.first = True
         self.all_tokens = tokens
         self.model = model
         self.time_shuffling = 0
+        self.profiler = NULL_PROFILER
+        # reuse mode: rows are served through a permutation index instead of shuffling the buffer, and only
+        # the rows that were served buffer_reuse times (or are older than buffer_max_age refreshes) get replaced
+        self.reuse = cfg.buffer_reuse > 1 or cfg.buffer_max_age is not None
+        if self.reuse:
+            self.uses = torch.zeros(cfg.buffer_size, dtype=torch.int32, device=cfg.device)
+            self.written_at = torch.zeros(cfg.buffer_size, dtype=torch.int32, device=cfg.device)
+            self.order = None
+        self.num_refreshes = 0
+        self.rows_written = 0
+        self.rows_served = 0
+        self.evicted_uses = 0
+        self.evicted_by_age = 0
         self.refresh()
 
+    def model_acts(self, num_seqs, whole_batches=True):
+        """
+        Runs the model over the next num_seqs sequences and yields the flattened activations, a model batch
+        at a time. With whole_batches the count is rounded up to a multiple of model_batch_size.
+        """
+        for start in range(0, num_seqs, self.cfg.model_batch_size):
+            n = self.cfg.model_batch_size if whole_batches else min(self.cfg.model_batch_size, num_seqs - start)
+            # no pinned memory or .contiguous() copies: these are row slices, already contiguous, and on
+            # the cpu there's no host to device copy for pinning to speed up. On cuda it's a few KB of tokens
+            tokens = self.all_tokens[self.token_pointer:self.token_pointer+n]
+            _, cache = self.model.run_with_cache(tokens, stop_at_layer=self.cfg.layer+1)
+            if self.cfg.flatten_heads:
+                acts = einops.rearrange(cache[self.cfg.act_name], "batch seq_pos n_head d_head -> (batch seq_pos) (n_head d_head)")
+            else:
+                acts = einops.rearrange(cache[self.cfg.act_name], "batch seq_pos d_act -> (batch seq_pos) d_act")
+            assert acts.shape[-1] == self.cfg.act_size
+            self.token_pointer += n
+            yield acts
+
     @torch.no_grad()
     def refresh(self):
         """
@@ -34,48 +68,110 @@ class Buffer():
         Note: This method assumes that the necessary attributes and configurations are already set.
         """
         t0 = time.time()
+        if self.reuse:
+            self.refresh_reuse()
+            self.time_shuffling += time.time() - t0
+            return
         self.pointer = 0
-        with torch.autocast("cuda", torch.float16):
+        with self.profiler.phase("refresh"), model_autocast(self.cfg):
             if self.first:
                 num_batches = self.cfg.buffer_batches
             else:
                 num_batches = int(self.cfg.buffer_batches * self.cfg.buffer_refresh_ratio)
             self.first = False
-            for _ in range(0, num_batches, self.cfg.model_batch_size):
-                tokens = self.all_tokens[self.token_pointer:self.token_pointer+self.cfg.model_batch_size]
-                _, cache = self.model.run_with_cache(tokens, stop_at_layer=self.cfg.layer+1)
-                if self.cfg.flatten_heads:
-                    acts = einops.rearrange(cache[self.cfg.act_name], "batch seq_pos n_head d_head -> (batch seq_pos) (n_head d_head)")
-                else:
-                    acts = einops.rearrange(cache[self.cfg.act_name], "batch seq_pos d_act -> (batch seq_pos) d_act")
-                assert acts.shape[-1] == self.cfg.act_size
+            for acts in self.model_acts(num_batches):
                 self.buffer[self.pointer: self.pointer+acts.shape[0]] = acts
                 self.pointer += acts.shape[0]
-                self.token_pointer += self.cfg.model_batch_size
+                self.rows_written += acts.shape[0]
+
+        self.pointer = 0
+        with self.profiler.phase("shuffle"):
+            self.shuffle()
+        self.num_refreshes += 1
+        self.time_shuffling += time.time() - t0
+        # torch.cuda.empty_cache()
 
+    @torch.no_grad()
+    def refresh_reuse(self):
+        """
+        The reuse mode refresh. The rows served since the last refresh have had their use counted, so
+        only about served / buffer_reuse new rows are needed. Rows that are used up or too old are
+        replaced first, then the most used and oldest ones, and the serving order is redrawn.
+        """
+        cfg = self.cfg
+        if self.order is not None:
+            self.uses[self.order[:self.pointer]] += 1
+            self.rows_served += self.pointer
         self.pointer = 0
+        age = self.num_refreshes - self.written_at
+        with self.profiler.phase("refresh"), model_autocast(cfg):
+            if self.first:
+                evict = torch.arange(cfg.buffer_size, device=cfg.device)
+                num_rows = cfg.buffer_size
+            else:
+                spent = self.uses >= cfg.buffer_reuse
+                stale = age >= cfg.buffer_max_age if cfg.buffer_max_age is not None else torch.zeros_like(spent)
+                must_go = spent | stale
+                served_per_refresh = int(cfg.buffer_size * cfg.buffer_refresh_ratio)
+                num_rows = max(int(must_go.sum()), -(-served_per_refresh // cfg.buffer_reuse))
+                evict = None
+            acts = torch.cat(list(self.model_acts(-(-num_rows // cfg.seq_len), whole_batches=False))) if num_rows > 0 else None
+        if acts is not None:
+            acts = acts[:cfg.buffer_size]
+            if evict is not None:
+                # running out of tokens can give fewer than asked for
+                evict = evict[:acts.shape[0]]
+            else:
+                # must_go rows first, then by uses, then by age
+                key = (must_go.long() << 62) | (self.uses.long() << 31) | age.long()
+                evict = key.topk(acts.shape[0]).indices
+                self.evicted_by_age += int((stale & ~spent)[evict].sum())
+                self.evicted_uses += int(self.uses[evict].sum())
+            self.buffer[evict] = acts.to(self.buffer.dtype)
+            self.uses[evict] = 0
+            self.written_at[evict] = self.num_refreshes + 1
+            self.rows_written += acts.shape[0]
+        self.first = False
+        self.num_refreshes += 1
+        with self.profiler.phase("shuffle"):
+            self.order = torch.randperm(cfg.buffer_size, device=cfg.device)
+
+    def reuse_stats(self):
+        """
+        How much each model activation is used: rows served per row written (about buffer_reuse in
+        reuse mode), and the mean uses and fraction evicted by age of the replaced rows.
+        """
+        replaced = self.rows_written - self.cfg.buffer_size
+        return {
+            "buffer_served_per_written": self.rows_served / max(self.rows_written, 1),
+            "buffer_mean_uses_at_eviction": self.evicted_uses / max(replaced, 1),
+            "buffer_evicted_by_age": self.evicted_by_age / max(replaced, 1),
+            "buffer_rows_written": self.rows_written,
+        }
+
+    @torch.no_grad()
+    def shuffle(self):
         if self.cfg.subshuffle is None:
-            self.buffer = self.buffer[torch.randperm(self.buffer.shape[0]).to(self.cfg.device)]
+            self.buffer = self.buffer[torch.randperm(self.buffer.shape[0], device=self.cfg.device)]
         else:
             ssize = self.buffer.shape[0] // self.cfg.subshuffle
             assert self.buffer.shape[0] % self.cfg.subshuffle == 0
-            rperm = torch.randperm(ssize).to(self.cfg.device)
+            rperm = torch.randperm(ssize, device=self.cfg.device)
             # self.buffer[::self.cfg.subshuffle] = self.buffer[::self.cfg.subshuffle][rperm]
-            perm = torch.arange(ssize)
+            perm = torch.arange(ssize, device=self.cfg.device)
 
             for i in range(self.cfg.subshuffle):
                 self.buffer[i::self.cfg.subshuffle] = self.buffer[i::self.cfg.subshuffle][rperm][perm - i]
             # for i in range(self.cfg.subshuffle):
             #     self.buffer[i*ssize:(i+1)*ssize] = self.buffer[i*ssize:(i+1)*ssize][rperm]
-
-
-
-        self.time_shuffling += time.time() - t0
-        # torch.cuda.empty_cache()
     
     @torch.no_grad()
     def next(self):
-        out = self.buffer[self.pointer:self.pointer+self.cfg.batch_size]
+        if self.reuse:
+            out = self.buffer[self.order[self.pointer:self.pointer+self.cfg.batch_size]]
+        else:
+            out = self.buffer[self.pointer:self.pointer+self.cfg.batch_size]
+            self.rows_served += out.shape[0]
         self.pointer += self.cfg.batch_size
         if self.pointer > int(self.buffer.shape[0] * self.cfg.buffer_refresh_ratio) - self.cfg.batch_size:
             # print("Refreshing the buffer!")
@@ -0,0 +1,135 @@
+# Drops dead, and optionally near duplicate, features from a trained AutoEncoder and saves the smaller
+# one as a new version, so encode and storage cost shrink with the number of live features.
+#
+# Which features are dead comes from measured frequencies: the version's feature stats
+# (feature_stats.py) if they've been collected, else a fresh pass over num_tokens tokens. A feature
+# whose decoder direction is above duplicate_threshold cosine similarity to its nearest neighbour is
+# dropped in favour of that neighbour if the neighbour fires more often.
+#
+# The kept features keep their relative order, and {new_version}_compaction.json records
+#   old_to_new     new id of every old feature, -1 if dropped
+#   new_to_old     old id of every new feature
+#   duplicate_of   old id -> old id of the feature a dropped duplicate was folded into
+# so indexes and analyses keyed by old feature ids can be remapped.
+#
+#   python compact.py --version 171 --min_frequency 1e-8 --duplicate_threshold 0.98
+import json
+import time
+import dataclasses
+from pathlib import Path
+from argparse import ArgumentParser
+from typing import Optional
+
+import torch
+
+from sae import AutoEncoder
+from setup_utils import SAVE_DIR
+from feature_matching import find_duplicates
+
+
+def compaction_path(version, save_dir=None):
+    save_dir = SAVE_DIR if save_dir is None else Path(save_dir)
+    return save_dir/f"{version}_compaction.json"
+
+
+def features_to_keep(ae :AutoEncoder, frequency :torch.Tensor, min_frequency :float = 0, duplicate_threshold :Optional[float] = None):
+    """
+    Returns (keep, duplicate_of): the mask of features to keep, and for each dropped duplicate the old id it was folded into.
+    """
+    frequency = frequency.to(ae.W_dec.device)
+    keep = frequency > min_frequency
+    duplicate_of = {}
+    if duplicate_threshold is not None:
+        dups = find_duplicates(ae.W_dec.detach().float(), duplicate_threshold)
+        nearest = dups["nearest_index"]
+        # drop the less frequent of each pair, the higher id on a tie
+        ids = torch.arange(len(frequency), device=frequency.device)
+        loses = (frequency < frequency[nearest]) | ((frequency == frequency[nearest]) & (ids > nearest))
+        dropped = dups["duplicate"] & loses & keep & keep[nearest]
+        keep &= ~dropped
+        duplicate_of = {int(i): int(nearest[i]) for i in dropped.nonzero().squeeze(1)}
+        # the neighbour can itself be a dropped duplicate, so follow the chain to the one that's kept
+        for i, j in duplicate_of.items():
+            while j in duplicate_of:
+                j = duplicate_of[j]
+            duplicate_of[i] = j
+    return keep, duplicate_of
+
+
+@torch.no_grad()
+def compact(ae :AutoEncoder, keep :torch.Tensor):
+    """
+    A new AutoEncoder with only the features in keep, in their original order.
+
+    Returns:
+        (compacted, old_to_new): old_to_new is the new id of every old feature, -1 for dropped ones.
+    """
+    keep = keep.to(ae.W_dec.device)
+    n_keep = int(keep.sum())
+    cfg = dataclasses.replace(ae.cfg, dict_mult=n_keep / ae.cfg.act_size)
+    assert cfg.dict_size == n_keep
+    new = AutoEncoder(cfg, init_weights=False)
+    new.load_state_dict({"W_enc": ae.W_enc[:, keep].clone(), "b_enc": ae.b_enc[keep].clone(),
+                         "W_dec": ae.W_dec[keep].clone(), "b_dec": ae.b_dec.clone()}, assign=True)
+    new.scaling_factor = ae.scaling_factor
+    new.activation_frequency = ae.activation_frequency[keep].clone()
+    new.steps_since_activation_frequency_reset = ae.steps_since_activation_frequency_reset
+    old_to_new = torch.full((ae.d_dict,), -1, dtype=torch.long, device=keep.device)
+    old_to_new[keep] = torch.arange(n_keep, device=keep.device)
+    return new, old_to_new
+
+
+def measured_frequency(version, ae :AutoEncoder, num_tokens :int, save_dir=None):
+    """
+    Firing frequency per feature, from the saved feature stats if there are any, else measured on num_tokens tokens.
+    """
+    from feature_stats import stats_path, load_stats, collect_stats
+    if stats_path(version, save_dir).exists():
+        stats = load_stats(version, save_dir)
+        print(f"using the feature stats over {stats.tokens} tokens")
+        return stats.frequency
+    from setup_utils import get_model, load_data
+    model = get_model(ae.cfg)
+    stats = collect_stats(ae, model, load_data(model), num_tokens=num_tokens)
+    return stats.frequency
+
+
+def compact_version(version, min_frequency :float = 0, duplicate_threshold :Optional[float] = None, num_tokens :int = int(1e7), save_dir=None):
+    ae = AutoEncoder.load(version, save_dir=save_dir, lazy=False)
+    frequency = measured_frequency(version, ae, num_tokens, save_dir)
+    keep, duplicate_of = features_to_keep(ae, frequency, min_frequency, duplicate_threshold)
+    new, old_to_new = compact(ae, keep)
+    print(f"keeping {new.d_dict} of {ae.d_dict} features: {int((frequency <= min_frequency).sum())} dead, {len(duplicate_of)} duplicates")
+
+    x = torch.randn(4096, ae.cfg.act_size, device=ae.W_enc.device, dtype=ae.W_enc.dtype)
+    timings = []
+    for encoder in [ae, new]:
+        encoder.encode(x)
+        t0 = time.perf_counter()
+        for _ in range(5):
+            encoder.encode(x)
+        timings.append((time.perf_counter() - t0) / 5)
+    print(f"encode time {1000 * timings[0]:.2f}ms -> {1000 * timings[1]:.2f}ms")
+
+    new.save(name=f"compact_{version}")
+    new_version = AutoEncoder.get_version() - 1
+    mapping = {"source_version": version, "min_frequency": min_frequency, "duplicate_threshold": duplicate_threshold,
+               "old_to_new": old_to_new.tolist(), "new_to_old": keep.nonzero().squeeze(1).tolist(), "duplicate_of": duplicate_of}
+    # save always writes to SAVE_DIR
+    with open(compaction_path(new_version), "w") as f:
+        json.dump(mapping, f)
+    return new_version, mapping
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--version", type=int, required=True)
+    parser.add_argument("--min_frequency", type=float, default=0, help="features firing at most this often are dropped")
+    parser.add_argument("--duplicate_threshold", type=float, default=None)
+    parser.add_argument("--num_tokens", type=int, default=int(1e7), help="tokens to measure frequencies on if there are no feature stats")
+    args = parser.parse_args()
+    compact_version(args.version, args.min_frequency, args.duplicate_threshold, args.num_tokens)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+from contextlib import nullcontext
+from functools import lru_cache
+
+import torch
+
+
+def device_type(device):
+    return torch.device(device).type
+
+
+@lru_cache(maxsize=None)
+def cpu_supports_bf16():
+    """
+    True if oneDNN runs bf16 on this CPU. That's AVX512-BF16 / AMX, where CPU autocast to bf16 speeds
+    things up, but also plain AVX512 (bw, vl, dq), where bf16 is converted in software and can be
+    slower than fp32. Set cfg.cpu_bf16 = False on those.
+    """
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def use_cpu_bf16(cfg):
+    if device_type(cfg.device) != "cpu":
+        return False
+    return cpu_supports_bf16() if cfg.cpu_bf16 is None else cfg.cpu_bf16
+
+
+def model_autocast(cfg):
+    """
+    Autocast context for running the transformer to get activations.
+    fp16 on cuda like before, bf16 on cpus that support it, and nothing otherwise.
+    """
+    if device_type(cfg.device) == "cuda":
+        return torch.autocast("cuda", torch.float16)
+    if use_cpu_bf16(cfg):
+        return torch.autocast("cpu", torch.bfloat16)
+    return nullcontext()
+
+
+def configure_threads(cfg):
+    """
+    Sets the intra-op and inter-op thread pools from cfg.num_threads / cfg.num_interop_threads.
+    Should be called before any torch work happens, since torch only lets the inter-op pool
+    be sized once.
+    """
+    if cfg.num_threads is not None:
+        torch.set_num_threads(cfg.num_threads)
+    if cfg.num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(cfg.num_interop_threads)
+        except RuntimeError as e:
+            print("Could not set the number of inter-op threads:", e)
+
+
+def empty_cache(device):
+    if device_type(device) == "cuda":
+        torch.cuda.empty_cache()
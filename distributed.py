@@ -0,0 +1,124 @@
+# Helpers for data-parallel training over torch.distributed (gloo by default, so it runs on cpu nodes).
+# Every helper is a no-op when no process group has been initialised, so single process code can
+# call them unconditionally.
+import os
+from contextlib import nullcontext
+
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_process_group(rank=None, world_size=None, backend="gloo", master_addr="127.0.0.1", master_port=29500):
+    """
+    Joins the process group. With rank/world_size left as None they are read from the environment
+    (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT), which is what torchrun sets.
+    """
+    if rank is None:
+        dist.init_process_group(backend=backend)
+    else:
+        os.environ.setdefault("MASTER_ADDR", master_addr)
+        os.environ.setdefault("MASTER_PORT", str(master_port))
+        dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+
+
+def destroy_process_group():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def shard_tokens(tokens :torch.Tensor):
+    """
+    This rank's contiguous slice of the token corpus. Shards are equally sized so every rank runs
+    the same number of steps.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return tokens
+    shard_size = tokens.shape[0] // world_size
+    rank = get_rank()
+    return tokens[rank * shard_size:(rank + 1) * shard_size]
+
+
+def is_model_parallel(encoder):
+    """
+    True for encoders whose features are split over the ranks (sharded_sae.ShardedAutoEncoder). Every
+    rank then trains on the same batch and owns different parameters, so the data parallel helpers
+    below leave those encoders alone.
+    """
+    return getattr(encoder, "model_parallel", False)
+
+
+def wrap_data_parallel(encoder, cfg):
+    """
+    Wraps the encoder in DistributedDataParallel, which buckets the gradients and all-reduces
+    each bucket as soon as it is ready, overlapping communication with the rest of backward.
+    Only the forward pass should go through the wrapper. Everything else (get_loss, renorm,
+    resampling) is called on the encoder itself.
+    """
+    if not is_distributed() or is_model_parallel(encoder):
+        return encoder
+    return torch.nn.parallel.DistributedDataParallel(encoder, bucket_cap_mb=cfg.ddp_bucket_cap_mb)
+
+
+def no_sync(parallel_encoder, enabled=True):
+    """
+    Skips the gradient all-reduce for the backward passes inside the context, for gradient accumulation.
+    A nullcontext if the encoder isn't wrapped in DDP.
+    """
+    if enabled and isinstance(parallel_encoder, torch.nn.parallel.DistributedDataParallel):
+        return parallel_encoder.no_sync()
+    return nullcontext()
+
+
+def all_reduce_mean(tensor :torch.Tensor):
+    if not is_distributed():
+        return tensor
+    tensor = tensor.clone()
+    dist.all_reduce(tensor)
+    return tensor / get_world_size()
+
+
+def all_gather_cat(tensor :torch.Tensor):
+    """
+    Concatenates tensor along dim 0 over all ranks, in rank order. Tensors must be the same shape on every rank.
+    """
+    if not is_distributed():
+        return tensor
+    gathered = [torch.empty_like(tensor) for _ in range(get_world_size())]
+    dist.all_gather(gathered, tensor.detach().contiguous())
+    return torch.cat(gathered, dim=0)
+
+
+@torch.no_grad()
+def sync_activation_frequency(encoder):
+    """
+    Averages the activation frequency counts over ranks so that dead feature decisions are made on
+    the global frequencies and come out identical everywhere. Every rank runs the same number of
+    steps, so the mean of the counts is the count that one process would have seen over all the data.
+    """
+    if is_distributed() and not is_model_parallel(encoder):
+        encoder.activation_frequency = all_reduce_mean(encoder.activation_frequency)
+
+
+@torch.no_grad()
+def broadcast_parameters(module, src=0):
+    if not is_distributed() or is_model_parallel(module):
+        return
+    for p in module.parameters():
+        dist.broadcast(p.data, src=src)
@@ -0,0 +1,221 @@
+# Approximate encoder for inference: an inverted file (IVF) index over the columns of W_enc, so that
+# only the features likely to fire get their pre-activations computed.
+#
+# The features are clustered with spherical k-means. For a cluster with mean column mu, radius
+# r = max ||w_f - mu|| and largest bias b_max, every member's pre-activation is bounded by
+#     x . w_f + b_f  <=  x . mu + ||x|| r + b_max
+# so with slack=1 any cluster whose bound is <= 0 can be skipped without missing an active feature.
+# That bound gets loose in high dimensions, so slack < 1 shrinks the radius term and n_probe caps the
+# number of clusters searched per token, trading recall for speed. measure_recall and calibrate
+# check that trade against the dense encoder.
+#
+#   python encoder_index.py --version 12 --n_clusters 256
+import time
+from argparse import ArgumentParser
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+
+from sae import AutoEncoder
+
+
+class EncoderIndex():
+    """
+    IVF index over the features of an AutoEncoder. Assumes a relu-like nonlinearity, i.e. features
+    with a pre-activation <= 0 are zero.
+
+    Args:
+        encoder (AutoEncoder): The encoder to index. The index keeps a copy of the weights,
+            so rebuild it if the encoder is trained further.
+        n_clusters (int, optional): Number of k-means clusters. Defaults to sqrt(d_dict) * 4.
+        n_probe (int, optional): Most clusters searched per token. None searches every cluster
+            that passes the bound. Defaults to None.
+        slack (float, optional): Weight on the radius term of the bound, 1 makes the bound exact.
+            Defaults to 1.0.
+        kmeans_iters (int, optional): Defaults to 20.
+    """
+    @torch.no_grad()
+    def __init__(self, encoder :AutoEncoder, n_clusters :Optional[int] = None, n_probe :Optional[int] = None,
+                 slack :float = 1.0, kmeans_iters :int = 20, seed :int = 0):
+        self.encoder = encoder
+        self.n_probe = n_probe
+        self.slack = slack
+        W = encoder.W_enc.detach().float()
+        b = encoder.b_enc.detach().float()
+        d_dict = W.shape[1]
+        if n_clusters is None:
+            n_clusters = int(d_dict ** 0.5) * 4
+        self.n_clusters = min(n_clusters, d_dict)
+        assignment = spherical_kmeans(W.T, self.n_clusters, kmeans_iters, seed)
+
+        # store the features cluster by cluster so each cluster is one contiguous matmul
+        order = torch.argsort(assignment, stable=True)
+        sizes = torch.bincount(assignment, minlength=self.n_clusters)
+        self.offsets = torch.cat([sizes.new_zeros(1), sizes.cumsum(0)]).tolist()
+        self.feature_ids = order
+        self.W = W[:, order].contiguous()
+        self.b = b[order]
+        self.centroids = torch.zeros(W.shape[0], self.n_clusters, device=W.device)
+        self.radii = torch.zeros(self.n_clusters, device=W.device)
+        self.max_bias = torch.full((self.n_clusters,), -float("inf"), device=W.device)
+        for c in range(self.n_clusters):
+            start, end = self.offsets[c], self.offsets[c + 1]
+            if start == end:
+                continue
+            members = self.W[:, start:end]
+            mu = members.mean(dim=1)
+            self.centroids[:, c] = mu
+            self.radii[c] = (members - mu[:, None]).norm(dim=0).max()
+            self.max_bias[c] = self.b[start:end].max()
+
+    @torch.no_grad()
+    def preprocess(self, x :torch.Tensor):
+        # the same input transform as AutoEncoder.encode
+        x = x * self.encoder.cfg.data_rescale
+        x = self.encoder.scale(x)
+        return (x - self.encoder.b_dec).float()
+
+    @torch.no_grad()
+    def probe(self, x_cent :torch.Tensor):
+        """
+        The clusters to search for each token, as a (batch, n_clusters) bool mask.
+        """
+        bound = x_cent @ self.centroids + self.slack * x_cent.norm(dim=-1, keepdim=True) * self.radii + self.max_bias
+        probed = bound > 0
+        if self.n_probe is not None and self.n_probe < self.n_clusters:
+            top = torch.topk(bound, self.n_probe, dim=-1).indices
+            in_top = torch.zeros_like(probed)
+            in_top.scatter_(1, top, True)
+            probed &= in_top
+        return probed
+
+    @torch.no_grad()
+    def encode_sparse(self, x :torch.Tensor):
+        """
+        Active features of x, as (token_idx, feature_idx, value) with only the nonzero entries kept.
+        """
+        x_cent = self.preprocess(x.reshape(-1, x.shape[-1]))
+        probed = self.probe(x_cent)
+        token_idx, feature_idx, values = [], [], []
+        # loop over clusters rather than tokens: each cluster is one (tokens probing it) x (members) matmul
+        for c in torch.nonzero(probed.any(dim=0)).squeeze(1).tolist():
+            start, end = self.offsets[c], self.offsets[c + 1]
+            tokens = torch.nonzero(probed[:, c]).squeeze(1)
+            acts = self.encoder.nonlinearity(x_cent[tokens] @ self.W[:, start:end] + self.b[start:end])
+            t, f = torch.nonzero(acts > 0, as_tuple=True)
+            token_idx.append(tokens[t])
+            feature_idx.append(self.feature_ids[start + f])
+            values.append(acts[t, f])
+        if not values:
+            empty = torch.zeros(0, dtype=torch.long, device=x.device)
+            return empty, empty, torch.zeros(0, device=x.device)
+        return torch.cat(token_idx), torch.cat(feature_idx), torch.cat(values)
+
+    @torch.no_grad()
+    def encode(self, x :torch.Tensor):
+        """
+        Drop in for AutoEncoder.encode. Features that weren't searched come out as 0.
+        """
+        token_idx, feature_idx, values = self.encode_sparse(x)
+        acts = torch.zeros(x.reshape(-1, x.shape[-1]).shape[0], self.encoder.d_dict, device=x.device)
+        acts[token_idx, feature_idx] = values
+        return acts.reshape(*x.shape[:-1], self.encoder.d_dict)
+
+    @torch.no_grad()
+    def searched_fraction(self, x :torch.Tensor):
+        """
+        Fraction of the dense encoder's multiply-adds that encode_sparse does on x.
+        """
+        probed = self.probe(self.preprocess(x.reshape(-1, x.shape[-1])))
+        sizes = torch.tensor(self.offsets, device=probed.device).diff().float()
+        return ((probed.float() @ sizes).sum() / (probed.shape[0] * self.encoder.d_dict)).item()
+
+    @torch.no_grad()
+    def measure_recall(self, x :torch.Tensor):
+        """
+        Compares against the dense encoder on x. recall is the fraction of active (token, feature)
+        pairs that were found, and act_mass_recall the same weighted by activation size.
+        """
+        dense = self.encoder.encode(x).reshape(-1, self.encoder.d_dict)
+        approx = self.encode(x).reshape(-1, self.encoder.d_dict)
+        active = dense > 0
+        found = active & (approx > 0)
+        return {
+            "recall": (found.sum() / active.sum().clamp(min=1)).item(),
+            "act_mass_recall": (dense[found].sum() / dense[active].sum().clamp(min=1e-12)).item(),
+            "searched_fraction": self.searched_fraction(x),
+            "l0_dense": active.float().sum(-1).mean().item(),
+        }
+
+    @torch.no_grad()
+    def calibrate(self, x :torch.Tensor, target_recall :float = 0.99):
+        """
+        Sets n_probe to the smallest power of two that reaches target_recall on x (or None if
+        even searching every passing cluster doesn't). Returns the recall it got.
+        """
+        n_probe = 1
+        while n_probe < self.n_clusters:
+            self.n_probe = n_probe
+            recall = self.measure_recall(x)["recall"]
+            if recall >= target_recall:
+                return recall
+            n_probe *= 2
+        self.n_probe = None
+        return self.measure_recall(x)["recall"]
+
+
+@torch.no_grad()
+def spherical_kmeans(points :torch.Tensor, k :int, iters :int = 20, seed :int = 0):
+    """
+    Clusters the rows of points by cosine similarity. Returns the cluster of each row.
+    """
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    normed = F.normalize(points, dim=-1)
+    centroids = normed[torch.randperm(points.shape[0], generator=generator)[:k].to(points.device)]
+    for _ in range(iters):
+        assignment = (normed @ centroids.T).argmax(dim=-1)
+        new_centroids = torch.zeros_like(centroids).index_add_(0, assignment, normed)
+        counts = torch.bincount(assignment, minlength=k)
+        # re-seed empty clusters with the points that fit their centroid worst
+        empty = torch.nonzero(counts == 0).squeeze(1)
+        if len(empty):
+            fit = (normed * centroids[assignment]).sum(-1)
+            new_centroids[empty] = normed[torch.topk(-fit, len(empty)).indices]
+        centroids = F.normalize(new_centroids, dim=-1)
+    return (normed @ centroids.T).argmax(dim=-1)
+
+
+def main():
+    from buffer import Buffer
+    from setup_utils import get_model, load_data
+    parser = ArgumentParser()
+    parser.add_argument("--version", type=int, required=True)
+    parser.add_argument("--n_clusters", type=int, default=None)
+    parser.add_argument("--target_recall", type=float, default=0.99)
+    parser.add_argument("--slack", type=float, nargs="+", default=[1.0, 0.5, 0.25, 0.0])
+    args = parser.parse_args()
+
+    encoder = AutoEncoder.load(args.version)
+    cfg = encoder.cfg
+    model = get_model(cfg)
+    buffer = Buffer(cfg, load_data(model), model=model)
+    x = buffer.next().float()
+
+    t0 = time.time()
+    index = EncoderIndex(encoder, n_clusters=args.n_clusters)
+    print(f"Built an index with {index.n_clusters} clusters in {time.time() - t0:.1f}s")
+    for slack in args.slack:
+        index.slack = slack
+        for n_probe in [None] + [2 ** k for k in range(int(index.n_clusters).bit_length())][::-1]:
+            index.n_probe = n_probe
+            print(f"slack {slack} n_probe {n_probe}:", index.measure_recall(x))
+        recall = index.calibrate(x, args.target_recall)
+        if index.n_probe is None:
+            print(f"slack {slack}: no n_probe reaches recall {args.target_recall}, searching every passing cluster (exhaustive) gets {recall:.4f}")
+        else:
+            print(f"slack {slack}: n_probe {index.n_probe} reaches recall {args.target_recall} ({recall:.4f})")
+
+
+if __name__ == "__main__":
+    main()
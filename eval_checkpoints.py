@@ -0,0 +1,124 @@
+# Evaluates many saved versions of an AutoEncoder on the same act_name in one pass over the eval tokens.
+#
+# get_recons_loss does a clean forward, a zero ablation forward and a spliced forward per call, so
+# scoring N checkpoints that way runs the clean and zero ablation forwards N times. Here each eval
+# batch runs the clean model once, caching the loss, the hooked activation and the residual stream
+# going into cfg.layer. The zero ablation and every checkpoint then only rerun the model from
+# cfg.layer onwards (start_at_layer), with the activation at act_name swapped for zeros or the
+# checkpoint's reconstruction of the cached clean activation.
+#
+#   python eval_checkpoints.py --versions 171 172 173 --num_seqs 512
+# prints one row per version: recons score, L0 and the fraction of features that never fired.
+import dataclasses
+from argparse import ArgumentParser
+
+import einops
+import torch
+import tqdm
+
+from sae import AutoEncoder
+
+
+def load_versions(versions, save_dir=None):
+    encoders = [AutoEncoder.load(v, save_dir=save_dir) for v in versions]
+    cfg = encoders[0].cfg
+    for v, encoder in zip(versions, encoders):
+        assert (encoder.cfg.act_name, encoder.cfg.model_name) == (cfg.act_name, cfg.model_name), \
+            f"version {v} is on {encoder.cfg.model_name} {encoder.cfg.act_name}, not {cfg.model_name} {cfg.act_name}"
+    return encoders
+
+
+# neither hook writes into acts: for a resid_pre site that's the cached residual every variant restarts from
+def zeros_hook(acts, hook):
+    return torch.zeros_like(acts)
+
+
+def splice_hook(acts, hook, replacement):
+    return replacement.to(acts.dtype)
+
+
+@torch.no_grad()
+def evaluate(encoders, model, tokens :torch.Tensor, batch_seqs :int = 32, names=None):
+    """
+    Recons score, L0 and dead fraction of every encoder over tokens. All encoders must share act_name.
+    Returns a list of dicts, in the order of encoders.
+    """
+    cfg = encoders[0].cfg
+    names = [str(i) for i in range(len(encoders))] if names is None else names
+    resid_name = f"blocks.{cfg.layer}.hook_resid_pre"
+    totals = {"loss": 0, "zero_abl_loss": 0}
+    recons_losses = [0. for _ in encoders]
+    l0s = [0. for _ in encoders]
+    fired = [torch.zeros(e.d_dict, dtype=torch.bool, device=e.W_enc.device) for e in encoders]
+    n_batches, n_tokens = 0, 0
+    for start in tqdm.trange(0, len(tokens), batch_seqs):
+        batch = tokens[start:start + batch_seqs].to(cfg.device)
+        loss, cache = model.run_with_cache(batch, return_type="loss", names_filter=[resid_name, cfg.act_name])
+        resid, clean = cache[resid_name], cache[cfg.act_name]
+        totals["loss"] += loss.item()
+        # everything before cfg.layer is the same for every variant, so they all start from the cached residual
+        def downstream_loss(hook):
+            return model.run_with_hooks(resid, start_at_layer=cfg.layer, tokens=batch, return_type="loss",
+                                        fwd_hooks=[(cfg.act_name, hook)]).item()
+        totals["zero_abl_loss"] += downstream_loss(zeros_hook)
+        x = einops.rearrange(clean, "batch seq_pos ... -> batch seq_pos (...)")
+        for i, encoder in enumerate(encoders):
+            reconstruction = encoder(x.to(encoder.W_enc.dtype), cache_l0=False, cache_acts=True)
+            acts = encoder.cached_acts
+            encoder.cached_acts = None
+            recons_losses[i] += downstream_loss(lambda a, hook: splice_hook(a, hook, reconstruction.reshape(clean.shape)))
+            active = acts > 0
+            l0s[i] += active.sum().item()
+            fired[i] |= active.flatten(0, 1).any(0)
+        n_batches += 1
+        n_tokens += x.shape[0] * x.shape[1]
+    loss, zero_abl_loss = totals["loss"] / n_batches, totals["zero_abl_loss"] / n_batches
+    results = []
+    for i, encoder in enumerate(encoders):
+        recons_loss = recons_losses[i] / n_batches
+        results.append({
+            "name": names[i],
+            "recons_score": (zero_abl_loss - recons_loss) / (zero_abl_loss - loss),
+            "loss": loss,
+            "recons_loss": recons_loss,
+            "zero_abl_loss": zero_abl_loss,
+            "l0": l0s[i] / n_tokens,
+            "dead": 1 - fired[i].float().mean().item(),
+            "d_dict": encoder.d_dict,
+        })
+    return results
+
+
+def print_table(results):
+    print(f"{'version':>10} {'d_dict':>8} {'recons':>8} {'l0':>8} {'dead':>8} {'recons_loss':>12}")
+    for r in results:
+        print(f"{r['name']:>10} {r['d_dict']:>8} {r['recons_score']:>8.2%} {r['l0']:>8.1f} {r['dead']:>8.2%} {r['recons_loss']:>12.4f}")
+    print(f"clean loss {results[0]['loss']:.4f}, zero ablation loss {results[0]['zero_abl_loss']:.4f}")
+
+
+def main():
+    from setup_utils import get_model, load_data, get_random_model, get_random_tokens, HELD_OUT_SEQS
+    from sae_config import AutoEncoderConfig
+    parser = ArgumentParser()
+    parser.add_argument("--versions", type=int, nargs="+", default=None)
+    parser.add_argument("--num_seqs", type=int, default=256, help=f"taken from load_data's held out rows, which training never sees (at most {HELD_OUT_SEQS})")
+    parser.add_argument("--batch_seqs", type=int, default=32)
+    parser.add_argument("--random_model", action="store_true", help="a random model and a few random encoders, for trying it out")
+    args = parser.parse_args()
+    if args.random_model:
+        cfg = AutoEncoderConfig(site="resid_pre", act_size=512, layer=1, dict_mult=8, flatten_heads=False, device="cpu")
+        # AutoEncoder seeds torch with cfg.seed, so each needs its own seed to differ
+        encoders = [AutoEncoder(dataclasses.replace(cfg, seed=i)) for i in range(3)]
+        names = [f"random_{i}" for i in range(3)]
+        model = get_random_model(cfg)
+        tokens = get_random_tokens(cfg, args.num_seqs, d_vocab=model.cfg.d_vocab)
+    else:
+        encoders = load_versions(args.versions)
+        names = [str(v) for v in args.versions]
+        model = get_model(encoders[0].cfg)
+        tokens = load_data(model, held_out=True)[:args.num_seqs]
+    print_table(evaluate(encoders, model, tokens, args.batch_seqs, names))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# Matches the features of two or more dictionaries by the cosine similarity of their decoder rows,
+# without ever building the full d_dict x d_dict similarity matrix. Both sides are tiled into blocks,
+# each block's similarities are folded into a running top k, and blocks of rows run on a thread pool,
+# so memory stays at about workers * block_size^2 floats whatever the dictionary size. There are
+# never more workers than blocks of rows, so a small dictionary runs its matmuls on all the cores.
+#
+#   python feature_matching.py 171 172 173 --save_dir ~/mats/sae/models-from-remote/
+# compares 171 against 172 and 173, and reports the duplicates within each of them.
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+
+from sae import AutoEncoder
+
+
+@torch.no_grad()
+def blockwise_topk(A :torch.Tensor, B :torch.Tensor, k :int = 1, block_size :int = 4096, workers :Optional[int] = None,
+                   exclude_self :bool = False):
+    """
+    Top k cosine similarities of every row of A against the rows of B.
+
+    Args:
+        A (torch.Tensor): (n, d), rows are compared.
+        B (torch.Tensor): (m, d).
+        k (int, optional): Defaults to 1.
+        block_size (int, optional): Rows of A and of B per tile. Defaults to 4096.
+        workers (int, optional): Threads, each working on its own blocks of A, at most one per block.
+            Defaults to os.cpu_count().
+        exclude_self (bool, optional): A and B are the same dictionary, so skip each row's match
+            with itself. Defaults to False.
+
+    Returns:
+        (values, indices), both (n, k), sorted by decreasing similarity.
+    """
+    A = F.normalize(A.float(), dim=-1)
+    B = F.normalize(B.float(), dim=-1)
+    n, m = A.shape[0], B.shape[0]
+    k = min(k, m - exclude_self)
+    values = torch.empty(n, k, device=A.device)
+    indices = torch.empty(n, k, dtype=torch.long, device=A.device)
+
+    def run_block(a_start):
+        a = A[a_start:a_start + block_size]
+        best_v = torch.full((a.shape[0], k), -float("inf"), device=A.device)
+        best_i = torch.zeros((a.shape[0], k), dtype=torch.long, device=A.device)
+        rows = torch.arange(a.shape[0], device=A.device)
+        for b_start in range(0, m, block_size):
+            sims = a @ B[b_start:b_start + block_size].T
+            if exclude_self:
+                cols = rows + a_start - b_start
+                on_block = (cols >= 0) & (cols < sims.shape[1])
+                sims[rows[on_block], cols[on_block]] = -float("inf")
+            cand_v = torch.cat([best_v, sims], dim=1)
+            cand_i = torch.cat([best_i, torch.arange(b_start, b_start + sims.shape[1], device=A.device).expand(a.shape[0], -1)], dim=1)
+            best_v, top = torch.topk(cand_v, k, dim=1)
+            best_i = torch.gather(cand_i, 1, top)
+        values[a_start:a_start + block_size] = best_v
+        indices[a_start:a_start + block_size] = best_i
+
+    starts = range(0, n, block_size)
+    # more workers than blocks would only take threads away from the matmuls
+    workers = min(workers or os.cpu_count() or 1, len(starts))
+    if workers <= 1:
+        for a_start in starts:
+            run_block(a_start)
+        return values, indices
+    # split the cores between the workers instead of every worker's matmuls using all of them
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(max(1, num_threads // workers))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(run_block, starts))
+    finally:
+        torch.set_num_threads(num_threads)
+    return values, indices
+
+
+def match(dec_a :torch.Tensor, dec_b :torch.Tensor, **kwargs):
+    """
+    Best match in b for every feature of a and vice versa. A pair is mutual when each is the
+    other's best match.
+    """
+    a_v, a_i = blockwise_topk(dec_a, dec_b, k=1, **kwargs)
+    b_v, b_i = blockwise_topk(dec_b, dec_a, k=1, **kwargs)
+    a_v, a_i, b_i = a_v[:, 0], a_i[:, 0], b_i[:, 0]
+    mutual = b_i[a_i] == torch.arange(dec_a.shape[0], device=a_i.device)
+    return {"best_cos": a_v, "best_index": a_i, "mutual": mutual, "reverse_best_cos": b_v[:, 0]}
+
+
+def find_duplicates(dec :torch.Tensor, threshold :float = 0.95, **kwargs):
+    """
+    Features with another feature of the same dictionary above threshold cosine similarity.
+    Returns the nearest other feature and its similarity for every feature, and the duplicate mask.
+    """
+    v, i = blockwise_topk(dec, dec, k=1, exclude_self=True, **kwargs)
+    return {"nearest_cos": v[:, 0], "nearest_index": i[:, 0], "duplicate": v[:, 0] > threshold}
+
+
+def universality(reference :torch.Tensor, others :List[torch.Tensor], threshold :float = 0.7, **kwargs):
+    """
+    For each feature of reference, the fraction of the other dictionaries that have a feature
+    above threshold cosine similarity to it, and its best similarity in each of them.
+    """
+    best = torch.stack([blockwise_topk(reference, other, k=1, **kwargs)[0][:, 0] for other in others], dim=1)
+    return {"best_cos": best, "universality": (best > threshold).float().mean(dim=1)}
+
+
+def dead_features(version, save_dir=None):
+    """
+    Features that never fired in the feature stats saved for version (see feature_stats.py),
+    or None if there are no stats. The weights alone can't tell a dead feature from a rare one.
+    """
+    from feature_stats import stats_path, load_stats
+    if not stats_path(version, save_dir).exists():
+        return None
+    return load_stats(version, save_dir).count == 0
+
+
+def compare_versions(versions :List[int], save_dir=None, match_threshold=0.7, duplicate_threshold=0.95, **kwargs):
+    """
+    Compares the first version against the rest and reports each one's duplicates and dead features.
+    """
+    decoders = {v: AutoEncoder.load(v, save_dir=save_dir).W_dec.detach() for v in versions}
+    report = {}
+    for v, dec in decoders.items():
+        dups = find_duplicates(dec, duplicate_threshold, **kwargs)
+        dead = dead_features(v, save_dir)
+        report[v] = {
+            "d_dict": dec.shape[0],
+            "duplicate_fraction": dups["duplicate"].float().mean().item(),
+            "dead_fraction": None if dead is None else dead.float().mean().item(),
+        }
+        print(f"version {v}:", report[v])
+    reference, *others = versions
+    for v in others:
+        m = match(decoders[reference], decoders[v], **kwargs)
+        report[(reference, v)] = {
+            "mean_best_cos": m["best_cos"].mean().item(),
+            f"matched_above_{match_threshold}": (m["best_cos"] > match_threshold).float().mean().item(),
+            "mutual_fraction": m["mutual"].float().mean().item(),
+        }
+        print(f"{reference} -> {v}:", report[(reference, v)])
+    if len(others) > 1:
+        u = universality(decoders[reference], [decoders[v] for v in others], match_threshold, **kwargs)
+        report["universality"] = u["universality"].mean().item()
+        print(f"mean universality of {reference}'s features over {others}:", report["universality"])
+    return report
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("versions", type=int, nargs="+")
+    parser.add_argument("--save_dir", type=str, default=None)
+    parser.add_argument("--match_threshold", type=float, default=0.7)
+    parser.add_argument("--duplicate_threshold", type=float, default=0.95)
+    parser.add_argument("--block_size", type=int, default=4096)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    compare_versions(args.versions, save_dir=args.save_dir, match_threshold=args.match_threshold,
+                     duplicate_threshold=args.duplicate_threshold, block_size=args.block_size, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
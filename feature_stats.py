@@ -0,0 +1,228 @@
+# Streaming per-feature statistics of the nonzero activations over a token corpus: count, mean, max
+# and a quantile sketch, in constant memory per feature.
+#
+# The sketch is a log-bucketed histogram (like DDSketch): bucket i holds the values in
+# [gamma^i, gamma^(i+1)), so any quantile comes back with relative error at most (gamma - 1) / (gamma + 1),
+# i.e. rel_accuracy. Every statistic is a sum or a max, so the stats of two disjoint token sets
+# merge exactly, whether they come from merge() or an all_reduce over torch.distributed.
+#
+# The stats are saved next to the checkpoint as {version}_feature_stats.sketch.
+#   python feature_stats.py --version 12 --num_tokens 10000000 --world_size 4
+import os
+import math
+import dataclasses
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Optional, TYPE_CHECKING
+
+import einops
+import torch
+import torch.multiprocessing as mp
+import tqdm
+
+import distributed
+from sae import AutoEncoder
+from setup_utils import SAVE_DIR
+from device_utils import model_autocast
+
+if TYPE_CHECKING:
+    from transformer_lens import HookedTransformer
+
+
+class FeatureStats():
+    """
+    Args:
+        d_dict (int): Number of features.
+        rel_accuracy (float, optional): Relative accuracy of the quantiles. Defaults to 0.02.
+        min_value (float, optional): Values below this share the lowest bucket. Defaults to 1e-4.
+        max_value (float, optional): Values above this share the highest bucket. Defaults to 1e4.
+    """
+    def __init__(self, d_dict :int, rel_accuracy :float = 0.02, min_value :float = 1e-4, max_value :float = 1e4, device="cpu"):
+        self.d_dict = d_dict
+        self.rel_accuracy = rel_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self.log_gamma = math.log((1 + rel_accuracy) / (1 - rel_accuracy))
+        self.min_bucket = math.floor(math.log(min_value) / self.log_gamma)
+        self.n_buckets = math.floor(math.log(max_value) / self.log_gamma) - self.min_bucket + 1
+        self.tokens = 0
+        self.count = torch.zeros(d_dict, dtype=torch.int64, device=device)
+        self.sum = torch.zeros(d_dict, dtype=torch.float64, device=device)
+        self.max = torch.zeros(d_dict, dtype=torch.float32, device=device)
+        self.histogram = torch.zeros(d_dict, self.n_buckets, dtype=torch.int32, device=device)
+
+    @torch.no_grad()
+    def update(self, acts :torch.Tensor):
+        """
+        Adds a (tokens, d_dict) batch of feature activations.
+        """
+        acts = acts.reshape(-1, self.d_dict).float()
+        self.tokens += acts.shape[0]
+        self.sum += acts.sum(0, dtype=torch.float64)
+        self.max = torch.maximum(self.max, acts.max(0).values)
+        token_idx, feature_idx = torch.nonzero(acts > 0, as_tuple=True)
+        values = acts[token_idx, feature_idx]
+        self.count += torch.bincount(feature_idx, minlength=self.d_dict)
+        buckets = self.bucket(values)
+        flat = feature_idx * self.n_buckets + buckets
+        self.histogram.view(-1).index_add_(0, flat, torch.ones_like(flat, dtype=torch.int32))
+
+    def bucket(self, values :torch.Tensor):
+        idx = torch.floor(values.clamp(self.min_value, self.max_value).log() / self.log_gamma).long()
+        return (idx - self.min_bucket).clamp(0, self.n_buckets - 1)
+
+    def bucket_value(self, buckets :torch.Tensor):
+        # the point of the bucket with the same relative error to both ends
+        lower = torch.exp((buckets + self.min_bucket).double() * self.log_gamma)
+        return (2 * lower * math.exp(self.log_gamma) / (1 + math.exp(self.log_gamma))).float()
+
+    def quantile(self, q :float):
+        """
+        The q quantile of each feature's nonzero activations, nan for features that never fired.
+        """
+        cumulative = self.histogram.cumsum(dim=1, dtype=torch.int64)
+        rank = (q * (self.count - 1)).floor().long()
+        buckets = torch.searchsorted(cumulative, (rank + 1)[:, None]).squeeze(1).clamp(max=self.n_buckets - 1)
+        out = self.bucket_value(buckets)
+        # the max is exact, and the sketch rounds it
+        out = torch.minimum(out, self.max)
+        out[self.count == 0] = float("nan")
+        return out
+
+    @property
+    def mean(self):
+        """
+        Mean of the nonzero activations, nan for features that never fired.
+        """
+        return (self.sum / self.count).float()
+
+    @property
+    def frequency(self):
+        return self.count.float() / max(self.tokens, 1)
+
+    def summary(self, quantiles=(0.1, 0.5, 0.9, 0.99)):
+        out = {"frequency": self.frequency, "mean": self.mean, "max": self.max}
+        for q in quantiles:
+            out[f"q{q}"] = self.quantile(q)
+        return out
+
+    def compatible(self, other :"FeatureStats"):
+        return (self.d_dict, self.rel_accuracy, self.min_value, self.max_value) == (other.d_dict, other.rel_accuracy, other.min_value, other.max_value)
+
+    def merge(self, other :"FeatureStats"):
+        assert self.compatible(other), "can only merge stats with the same sketch parameters"
+        self.tokens += other.tokens
+        self.count += other.count.to(self.count.device)
+        self.sum += other.sum.to(self.sum.device)
+        self.max = torch.maximum(self.max, other.max.to(self.max.device))
+        self.histogram += other.histogram.to(self.histogram.device)
+        return self
+
+    def all_reduce(self):
+        """
+        Merges the stats of every rank in place. Every rank ends up with the total.
+        """
+        if not distributed.is_distributed():
+            return self
+        tokens = torch.tensor([self.tokens], dtype=torch.int64)
+        for t in [tokens, self.count, self.sum, self.histogram]:
+            torch.distributed.all_reduce(t)
+        torch.distributed.all_reduce(self.max, op=torch.distributed.ReduceOp.MAX)
+        self.tokens = tokens.item()
+        return self
+
+    def state_dict(self):
+        return {
+            "d_dict": self.d_dict, "rel_accuracy": self.rel_accuracy, "min_value": self.min_value,
+            "max_value": self.max_value, "tokens": self.tokens, "count": self.count, "sum": self.sum,
+            "max": self.max, "histogram": self.histogram,
+        }
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+        print("Saved feature stats to", path)
+
+    @classmethod
+    def load(cls, path, device="cpu"):
+        state = torch.load(path, map_location=device, weights_only=True)
+        self = cls(state["d_dict"], state["rel_accuracy"], state["min_value"], state["max_value"], device="meta")
+        self.tokens = state["tokens"]
+        for k in ["count", "sum", "max", "histogram"]:
+            setattr(self, k, state[k])
+        return self
+
+
+def stats_path(version, save_dir=None):
+    # not .pt, so AutoEncoder.load's glob for the weights doesn't pick it up
+    save_dir = SAVE_DIR if save_dir is None else Path(save_dir)
+    return save_dir/f"{version}_feature_stats.sketch"
+
+
+def load_stats(version, save_dir=None, device="cpu"):
+    return FeatureStats.load(stats_path(version, save_dir), device=device)
+
+
+@torch.no_grad()
+def collect_stats(encoder :AutoEncoder, model :"HookedTransformer", tokens :torch.Tensor, stats :Optional[FeatureStats] = None,
+                  num_tokens :Optional[int] = None, show_progress=True, **sketch_kwargs):
+    """
+    Runs the model over tokens (sequences of cfg.seq_len) and adds the encoder's activations to stats.
+    """
+    cfg = encoder.cfg
+    if stats is None:
+        stats = FeatureStats(encoder.d_dict, device=cfg.device, **sketch_kwargs)
+    n_seqs = tokens.shape[0] if num_tokens is None else min(tokens.shape[0], num_tokens // tokens.shape[1])
+    for start in tqdm.trange(0, n_seqs, cfg.model_batch_size, disable=not show_progress):
+        batch = tokens[start:min(start + cfg.model_batch_size, n_seqs)].to(cfg.device)
+        with model_autocast(cfg):
+            _, cache = model.run_with_cache(batch, stop_at_layer=cfg.layer + 1, names_filter=cfg.act_name)
+        acts = einops.rearrange(cache[cfg.act_name], "batch seq_pos ... -> (batch seq_pos) (...)")
+        stats.update(encoder.encode(acts.float()))
+    return stats
+
+
+def run(args):
+    from setup_utils import get_model, load_data
+    encoder = AutoEncoder.load(args.version)
+    if args.device is not None:
+        encoder.cfg = dataclasses.replace(encoder.cfg, device=args.device)
+        encoder.to(args.device)
+    model = get_model(encoder.cfg)
+    # every rank loads the tokens in the same order and takes its own slice. load_data shuffles with
+    # the global rng, so seed it here rather than rely on what ran before
+    torch.manual_seed(encoder.cfg.seed)
+    tokens = distributed.shard_tokens(load_data(model))
+    num_tokens = None if args.num_tokens is None else args.num_tokens // distributed.get_world_size()
+    stats = collect_stats(encoder, model, tokens, num_tokens=num_tokens, show_progress=distributed.is_main_process(),
+                          rel_accuracy=args.rel_accuracy)
+    stats.all_reduce()
+    if distributed.is_main_process():
+        stats.save(stats_path(args.version))
+
+
+def worker(rank, world_size, args):
+    distributed.init_process_group(rank, world_size, master_port=args.port)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    try:
+        run(args)
+    finally:
+        distributed.destroy_process_group()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--version", type=int, required=True)
+    parser.add_argument("--num_tokens", type=int, default=None)
+    parser.add_argument("--rel_accuracy", type=float, default=0.02)
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--world_size", type=int, default=None, help="number of local worker processes")
+    parser.add_argument("--port", type=int, default=29500)
+    args = parser.parse_args()
+    if args.world_size is None:
+        run(args)
+    else:
+        mp.spawn(worker, args=(args.world_size, args), nprocs=args.world_size)
+
+
+if __name__ == "__main__":
+    main()
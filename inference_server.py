@@ -0,0 +1,371 @@
+# A long running local service that keeps a HookedTransformer and some AutoEncoders loaded and
+# returns sparse feature activations, so analysis scripts don't each reload everything.
+#
+# Requests that arrive within window_ms of each other (up to max_batch_tokens) are right padded and
+# run as one forward pass. The model is causal, so padding on the right doesn't change the real
+# positions. One cache covers every SAE: each reads its own act_name from the same run.
+#
+# The server listens on a Unix socket or a localhost TCP port, and speaks either protocol on the same
+# connection type:
+#   JSON lines   one request object per line, one response per line, in order
+#   HTTP         POST /encode with a request object as the body, GET /metrics
+# A request is
+#   {"tokens": [[...], ...]} or {"text": "..." or ["...", ...]},
+#   optionally "saes": [names] (default all), "top_k": k per position, "threshold": min activation
+# and the response has, for every sae, the nonzero activations in COO form:
+#   {"tokens": [[...]], "features": {name: {"seq": [...], "pos": [...], "feature": [...], "value": [...]}}}
+# {"op": "metrics"} on a JSON lines connection returns the metrics.
+#
+#   python inference_server.py --versions 171 172 --socket /tmp/sae.sock
+#   python inference_server.py --random_model --port 8765
+# and from a script:
+#   client = Client("/tmp/sae.sock"); out = client.encode(text="Hello world")
+import json
+import time
+import socket
+import asyncio
+import collections
+from argparse import ArgumentParser
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+import torch
+import einops
+
+from sae import AutoEncoder
+from device_utils import model_autocast, device_type
+
+if TYPE_CHECKING:
+    from transformer_lens import HookedTransformer
+
+
+class Metrics():
+    """
+    Counters plus latency and batch size over the last window requests.
+    """
+    def __init__(self, window :int = 1000):
+        self.t_start = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.sequences = 0
+        self.tokens = 0
+        self.batches = 0
+        self.forward_time = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.queue_waits = collections.deque(maxlen=window)
+        self.batch_tokens = collections.deque(maxlen=window)
+
+    def record_batch(self, n_seqs, n_tokens, forward_time):
+        self.batches += 1
+        self.sequences += n_seqs
+        self.tokens += n_tokens
+        self.forward_time += forward_time
+        self.batch_tokens.append(n_tokens)
+
+    def summary(self):
+        def quantiles(values):
+            if not values:
+                return None
+            t = torch.tensor(list(values), dtype=torch.float64)
+            return {f"p{int(q * 100)}": torch.quantile(t, q).item() for q in [0.5, 0.9, 0.99]}
+        elapsed = time.time() - self.t_start
+        return {
+            "uptime_s": elapsed,
+            "requests": self.requests,
+            "errors": self.errors,
+            "sequences": self.sequences,
+            "tokens": self.tokens,
+            "batches": self.batches,
+            "tokens_per_s": self.tokens / elapsed,
+            "forward_tokens_per_s": self.tokens / self.forward_time if self.forward_time else None,
+            "requests_per_batch": self.requests / self.batches if self.batches else None,
+            "latency_ms": quantiles([1000 * l for l in self.latencies]),
+            "queue_wait_ms": quantiles([1000 * l for l in self.queue_waits]),
+            "batch_tokens": quantiles(self.batch_tokens),
+        }
+
+
+class InferenceServer():
+    """
+    Args:
+        model (HookedTransformer): The model all the encoders read from.
+        encoders (Dict[str, AutoEncoder]): Encoders by the name requests use.
+        window_ms (float, optional): How long the first request of a batch waits for others. Defaults to 5.
+        max_batch_tokens (int, optional): Stop adding requests to a batch past this many (padded) tokens. Defaults to 16384.
+    """
+    def __init__(self, model :"HookedTransformer", encoders :Dict[str, AutoEncoder], window_ms :float = 5, max_batch_tokens :int = 16384):
+        self.model = model
+        self.encoders = encoders
+        self.window = window_ms / 1000
+        self.max_batch_tokens = max_batch_tokens
+        self.metrics = Metrics()
+        cfgs = [e.cfg for e in encoders.values()]
+        self.act_names = sorted({c.act_name for c in cfgs})
+        self.stop_at_layer = max(c.layer for c in cfgs) + 1
+        self.cfg = cfgs[0]
+        self.queue = None
+
+    def tokens_of(self, request):
+        if "tokens" in request:
+            tokens = request["tokens"]
+            # a single sequence is allowed too
+            return [tokens] if tokens and isinstance(tokens[0], int) else tokens
+        texts = request["text"]
+        texts = [texts] if isinstance(texts, str) else texts
+        return [self.model.to_tokens(t)[0].tolist() for t in texts]
+
+    def check_tokens(self, seqs):
+        # a bad sequence would otherwise fail the whole batch it lands in
+        d_vocab, n_ctx = self.model.cfg.d_vocab, self.model.cfg.n_ctx
+        if not seqs:
+            raise ValueError("no sequences")
+        for s in seqs:
+            if not s:
+                raise ValueError("empty sequence")
+            if len(s) > n_ctx:
+                raise ValueError(f"sequence of {len(s)} tokens is longer than n_ctx {n_ctx}")
+            if not all(isinstance(t, int) and 0 <= t < d_vocab for t in s):
+                raise ValueError(f"token ids have to be ints in [0, {d_vocab})")
+
+    @torch.no_grad()
+    def run_batch(self, requests :List[dict]):
+        """
+        One forward pass for all the sequences of the requests. Returns a response per request.
+        """
+        seqs = [s for r in requests for s in r["_tokens"]]
+        lengths = torch.tensor([len(s) for s in seqs])
+        tokens = torch.zeros(len(seqs), int(lengths.max()), dtype=torch.long)
+        for i, s in enumerate(seqs):
+            tokens[i, :len(s)] = torch.tensor(s)
+        t0 = time.perf_counter()
+        with model_autocast(self.cfg):
+            _, cache = self.model.run_with_cache(tokens.to(self.cfg.device), stop_at_layer=self.stop_at_layer,
+                                                 names_filter=lambda name: name in self.act_names)
+        valid = (torch.arange(tokens.shape[1])[None] < lengths[:, None]).to(self.cfg.device)
+        acts_by_sae = {}
+        wanted = {n for r in requests for n in (r.get("saes") or self.encoders)}
+        for name in wanted:
+            encoder = self.encoders[name]
+            acts = cache[encoder.cfg.act_name]
+            if encoder.cfg.flatten_heads and acts.dim() == 4:
+                acts = einops.rearrange(acts, "batch seq_pos n_head d_head -> batch seq_pos (n_head d_head)")
+            acts_by_sae[name] = encoder.encode(acts.to(encoder.W_enc.dtype)) * valid[..., None]
+        if device_type(self.cfg.device) == "cuda":
+            torch.cuda.synchronize()
+        self.metrics.record_batch(len(seqs), int(lengths.sum()), time.perf_counter() - t0)
+
+        responses, start = [], 0
+        for r in requests:
+            n = len(r["_tokens"])
+            features = {}
+            for name in r.get("saes") or self.encoders:
+                features[name] = sparse_features(acts_by_sae[name][start:start + n], r.get("top_k"), r.get("threshold", 0))
+            responses.append({"tokens": r["_tokens"], "features": features})
+            start += n
+        return responses
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            n_tokens = batch[0][0]["_n_tokens"]
+            deadline = loop.time() + self.window
+            while n_tokens < self.max_batch_tokens:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                n_tokens += item[0]["_n_tokens"]
+            requests = [r for r, _ in batch]
+            now = time.perf_counter()
+            for r in requests:
+                self.metrics.queue_waits.append(now - r["_t0"])
+            try:
+                # forward passes run on a separate thread so the loop keeps accepting requests meanwhile
+                responses = await loop.run_in_executor(None, self.run_batch, requests)
+                for (_, future), response in zip(batch, responses):
+                    future.set_result(response)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # rerun one at a time so only the request that fails gets the error
+                for request, future in batch:
+                    try:
+                        future.set_result((await loop.run_in_executor(None, self.run_batch, [request]))[0])
+                    except Exception as e:
+                        future.set_exception(e)
+
+    async def handle(self, request :dict):
+        if request.get("op") == "metrics":
+            return self.metrics.summary()
+        t0 = time.perf_counter()
+        self.metrics.requests += 1
+        try:
+            unknown = [n for n in request.get("saes") or [] if n not in self.encoders]
+            if unknown:
+                raise ValueError(f"unknown saes {unknown}, have {list(self.encoders)}")
+            # to_tokens can take a while for long texts, so it stays off the loop
+            request["_tokens"] = await asyncio.get_running_loop().run_in_executor(None, self.tokens_of, request)
+            self.check_tokens(request["_tokens"])
+            request["_n_tokens"] = len(request["_tokens"]) * max(len(s) for s in request["_tokens"])
+            request["_t0"] = t0
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((request, future))
+            response = await future
+        except Exception as e:
+            self.metrics.errors += 1
+            return {"error": f"{type(e).__name__}: {e}"}
+        self.metrics.latencies.append(time.perf_counter() - t0)
+        if "id" in request:
+            response["id"] = request["id"]
+        return response
+
+    async def serve_connection(self, reader :asyncio.StreamReader, writer :asyncio.StreamWriter):
+        try:
+            first = await reader.readline()
+            if first.split(b" ")[0] in [b"GET", b"POST"]:
+                await self.serve_http(first, reader, writer)
+                return
+            line = first
+            while line:
+                if line.strip():
+                    try:
+                        response = await self.handle(json.loads(line))
+                    except json.JSONDecodeError as e:
+                        response = {"error": f"bad json: {e}"}
+                    writer.write(json.dumps(response).encode() + b"\n")
+                    await writer.drain()
+                line = await reader.readline()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve_http(self, request_line, reader, writer):
+        method, path = request_line.decode().split(" ")[:2]
+        headers = {}
+        while (line := await reader.readline()) not in [b"\r\n", b"\n", b""]:
+            key, _, value = line.decode().partition(":")
+            headers[key.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        if method == "GET" and path == "/metrics":
+            status, response = "200 OK", self.metrics.summary()
+        elif method == "POST" and path == "/encode":
+            try:
+                response = await self.handle(json.loads(body))
+            except json.JSONDecodeError as e:
+                response = {"error": f"bad json: {e}"}
+            status = "400 Bad Request" if "error" in response else "200 OK"
+        else:
+            status, response = "404 Not Found", {"error": f"no route {method} {path}"}
+        payload = json.dumps(response).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+
+    async def serve(self, socket_path :Optional[str] = None, port :Optional[int] = None):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.serve_connection, path=socket_path)
+            print(f"Serving {list(self.encoders)} on {socket_path}")
+        else:
+            server = await asyncio.start_server(self.serve_connection, host="127.0.0.1", port=port)
+            print(f"Serving {list(self.encoders)} on 127.0.0.1:{port}")
+        async with server:
+            await server.serve_forever()
+        batcher.cancel()
+
+
+def sparse_features(acts :torch.Tensor, top_k :Optional[int] = None, threshold :float = 0):
+    """
+    (n_seqs, seq_len, d_dict) activations as COO lists of their entries above threshold, keeping the
+    top_k largest per position if given.
+    """
+    if top_k is not None:
+        values, features = acts.topk(min(top_k, acts.shape[-1]), dim=-1)
+        keep = values > threshold
+        seq, pos, k = keep.nonzero(as_tuple=True)
+        feature, value = features[seq, pos, k], values[seq, pos, k]
+    else:
+        seq, pos, feature = (acts > threshold).nonzero(as_tuple=True)
+        value = acts[seq, pos, feature]
+    return {"seq": seq.tolist(), "pos": pos.tolist(), "feature": feature.tolist(), "value": value.float().tolist()}
+
+
+def features_to_dense(features :dict, shape):
+    """
+    Back to a dense (n_seqs, seq_len, d_dict) tensor, from one sae's entry of a response.
+    """
+    dense = torch.zeros(shape)
+    dense[features["seq"], features["pos"], features["feature"]] = torch.tensor(features["value"])
+    return dense
+
+
+class Client():
+    """
+    Blocking JSON lines client for scripts and notebooks.
+
+    Args:
+        address (str or int): The Unix socket path, or a localhost port.
+    """
+    def __init__(self, address):
+        if isinstance(address, int):
+            self.sock = socket.create_connection(("127.0.0.1", address))
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.file = self.sock.makefile("rwb")
+
+    def request(self, request :dict):
+        self.file.write(json.dumps(request).encode() + b"\n")
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def encode(self, tokens=None, text=None, saes=None, top_k=None, threshold=0):
+        request = {"tokens": tokens} if tokens is not None else {"text": text}
+        request.update({"saes": saes, "top_k": top_k, "threshold": threshold})
+        return self.request(request)
+
+    def metrics(self):
+        return self.request({"op": "metrics"})
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+def main():
+    from setup_utils import get_model, get_random_model
+    from sae_config import AutoEncoderConfig
+    parser = ArgumentParser()
+    parser.add_argument("--versions", type=int, nargs="+", default=[])
+    parser.add_argument("--socket", type=str, default=None)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--window_ms", type=float, default=5)
+    parser.add_argument("--max_batch_tokens", type=int, default=16384)
+    parser.add_argument("--random_model", action="store_true", help="a random model and encoder, for trying the server out")
+    args = parser.parse_args()
+    if args.random_model:
+        cfg = AutoEncoderConfig(site="resid_pre", act_size=512, layer=1, dict_mult=8, flatten_heads=False)
+        model = get_random_model(cfg)
+        encoders = {"random": AutoEncoder(cfg)}
+    else:
+        encoders = {str(v): AutoEncoder.load(v) for v in args.versions}
+        model_names = {e.cfg.model_name for e in encoders.values()}
+        assert len(model_names) == 1, f"the encoders have to read from the same model, got {model_names}"
+        model = get_model(next(iter(encoders.values())).cfg)
+    for encoder in encoders.values():
+        encoder.eval()
+    server = InferenceServer(model, encoders, window_ms=args.window_ms, max_batch_tokens=args.max_batch_tokens)
+    asyncio.run(server.serve(socket_path=args.socket, port=None if args.socket else args.port))
+
+
+if __name__ == "__main__":
+    main()
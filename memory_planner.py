@@ -0,0 +1,266 @@
+# Estimates how much memory a training run needs, and fits buffer_mult, batch_size and
+# model_batch_size to a budget. post_init_cfg derives the buffer and model batch sizes from
+# batch_size alone, which OOMs small hosts and leaves big ones mostly empty.
+#
+# The estimate covers, per device:
+#   buffer            buffer_size * act_size fp16 activations, plus the copy a shuffle makes
+#   tokens            the token corpus, which stays on the host. A TokenStore's memory map isn't
+#                     counted: its pages come from the file and the os can drop them again
+#   model             the transformer's weights
+#   model_activations what run_with_cache(stop_at_layer=layer + 1) keeps for one model batch
+#   sae_params, sae_grads, adam_state
+#   step_activations  the (batch, d_dict) intermediates of one forward + backward
+# Activation sizes are estimates (every cached hook, autograd's saved tensors), so the planner
+# keeps a headroom fraction of the budget free.
+#
+#   python memory_planner.py --budget_gb 24
+# prints the breakdown for train_sae.cfg and the sizes it would pick.
+import math
+import dataclasses
+from argparse import ArgumentParser
+from typing import Dict, Optional, TYPE_CHECKING
+
+import torch
+
+from setup_utils import DTYPES
+from device_utils import device_type
+
+if TYPE_CHECKING:
+    from transformer_lens import HookedTransformer
+
+GB = 2**30
+
+# (n_params, d_model, n_heads, d_mlp) for when the model isn't loaded yet
+KNOWN_MODELS = {
+    "gelu-1l": (51e6, 512, 8, 2048),
+    "gelu-2l": (56e6, 512, 8, 2048),
+    "gpt2-small": (124e6, 768, 12, 3072),
+    "pythia-70m": (70e6, 512, 8, 2048),
+}
+
+
+@dataclasses.dataclass
+class MemoryPlan:
+    device :str
+    components :Dict[str, float] # bytes
+    host_components :Dict[str, float]
+    device_budget :Optional[float]
+    host_budget :Optional[float]
+    notes :list = dataclasses.field(default_factory=list)
+
+    @property
+    def device_total(self):
+        return sum(self.components.values())
+
+    @property
+    def host_total(self):
+        return sum(self.host_components.values())
+
+    @property
+    def fits(self):
+        device_ok = self.device_budget is None or self.device_total <= self.device_budget
+        host_ok = self.host_budget is None or self.host_total <= self.host_budget
+        return device_ok and host_ok
+
+    def print(self):
+        def section(name, components, total, budget):
+            print(f"{name}:")
+            for k, v in components.items():
+                print(f"  {k:<20} {v / GB:8.3f} GB")
+            budget_str = "no budget" if budget is None else f"budget {budget / GB:.3f} GB"
+            print(f"  {'total':<20} {total / GB:8.3f} GB  ({budget_str})")
+        on_host = device_type(self.device) == "cpu"
+        section(f"Memory on {self.device}" + (" (the host)" if on_host else ""), self.components, self.device_total, self.device_budget)
+        if not on_host:
+            section("Host memory", self.host_components, self.host_total, self.host_budget)
+        for note in self.notes:
+            print("  note:", note)
+        if not self.fits:
+            print("  WARNING: this run is not expected to fit in memory")
+
+
+def available_memory(device):
+    """
+    Free memory on device in bytes, or None if it can't be read.
+    """
+    if device_type(device) == "cuda":
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def model_shape(cfg, model :Optional["HookedTransformer"] = None):
+    """
+    (n_param_bytes, d_model, n_heads, d_mlp, n_layers_run) from the model, or KNOWN_MODELS, or a guess from act_size.
+    """
+    if model is not None:
+        n_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+        c = model.cfg
+        return n_bytes, c.d_model, c.n_heads, c.d_mlp or 4 * c.d_model, cfg.layer + 1
+    n_params, d_model, n_heads, d_mlp = KNOWN_MODELS.get(cfg.model_name, (None, cfg.act_size, 8, 4 * cfg.act_size))
+    n_bytes = None if n_params is None else n_params * DTYPES[cfg.enc_dtype].itemsize
+    return n_bytes, d_model, n_heads, d_mlp, cfg.layer + 1
+
+
+def estimate(cfg, model :Optional["HookedTransformer"] = None, corpus :Optional[torch.Tensor] = None,
+             device_budget :Optional[float] = None, host_budget :Optional[float] = None, corpus_mapped :bool = False):
+    """
+    The memory breakdown for cfg. Without the corpus tensor, it's taken to be cfg.num_tokens int64 tokens.
+    corpus_mapped leaves it out, for load_data's memory mapped TokenStore rows.
+    """
+    enc_bytes = DTYPES[cfg.enc_dtype].itemsize
+    model_bytes, d_model, n_heads, d_mlp, n_layers = model_shape(cfg, model)
+    # fp16 on cuda, bf16 under cpu autocast, the weights' dtype otherwise. 2 bytes is close enough for all but fp32 on cpu
+    act_bytes = 2 if device_type(cfg.device) == "cuda" else enc_bytes
+    d_dict = cfg.dict_size
+    batch = cfg.micro_batch_size or cfg.batch_size
+
+    buffer = cfg.buffer_size * cfg.act_size * 2
+    # a full shuffle copies the whole buffer. Subshuffling works a slice at a time
+    shuffle = buffer if cfg.subshuffle is None else 2 * buffer / cfg.subshuffle
+    if cfg.buffer_reuse > 1 or cfg.buffer_max_age is not None:
+        # reuse mode serves through an int64 permutation and keeps int32 use and age counters instead
+        shuffle = cfg.buffer_size * (8 + 4 + 4)
+    tokens_per_model_batch = cfg.model_batch_size * cfg.seq_len
+    # every hook up to the layer is cached: the residual stream hooks, q k v z and the attention
+    # result per head, the attention scores and pattern, and mlp pre / post
+    per_token_per_layer = (8 * d_model + 4 * d_model + n_heads * d_model + 2 * n_heads * cfg.seq_len + 2 * d_mlp)
+    model_activations = tokens_per_model_batch * n_layers * per_token_per_layer * act_bytes
+    sae_params = (2 * cfg.act_size * d_dict + d_dict + cfg.act_size) * enc_bytes
+    # pre-activations, acts, and their float / abs / (acts > 0) copies for the losses, saved for backward
+    step_activations = batch * d_dict * 4 * 5 + batch * cfg.act_size * 4 * 6
+
+    components = {
+        "buffer": buffer,
+        "buffer_shuffle": shuffle,
+        "model": model_bytes or 0,
+        "model_activations": model_activations,
+        "sae_params": sae_params,
+        "sae_grads": sae_params,
+        "adam_state": 2 * sae_params,
+        "step_activations": step_activations,
+    }
+    notes = []
+    if model_bytes is None:
+        notes.append(f"unknown model {cfg.model_name}, its weights aren't counted")
+    corpus_bytes = cfg.num_tokens * 8 if corpus is None else corpus.numel() * corpus.element_size()
+    host_components = {}
+    if corpus_mapped:
+        notes.append(f"the token corpus ({corpus_bytes / GB:.2f}GB) is memory mapped from disk, so it isn't counted")
+    elif device_type(cfg.device) == "cpu":
+        components["tokens"] = corpus_bytes
+    else:
+        host_components["tokens"] = corpus_bytes
+    refresh_seqs = int(cfg.buffer_batches * cfg.buffer_refresh_ratio)
+    written = -(-refresh_seqs // cfg.model_batch_size) * cfg.model_batch_size * cfg.seq_len
+    if written > cfg.buffer_size:
+        notes.append(f"a refresh writes {written} activations into a buffer of {cfg.buffer_size}, lower model_batch_size or raise buffer_mult")
+    return MemoryPlan(cfg.device, components, host_components, device_budget, host_budget, notes)
+
+
+def replace_cfg(cfg, **changes):
+    """
+    dataclasses.replace re-runs post_init_cfg, which resets model_batch_size from batch_size.
+    """
+    model_batch_size = changes.pop("model_batch_size", None)
+    new_cfg = dataclasses.replace(cfg, **changes)
+    if model_batch_size is not None:
+        new_cfg.model_batch_size = model_batch_size
+    return new_cfg
+
+
+def plan(cfg, model :Optional["HookedTransformer"] = None, corpus :Optional[torch.Tensor] = None,
+         budget_gb :Optional[float] = None, host_budget_gb :Optional[float] = None, headroom :float = 0.1,
+         max_buffer_mult :Optional[int] = None, corpus_mapped :bool = False):
+    """
+    Picks sizes that fit the budget, keeping the optimisation batch the same:
+      1. model_batch_size is halved until a model forward fits in a quarter of the budget.
+      2. if a training step doesn't fit, micro_batch_size is set to the largest power of two
+         dividing batch_size that does (see train_sae.train's micro batching), but not below
+         the point where the step activations are a 16th of the budget.
+      3. buffer_mult takes whatever is left, capped at max_buffer_mult.
+    The budgets default to the free memory on cfg.device and on the host.
+
+    Returns:
+        (cfg, plan): the adjusted config and its MemoryPlan.
+    """
+    def budget(gb, device):
+        free = available_memory(device) if gb is None else gb * GB
+        return None if free is None else free * (1 - headroom)
+    device_budget = budget(budget_gb, cfg.device)
+    host_budget = device_budget if device_type(cfg.device) == "cpu" else budget(host_budget_gb, "cpu")
+    if device_budget is None:
+        print("Couldn't read the free memory, so the config is left as it is")
+        return cfg, estimate(cfg, model, corpus, corpus_mapped=corpus_mapped)
+
+    def est(c):
+        return estimate(c, model, corpus, device_budget, host_budget, corpus_mapped).components
+
+    # 1. model batch
+    model_batch_size = cfg.model_batch_size
+    while model_batch_size > 1 and est(replace_cfg(cfg, model_batch_size=model_batch_size))["model_activations"] > device_budget / 4:
+        model_batch_size //= 2
+    cfg = replace_cfg(cfg, model_batch_size=model_batch_size)
+
+    # 2. the step, with everything but the buffer
+    def fixed(c):
+        parts = est(c)
+        return sum(v for k, v in parts.items() if k not in ["buffer", "buffer_shuffle"])
+    micro = cfg.micro_batch_size or cfg.batch_size
+    while micro > 1 and micro % 2 == 0:
+        parts = est(replace_cfg(cfg, micro_batch_size=micro, model_batch_size=model_batch_size))
+        # smaller micro batches stop helping once the step activations are a small part of the budget
+        if fixed(replace_cfg(cfg, micro_batch_size=micro, model_batch_size=model_batch_size)) <= device_budget or parts["step_activations"] < device_budget / 16:
+            break
+        micro //= 2
+    cfg = replace_cfg(cfg, micro_batch_size=None if micro == cfg.batch_size else micro, model_batch_size=model_batch_size)
+
+    # 3. the buffer gets the rest
+    per_mult = sum(est(replace_cfg(cfg, buffer_mult=1, model_batch_size=model_batch_size))[k] for k in ["buffer", "buffer_shuffle"])
+    buffer_mult = int((device_budget - fixed(cfg)) // per_mult)
+    if max_buffer_mult is not None:
+        buffer_mult = min(buffer_mult, max_buffer_mult)
+    # refreshes write whole model batches, so buffer_batches = batch_size * buffer_mult // seq_len has to
+    # be a multiple of model_batch_size, and subshuffle has to divide buffer_mult
+    seqs_per_step = cfg.model_batch_size * cfg.seq_len
+    step = seqs_per_step // math.gcd(cfg.batch_size, seqs_per_step)
+    if cfg.subshuffle is not None:
+        step = math.lcm(step, cfg.subshuffle)
+    buffer_mult -= buffer_mult % step
+    # a refresh has to fit into the buffer
+    min_mult = -(-cfg.model_batch_size * cfg.seq_len // int(cfg.batch_size * cfg.buffer_refresh_ratio))
+    min_mult = -(-min_mult // step) * step
+    if buffer_mult < min_mult:
+        print(f"Only room for buffer_mult {buffer_mult}, using the smallest that works, {min_mult}")
+        buffer_mult = min_mult
+    cfg = replace_cfg(cfg, buffer_mult=buffer_mult, model_batch_size=model_batch_size)
+    result = estimate(cfg, model, corpus, device_budget, host_budget, corpus_mapped)
+    result.notes.append(f"picked buffer_mult {cfg.buffer_mult}, model_batch_size {cfg.model_batch_size}, micro_batch_size {cfg.micro_batch_size}")
+    return cfg, result
+
+
+def main():
+    import train_sae
+    parser = ArgumentParser()
+    parser.add_argument("--budget_gb", type=float, default=None, help="defaults to the free memory on the device")
+    parser.add_argument("--host_budget_gb", type=float, default=None)
+    parser.add_argument("--headroom", type=float, default=0.1)
+    args = parser.parse_args()
+    cfg = train_sae.cfg
+    print("As configured:")
+    estimate(cfg).print()
+    print()
+    print("Planned:")
+    new_cfg, result = plan(cfg, budget_gb=args.budget_gb, host_budget_gb=args.host_budget_gb, headroom=args.headroom)
+    result.print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+# Torch free inference for exported autoencoders, for feature extraction on activations that are
+# already computed. Importing this module only imports numpy; export and check_parity import torch
+# when they're called.
+#
+# File format (one file, memory mapped on load):
+#   8 bytes   magic b"SAENPY01"
+#   8 bytes   little endian uint64 length of the json header
+#   header    {"arrays": {name: {"dtype", "shape", "offset"}}, "act_size", "d_dict", "nonlinearity",
+#              "scaling_factor", "data_rescale", ...}
+#   arrays    W_enc (act_size, d_dict), b_enc, W_dec (d_dict, act_size), b_dec, each 64 byte aligned
+#
+# encode runs as a grid of (row block, feature block) tasks on a thread pool. numpy's matmul drops the
+# GIL, so the blocks run in parallel. Bias, nonlinearity and top-k are applied per block, so with top_k
+# the full (n, d_dict) activations never exist, and fp16 weights are upcast a block at a time.
+#
+#   python numpy_runtime.py export --version 171 --out 171.saenpy
+#   python numpy_runtime.py check --version 171
+import os
+import json
+import time
+from pathlib import Path
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+MAGIC = b"SAENPY01"
+ALIGN = 64
+ARRAYS = ["W_enc", "b_enc", "W_dec", "b_dec"]
+# forward passes of the nonlinearities in novel_nonlinearities. undying_relu only differs from relu in its gradient
+NONLINEARITIES = {
+    "relu": lambda x: np.maximum(x, 0, out=x),
+    "undying_relu": lambda x: np.maximum(x, 0, out=x),
+}
+
+
+def export(ae, path):
+    """
+    Writes an AutoEncoder's weights and preprocessing constants to path.
+    """
+    import torch
+    cfg = ae.cfg
+    if cfg.nonlinearity[0] not in NONLINEARITIES:
+        raise NotImplementedError(f"no numpy version of the {cfg.nonlinearity[0]} nonlinearity")
+    arrays = {name: getattr(ae, name).detach().cpu().numpy() for name in ARRAYS}
+    scaling_factor = ae.scaling_factor.item() if isinstance(ae.scaling_factor, torch.Tensor) else float(ae.scaling_factor)
+    header = {"act_size": cfg.act_size, "d_dict": cfg.dict_size, "nonlinearity": cfg.nonlinearity[0],
+              "scaling_factor": scaling_factor, "data_rescale": cfg.data_rescale, "name": cfg.name, "arrays": {}}
+    offset = 0
+    for name, a in arrays.items():
+        header["arrays"][name] = {"dtype": a.dtype.str, "shape": list(a.shape), "offset": offset}
+        offset += -(-a.nbytes // ALIGN) * ALIGN
+    header_bytes = json.dumps(header).encode()
+    # the arrays start aligned too
+    header_bytes += b" " * (-(len(MAGIC) + 8 + len(header_bytes)) % ALIGN)
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, a in arrays.items():
+            f.write(np.ascontiguousarray(a).tobytes())
+            f.write(b"\0" * (-a.nbytes % ALIGN))
+    return header
+
+
+class NumpyAutoEncoder():
+    """
+    Args:
+        path (str): An exported autoencoder.
+        threads (int, optional): Defaults to os.cpu_count().
+        row_block (int, optional): Rows of x per task. Defaults to 1024.
+        feature_block (int, optional): Features per task. Defaults to 4096.
+    """
+    def __init__(self, path, threads :Optional[int] = None, row_block :int = 1024, feature_block :int = 4096):
+        with open(path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f"{path} isn't an exported autoencoder")
+            header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            self.header = json.loads(f.read(header_len))
+        data_start = len(MAGIC) + 8 + header_len
+        self.mmap = np.memmap(path, dtype=np.uint8, mode="r")
+        for name, a in self.header["arrays"].items():
+            dtype = np.dtype(a["dtype"])
+            count = int(np.prod(a["shape"]))
+            start = data_start + a["offset"]
+            setattr(self, name, self.mmap[start:start + count * dtype.itemsize].view(dtype).reshape(a["shape"]))
+        self.act_size = self.header["act_size"]
+        self.d_dict = self.header["d_dict"]
+        self.nonlinearity = NONLINEARITIES[self.header["nonlinearity"]]
+        self.scaling_factor = self.header["scaling_factor"]
+        self.data_rescale = self.header["data_rescale"]
+        self.row_block = row_block
+        self.feature_block = feature_block
+        self.pool = ThreadPoolExecutor(threads or os.cpu_count())
+        # small vectors are used by every block, so keep them as float32 up front
+        self.b_enc32 = self.b_enc.astype(np.float32)
+        self.b_dec32 = self.b_dec.astype(np.float32)
+
+    def preprocess(self, x :np.ndarray):
+        x = np.asarray(x, dtype=np.float32)
+        return x * (self.data_rescale / self.scaling_factor) - self.b_dec32
+
+    def encode_block(self, x_cent, rows, cols, top_k):
+        W = self.W_enc[:, cols]
+        if W.dtype != np.float32:
+            W = W.astype(np.float32)
+        acts = x_cent[rows] @ W
+        acts += self.b_enc32[cols]
+        acts = self.nonlinearity(acts)
+        if top_k is None:
+            return acts
+        k = min(top_k, acts.shape[1])
+        idx = np.argpartition(acts, -k, axis=1)[:, -k:]
+        return np.take_along_axis(acts, idx, axis=1), idx + cols.start
+
+    def blocks(self, n):
+        return [(slice(r, min(r + self.row_block, n)), slice(c, min(c + self.feature_block, self.d_dict)))
+                for r in range(0, n, self.row_block) for c in range(0, self.d_dict, self.feature_block)]
+
+    def encode(self, x :np.ndarray, top_k :Optional[int] = None):
+        """
+        Dictionary activations for x (n, act_size). Without top_k the dense (n, d_dict) activations,
+        with it (values, indices), both (n, top_k) and sorted by value, largest first.
+        """
+        x_cent = self.preprocess(x)
+        n = x_cent.shape[0]
+        blocks = self.blocks(n)
+        results = self.pool.map(lambda b: self.encode_block(x_cent, b[0], b[1], top_k), blocks)
+        if top_k is None:
+            out = np.empty((n, self.d_dict), dtype=np.float32)
+            for (rows, cols), acts in zip(blocks, results):
+                out[rows, cols] = acts
+            return out
+        # merge the per block candidates of each row block
+        by_rows = {}
+        for (rows, _), (values, idx) in zip(blocks, results):
+            by_rows.setdefault(rows.start, []).append((values, idx))
+        k = min(top_k, self.d_dict)
+        values = np.empty((n, k), dtype=np.float32)
+        indices = np.empty((n, k), dtype=np.int64)
+        for start, parts in by_rows.items():
+            v = np.concatenate([p[0] for p in parts], axis=1)
+            i = np.concatenate([p[1] for p in parts], axis=1)
+            order = np.argsort(-v, axis=1, kind="stable")[:, :k]
+            values[start:start + len(v)] = np.take_along_axis(v, order, axis=1)
+            indices[start:start + len(v)] = np.take_along_axis(i, order, axis=1)
+        return values, indices
+
+    def encode_sparse(self, x :np.ndarray, top_k :Optional[int] = None, threshold :float = 0):
+        """
+        The activations above threshold as COO arrays (rows, features, values).
+        """
+        if top_k is None:
+            acts = self.encode(x)
+            rows, features = np.nonzero(acts > threshold)
+            return rows, features, acts[rows, features]
+        values, indices = self.encode(x, top_k)
+        rows, k = np.nonzero(values > threshold)
+        return rows, indices[rows, k], values[rows, k]
+
+    def decode_block(self, acts :np.ndarray):
+        # only the rows of W_dec for features that fire in the block are read
+        active = np.flatnonzero((acts != 0).any(0))
+        W = self.W_dec[active]
+        if W.dtype != np.float32:
+            W = W.astype(np.float32)
+        return acts[:, active] @ W
+
+    def finish_decode(self, blocks, n):
+        out = np.concatenate(list(blocks)) if n else np.zeros((0, self.act_size), np.float32)
+        out += self.b_dec32
+        return out * (self.scaling_factor / self.data_rescale)
+
+    def decode(self, acts :np.ndarray):
+        """
+        Reconstruction from dense (n, d_dict) activations, in the input's scale.
+        """
+        acts = np.asarray(acts, dtype=np.float32)
+        n = acts.shape[0]
+        row_blocks = [slice(r, min(r + self.row_block, n)) for r in range(0, n, self.row_block)]
+        return self.finish_decode(self.pool.map(lambda rows: self.decode_block(acts[rows]), row_blocks), n)
+
+    def decode_sparse(self, n :int, rows :np.ndarray, features :np.ndarray, values :np.ndarray):
+        """
+        Reconstruction of n rows from COO activations, e.g. the output of encode_sparse.
+        Each row block is scattered into a dense block of its own, so memory stays at a block's worth.
+        """
+        order = np.argsort(rows, kind="stable")
+        rows, features, values = rows[order], features[order], values[order]
+        starts = list(range(0, n, self.row_block))
+        bounds = np.searchsorted(rows, starts + [n])
+        def block(j):
+            lo, hi = bounds[j], bounds[j + 1]
+            dense = np.zeros((min(self.row_block, n - starts[j]), self.d_dict), dtype=np.float32)
+            dense[rows[lo:hi] - starts[j], features[lo:hi]] = values[lo:hi]
+            return self.decode_block(dense)
+        return self.finish_decode(self.pool.map(block, range(len(starts))), n)
+
+    def __call__(self, x :np.ndarray):
+        return self.decode(self.encode(x))
+
+
+def check_parity(ae, path, x, top_k :int = 32, **kwargs):
+    """
+    Compares the exported runtime at path against the torch AutoEncoder ae on activations x (torch, (n, act_size)).
+    """
+    import torch
+    with torch.no_grad():
+        acts = ae.encode(x.to(ae.W_enc.device, ae.W_enc.dtype)).float().cpu()
+        recons = ae(x.to(ae.W_enc.device, ae.W_enc.dtype)).float().cpu()
+    t0 = time.perf_counter()
+    np_ae = NumpyAutoEncoder(path, **kwargs)
+    t_load = time.perf_counter() - t0
+    x_np = x.float().cpu().numpy()
+    t0 = time.perf_counter()
+    np_acts = np_ae.encode(x_np)
+    t_encode = time.perf_counter() - t0
+    np_recons = np_ae.decode(np_acts)
+    values, indices = np_ae.encode(x_np, top_k=top_k)
+    ref_values, ref_indices = acts.topk(top_k, dim=-1)
+    rows, features, sparse_values = np_ae.encode_sparse(x_np)
+    # ties can swap the order of equal values, so compare the sets, and only of the nonzero entries since zeros tie with each other
+    same_topk = np.mean([len(set(a[va > 0]) & set(b[vb > 0])) / (vb > 0).sum()
+                         for a, va, b, vb in zip(indices, values, ref_indices.numpy(), ref_values.numpy()) if (vb > 0).any()])
+    scale = acts.abs().max().item() + 1e-12
+    return {
+        "acts_max_rel_err": np.abs(np_acts - acts.numpy()).max() / scale,
+        "recons_max_rel_err": np.abs(np_recons - recons.numpy()).max() / (recons.abs().max().item() + 1e-12),
+        "sparse_recons_max_rel_err": np.abs(np_ae.decode_sparse(len(x_np), rows, features, sparse_values) - recons.numpy()).max() / (recons.abs().max().item() + 1e-12),
+        "topk_values_max_rel_err": np.abs(values - ref_values.numpy()).max() / scale,
+        "topk_index_overlap": same_topk,
+        "load_ms": 1000 * t_load,
+        "encode_ms": 1000 * t_encode,
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("command", choices=["export", "check"])
+    parser.add_argument("--version", type=int, required=True)
+    parser.add_argument("--out", type=str, default=None, help="defaults to SAVE_DIR/<version>.saenpy")
+    parser.add_argument("--n", type=int, default=4096, help="rows of random activations to check parity on")
+    args = parser.parse_args()
+    import torch
+    from sae import AutoEncoder
+    from setup_utils import SAVE_DIR
+    ae = AutoEncoder.load(args.version)
+    out = Path(args.out) if args.out is not None else SAVE_DIR / f"{args.version}.saenpy"
+    if args.command == "export" or not out.exists():
+        export(ae, out)
+        print("exported to", out)
+    if args.command == "check":
+        x = torch.randn(args.n, ae.cfg.act_size) * 10
+        print(json.dumps(check_parity(ae, out, x), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import resource
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import torch
+
+
+_NULL_PHASE = nullcontext()
+
+
+class StepProfiler():
+    """
+    Per-phase wall time, tokens/sec and peak memory for the training loop.
+
+    Wrap each part of a step in `with profiler.phase("name"):` and call `profiler.step(n_tokens)`
+    once at the end of the step. Phases can nest, and each phase's time excludes the time spent
+    in the phases nested inside it (e.g. "refresh" is not double counted in "data_fetch").
+    When disabled, phase() hands back a shared nullcontext and step() returns straight away,
+    so leaving the calls in the loop costs next to nothing.
+
+    Optionally records a torch.profiler trace for the steps in [trace_steps[0], trace_steps[1]).
+    Call close() when training ends, so a trace still recording then is saved too.
+    """
+    def __init__(self, enabled=False, device="cpu", trace_steps :Optional[Tuple[int, int]] = None, trace_dir=None):
+        self.enabled = enabled
+        self.cuda = torch.device(device).type == "cuda"
+        self.trace_steps = tuple(trace_steps) if trace_steps is not None else None
+        self.trace_dir = Path(trace_dir) if trace_dir is not None else Path(".")
+        self.torch_profiler = None
+        self.step_num = 0
+        self.reset()
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        from setup_utils import SAVE_DIR
+        return cls(enabled=cfg.profile, device=cfg.device, trace_steps=cfg.profile_trace_steps, trace_dir=SAVE_DIR / "traces")
+
+    def reset(self):
+        self.phase_times :Dict[str, float] = {}
+        self.phase_calls :Dict[str, int] = {}
+        self.tokens = 0
+        self.steps = 0
+        self.t_start = time.perf_counter()
+        self._stack = []
+        if self.cuda and self.enabled:
+            torch.cuda.reset_peak_memory_stats()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def step(self, n_tokens=0):
+        if not self.enabled:
+            return
+        self.steps += 1
+        self.tokens += n_tokens
+        self.step_num += 1
+        if self.trace_steps is not None:
+            start, stop = self.trace_steps
+            if self.step_num == start:
+                self._start_trace()
+            elif self.step_num == stop and self.torch_profiler is not None:
+                self._stop_trace()
+
+    def _start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self.torch_profiler.__enter__()
+
+    def _stop_trace(self):
+        self.torch_profiler.__exit__(None, None, None)
+        self.trace_dir.mkdir(parents=True, exist_ok=True)
+        # step_num is trace_steps[1] unless training ended inside the traced steps
+        path = self.trace_dir / f"trace_steps_{self.trace_steps[0]}-{self.step_num}.json"
+        self.torch_profiler.export_chrome_trace(str(path))
+        print("Saved profiler trace to", path)
+        self.torch_profiler = None
+
+    def close(self):
+        if self.torch_profiler is not None:
+            self._stop_trace()
+
+    def peak_memory(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated()
+        # ru_maxrss is in kB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def summary(self):
+        """
+        Returns the stats accumulated since the last reset, keyed like "time/forward" so they can
+        go straight to wandb.log.
+        """
+        elapsed = time.perf_counter() - self.t_start
+        d = {f"time/{name}": t for name, t in self.phase_times.items()}
+        d.update({f"time_per_step/{name}": t / max(self.steps, 1) for name, t in self.phase_times.items()})
+        d["time/unaccounted"] = elapsed - sum(self.phase_times.values())
+        d["tokens_per_sec"] = self.tokens / elapsed if elapsed > 0 else 0.
+        d["peak_memory_gb"] = self.peak_memory() / 2**30
+        return d
+
+    def print_summary(self):
+        s = self.summary()
+        total = sum(t for k, t in s.items() if k.startswith("time/"))
+        for k, t in sorted(((k, t) for k, t in s.items() if k.startswith("time/")), key=lambda kv: -kv[1]):
+            print(f"{k[5:]:>16}: {t:8.3f}s {t / total if total > 0 else 0:6.1%}")
+        print(f"{s['tokens_per_sec']:.0f} tokens/s, peak memory {s['peak_memory_gb']:.2f}GB")
+
+
+class _Phase():
+    def __init__(self, profiler :StepProfiler, name :str):
+        self.profiler = profiler
+        self.name = name
+        self.record_function = None
+
+    def __enter__(self):
+        p = self.profiler
+        p._sync()
+        if p.torch_profiler is not None:
+            self.record_function = torch.profiler.record_function(self.name)
+            self.record_function.__enter__()
+        self.child_time = 0.
+        p._stack.append(self)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        p = self.profiler
+        p._sync()
+        elapsed = time.perf_counter() - self.t0
+        p._stack.pop()
+        if p._stack:
+            p._stack[-1].child_time += elapsed
+        p.phase_times[self.name] = p.phase_times.get(self.name, 0.) + elapsed - self.child_time
+        p.phase_calls[self.name] = p.phase_calls.get(self.name, 0) + 1
+        if self.record_function is not None:
+            self.record_function.__exit__(*exc)
+        return False
+
+
+NULL_PROFILER = StepProfiler(enabled=False)
@@ -0,0 +1,219 @@
+# Post training int8 quantisation of an AutoEncoder for inference on the cpu.
+#
+# W_enc and W_dec are quantised symmetrically, each with one scale per feature: per column of W_enc
+# and per row of W_dec. That keeps a feature with small weights from losing all its precision to a
+# feature with big ones. The biases stay in fp32.
+#   encode  the encoder runs as quantized::linear_dynamic: x is quantised to uint8 on the fly and
+#           multiplied by the int8 weights by fbgemm / onednn. Off the cpu it falls back to
+#           dequantised weights.
+#   decode  only the rows of W_dec for features that fire are dequantised and multiplied, so the
+#           cost follows L0 rather than d_dict.
+# The weights take a quarter of the fp32 memory.
+#
+#   python quantize.py --version 171
+# quantises a saved version, saves it next to the original and prints the accuracy report against
+# fp32 on held out tokens: recons score, L0 drift and how many activations flip on / off.
+import time
+import json
+import warnings
+from functools import partial
+from argparse import ArgumentParser
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from sae import AutoEncoder
+from sae_config import AutoEncoderConfig
+from setup_utils import SAVE_DIR
+from device_utils import device_type
+from calculations_on_sae import replacement_hook, zero_ablate_hook
+
+
+def quantize_per_feature(W :torch.Tensor, dim :int):
+    """
+    Symmetric int8 quantisation with one scale per slice along dim. Returns (int8 weights, scales).
+    """
+    W = W.detach().float()
+    scale = W.abs().amax(dim=1 - dim, keepdim=True).clamp(min=1e-12) / 127
+    q = (W / scale).round().clamp(-127, 127).to(torch.int8)
+    return q, scale.squeeze(1 - dim)
+
+
+# encode applies relu, which only matches these
+QUANTIZED_NONLINEARITIES = ["relu", "undying_relu"]
+
+
+class QuantizedAutoEncoder(nn.Module):
+    """
+    Inference only int8 version of an AutoEncoder. Build with from_autoencoder.
+    """
+    def __init__(self, cfg :AutoEncoderConfig, W_enc_q, enc_scale, b_enc, W_dec_q, dec_scale, b_dec, scaling_factor :float):
+        super().__init__()
+        if cfg.nonlinearity[0] not in QUANTIZED_NONLINEARITIES:
+            raise NotImplementedError(f"no quantized version of the {cfg.nonlinearity[0]} nonlinearity")
+        self.cfg = cfg
+        self.d_dict = cfg.dict_size
+        # W_enc is stored transposed, (d_dict, act_size), like nn.Linear's weight
+        self.register_buffer("W_enc_q", W_enc_q)
+        self.register_buffer("enc_scale", enc_scale)
+        self.register_buffer("b_enc", b_enc.float())
+        self.register_buffer("W_dec_q", W_dec_q)
+        self.register_buffer("dec_scale", dec_scale)
+        self.register_buffer("b_dec", b_dec.float())
+        self.scaling_factor = scaling_factor
+        self.packed = None
+
+    @classmethod
+    @torch.no_grad()
+    def from_autoencoder(cls, ae :AutoEncoder):
+        W_enc_q, enc_scale = quantize_per_feature(ae.W_enc.T, dim=0)
+        W_dec_q, dec_scale = quantize_per_feature(ae.W_dec, dim=0)
+        scaling_factor = ae.scaling_factor.item() if isinstance(ae.scaling_factor, torch.Tensor) else float(ae.scaling_factor)
+        return cls(ae.cfg, W_enc_q, enc_scale, ae.b_enc.detach(), W_dec_q, dec_scale, ae.b_dec.detach(), scaling_factor)
+
+    def use_quantized_kernels(self):
+        return device_type(self.W_enc_q.device) == "cpu" and torch.backends.quantized.engine != "none"
+
+    def pack(self):
+        """
+        Packs the encoder for quantized::linear_dynamic. torch has deprecated its quantized tensors, so
+        if they're gone this leaves packed False and encode uses the dequantised fallback.
+        """
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)
+                qweight = torch.quantize_per_channel(self.W_enc_q.float() * self.enc_scale[:, None], self.enc_scale.double(),
+                                                     torch.zeros(self.d_dict, dtype=torch.long), axis=0, dtype=torch.qint8)
+                self.packed = torch.ops.quantized.linear_prepack(qweight, self.b_enc)
+        except (RuntimeError, AttributeError) as e:
+            print("No quantized kernels, encoding with dequantised weights:", e)
+            self.packed = False
+
+    def weight_bytes(self):
+        return sum(b.numel() * b.element_size() for b in self.buffers())
+
+    @torch.no_grad()
+    def encode(self, x :torch.Tensor):
+        x = x * self.cfg.data_rescale / self.scaling_factor
+        x_cent = (x - self.b_dec).float()
+        shape = x_cent.shape
+        x_cent = x_cent.reshape(-1, shape[-1])
+        if self.use_quantized_kernels() and self.packed is None:
+            self.pack()
+        if self.use_quantized_kernels() and self.packed is not False:
+            # fbgemm needs the reduced activation range to stay clear of int16 overflow in its accumulation
+            pre = torch.ops.quantized.linear_dynamic(x_cent.contiguous(), self.packed, torch.backends.quantized.engine in ["fbgemm", "x86"])
+        else:
+            pre = x_cent @ (self.W_enc_q.float() * self.enc_scale[:, None]).T + self.b_enc
+        return F.relu(pre).reshape(*shape[:-1], self.d_dict)
+
+    @torch.no_grad()
+    def decode(self, acts :torch.Tensor):
+        shape = acts.shape
+        acts = acts.reshape(-1, self.d_dict)
+        active = (acts != 0).any(0).nonzero().squeeze(1)
+        out = (acts[:, active] * self.dec_scale[active]) @ self.W_dec_q[active].float() + self.b_dec
+        out = out * self.scaling_factor / self.cfg.data_rescale
+        return out.reshape(*shape[:-1], -1)
+
+    def forward(self, x :torch.Tensor):
+        return self.decode(self.encode(x)).to(x.dtype)
+
+    def save(self, path):
+        torch.save({"state_dict": self.state_dict(), "scaling_factor": self.scaling_factor, "cfg": self.cfg.__dict__}, path)
+
+    @classmethod
+    def load(cls, path, device="cpu"):
+        saved = torch.load(path, map_location=device, weights_only=True)
+        cfg = AutoEncoderConfig(**{k: v for k, v in saved["cfg"].items() if k in AutoEncoderConfig.__dataclass_fields__})
+        s = saved["state_dict"]
+        return cls(cfg, s["W_enc_q"], s["enc_scale"], s["b_enc"], s["W_dec_q"], s["dec_scale"], s["b_dec"], saved["scaling_factor"])
+
+
+def quantized_path(version, save_dir=None):
+    return (SAVE_DIR if save_dir is None else save_dir) / f"{version}_int8.qpt"
+
+
+@torch.no_grad()
+def accuracy_report(ae :AutoEncoder, qae :QuantizedAutoEncoder, model, tokens :torch.Tensor, batch_seqs :int = 32):
+    """
+    The int8 encoder against fp32 on tokens: recons scores, L0 of each, the mean |L0 difference| per
+    token, the fraction of activations that turn on or off, reconstruction mse, and encode time per token.
+    """
+    cfg = ae.cfg
+    totals = {"loss": 0, "fp32_recons_loss": 0, "int8_recons_loss": 0, "zero_abl_loss": 0, "fp32_l0": 0, "int8_l0": 0,
+              "l0_abs_drift": 0, "flipped": 0, "fp32_mse": 0, "int8_mse": 0, "fp32_encode_s": 0, "int8_encode_s": 0}
+    n_batches, n_tokens = 0, 0
+    for start in range(0, len(tokens), batch_seqs):
+        batch = tokens[start:start + batch_seqs].to(cfg.device)
+        totals["loss"] += model(batch, return_type="loss").item()
+        totals["fp32_recons_loss"] += model.run_with_hooks(batch, return_type="loss", fwd_hooks=[(cfg.act_name, partial(replacement_hook, encoder=ae))]).item()
+        totals["int8_recons_loss"] += model.run_with_hooks(batch, return_type="loss", fwd_hooks=[(cfg.act_name, partial(replacement_hook, encoder=qae))]).item()
+        totals["zero_abl_loss"] += model.run_with_hooks(batch, return_type="loss", fwd_hooks=[(cfg.act_name, zero_ablate_hook)]).item()
+        _, cache = model.run_with_cache(batch, stop_at_layer=cfg.layer + 1, names_filter=cfg.act_name)
+        x = cache[cfg.act_name].reshape(-1, cfg.act_size).float()
+        t0 = time.perf_counter()
+        acts = ae.encode(x.to(ae.W_enc.dtype)).float()
+        t1 = time.perf_counter()
+        q_acts = qae.encode(x)
+        t2 = time.perf_counter()
+        on, q_on = acts > 0, q_acts > 0
+        totals["fp32_l0"] += on.sum().item()
+        totals["int8_l0"] += q_on.sum().item()
+        totals["l0_abs_drift"] += (on.sum(-1) - q_on.sum(-1)).abs().sum().item()
+        totals["flipped"] += (on != q_on).sum().item()
+        totals["fp32_mse"] += (ae(x.to(ae.W_enc.dtype)).float() - x).pow(2).mean(-1).sum().item()
+        totals["int8_mse"] += (qae(x) - x).pow(2).mean(-1).sum().item()
+        totals["fp32_encode_s"] += t1 - t0
+        totals["int8_encode_s"] += t2 - t1
+        n_batches += 1
+        n_tokens += x.shape[0]
+    losses = {k: totals[k] / n_batches for k in ["loss", "fp32_recons_loss", "int8_recons_loss", "zero_abl_loss"]}
+    def score(recons_loss):
+        return (losses["zero_abl_loss"] - recons_loss) / (losses["zero_abl_loss"] - losses["loss"])
+    fp32_bytes = sum(p.numel() * p.element_size() for p in ae.parameters())
+    return {
+        **losses,
+        "fp32_recons_score": score(losses["fp32_recons_loss"]),
+        "int8_recons_score": score(losses["int8_recons_loss"]),
+        "fp32_l0": totals["fp32_l0"] / n_tokens,
+        "int8_l0": totals["int8_l0"] / n_tokens,
+        "l0_abs_drift": totals["l0_abs_drift"] / n_tokens,
+        "flipped_per_token": totals["flipped"] / n_tokens,
+        "fp32_mse": totals["fp32_mse"] / n_tokens,
+        "int8_mse": totals["int8_mse"] / n_tokens,
+        "fp32_encode_us_per_token": 1e6 * totals["fp32_encode_s"] / n_tokens,
+        "int8_encode_us_per_token": 1e6 * totals["int8_encode_s"] / n_tokens,
+        "fp32_weight_mb": fp32_bytes / 2**20,
+        "int8_weight_mb": qae.weight_bytes() / 2**20,
+    }
+
+
+def main():
+    from setup_utils import get_model, load_data, get_random_model, get_random_tokens, HELD_OUT_SEQS
+    parser = ArgumentParser()
+    parser.add_argument("--version", type=int, default=None)
+    parser.add_argument("--held_out_seqs", type=int, default=256, help=f"taken from load_data's held out rows, which training never sees (at most {HELD_OUT_SEQS})")
+    parser.add_argument("--random_model", action="store_true", help="a random model and encoder, for trying it out")
+    args = parser.parse_args()
+    if args.random_model:
+        cfg = AutoEncoderConfig(site="resid_pre", act_size=512, layer=1, dict_mult=8, flatten_heads=False, device="cpu")
+        ae = AutoEncoder(cfg)
+        model = get_random_model(cfg)
+        tokens = get_random_tokens(cfg, args.held_out_seqs, d_vocab=model.cfg.d_vocab)
+    else:
+        ae = AutoEncoder.load(args.version, lazy=False)
+        ae.cfg.device = "cpu"
+        ae = ae.to("cpu")
+        model = get_model(ae.cfg)
+        tokens = load_data(model, held_out=True)[:args.held_out_seqs]
+    qae = QuantizedAutoEncoder.from_autoencoder(ae)
+    if args.version is not None:
+        qae.save(quantized_path(args.version))
+        print("saved to", quantized_path(args.version))
+    print(json.dumps(accuracy_report(ae, qae, model, tokens), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# Resampling dead neurons from a large sample of reconstruction errors instead of a single batch.
+#
+# train() used to pass the residuals of the current batch to re_init_neurons every 200 steps, which
+# only takes the top num_to_resample of a few thousand rows at a time, so a big set of dead neurons
+# drips back over many steps. Here the residuals of a stream of activations (num_tokens worth, a
+# chunk at a time) go through a weighted reservoir: A-Res (Efraimidis & Spirakis 2006) gives every
+# residual key u^(1/w) with w its squared error and keeps the capacity largest, which is a weighted
+# sample without replacement in one pass and bounded memory. All pending neurons then get directions
+# from the reservoir at once, up to its capacity: a direction is never handed out twice, since two
+# neurons reset to the same one get the same gradients and stay copies of each other.
+#
+# Set cfg.resample_mode = "reservoir" to use it in train_sae.train.
+from typing import Optional, TYPE_CHECKING
+
+import einops
+import torch
+
+from sae import AutoEncoder
+from device_utils import model_autocast
+
+if TYPE_CHECKING:
+    from transformer_lens import HookedTransformer
+
+
+class ResidualReservoir():
+    """
+    Weighted reservoir of residual vectors, weight = squared norm.
+
+    Args:
+        capacity (int): Residuals kept.
+        d (int): Residual dimension.
+    """
+    def __init__(self, capacity :int, d :int, device="cpu", seed :int = 0):
+        self.capacity = capacity
+        self.residuals = torch.zeros(0, d, device=device)
+        # log of the A-Res key u^(1/w), which keeps keys of tiny weights from all rounding to 0
+        self.log_keys = torch.zeros(0, device=device)
+        self.generator = torch.Generator(device=device).manual_seed(seed)
+        self.seen = 0
+        self.total_weight = 0.
+
+    def add(self, residuals :torch.Tensor):
+        residuals = residuals.float().to(self.residuals.device)
+        weights = residuals.pow(2).sum(-1)
+        u = torch.rand(len(residuals), device=self.residuals.device, generator=self.generator)
+        log_keys = u.log() / weights
+        # only rows that could make it in are kept before the merge
+        if len(self.log_keys) == self.capacity:
+            candidates = log_keys > self.log_keys.min()
+            residuals, log_keys = residuals[candidates], log_keys[candidates]
+        all_keys = torch.cat([self.log_keys, log_keys])
+        top = all_keys.topk(min(self.capacity, len(all_keys))).indices
+        self.residuals = torch.cat([self.residuals, residuals])[top]
+        self.log_keys = all_keys[top]
+        self.seen += len(weights)
+        self.total_weight += weights.sum().item()
+
+    def sample(self, n :int):
+        """
+        n residuals from the reservoir without replacement, or all of them if it holds fewer than n.
+        """
+        idx = torch.randperm(len(self.residuals), device=self.residuals.device, generator=self.generator)[:n]
+        return self.residuals[idx]
+
+
+@torch.no_grad()
+def fill_reservoir(encoder :AutoEncoder, model :"HookedTransformer", tokens :torch.Tensor, num_tokens :int,
+                   capacity :int, reservoir :Optional[ResidualReservoir] = None, seed :int = 0):
+    """
+    Streams num_tokens tokens worth of random sequences from tokens through the model and encoder,
+    a model batch at a time, and adds the residuals to the reservoir.
+    """
+    cfg = encoder.cfg
+    if reservoir is None:
+        reservoir = ResidualReservoir(capacity, cfg.act_size, device=cfg.device, seed=seed)
+    n_seqs = min(len(tokens), max(1, num_tokens // tokens.shape[1]))
+    generator = torch.Generator().manual_seed(seed)
+    seqs = torch.randperm(len(tokens), generator=generator)[:n_seqs]
+    for start in range(0, n_seqs, cfg.model_batch_size):
+        batch = tokens[seqs[start:start + cfg.model_batch_size]].to(cfg.device)
+        with model_autocast(cfg):
+            _, cache = model.run_with_cache(batch, stop_at_layer=cfg.layer + 1, names_filter=cfg.act_name)
+        acts = einops.rearrange(cache[cfg.act_name], "batch seq_pos ... -> (batch seq_pos) (...)").to(encoder.W_enc.dtype)
+        # forward works in the data scale and returns the reconstruction unscaled, like train's x_diff
+        reservoir.add(acts.float() - encoder(acts, cache_l0=False).float())
+    return reservoir
+
+
+@torch.no_grad()
+def resample_all(encoder :AutoEncoder, reservoir :ResidualReservoir):
+    """
+    Resets every neuron in encoder.to_be_reset at once, to directions sampled from the reservoir.
+    When more neurons wait than the reservoir holds, the rest stay in to_be_reset for the next pass.
+    Returns the number reset.
+    """
+    if encoder.to_be_reset is None:
+        return 0
+    waiting = encoder.to_be_reset.shape[0]
+    directions = reservoir.sample(waiting)
+    encoder.reset_neurons(directions.to(encoder.W_dec.dtype))
+    return waiting - (0 if encoder.to_be_reset is None else encoder.to_be_reset.shape[0])
@@ -2,6 +2,7 @@
 # this work https://colab.research.google.com/drive/1MjF_5-msnSe5F9Qy4kEGSeqyYPE9_D2p?authuser=1#scrollTo=7WXAjU3mRak6
 # which I think was made by Bart Bussman, based off Neel Nanda's code.
 import novel_nonlinearities
+import distributed
 
 import torch
 import torch.nn as nn
@@ -18,18 +19,28 @@ from sae_config import AutoEncoderConfig
 from setup_utils import SAVE_DIR, DTYPES
 
 class AutoEncoder(nn.Module):
-    def __init__(self, cfg):
+    def __init__(self, cfg, init_weights=True):
+        """
+        Args:
+            cfg (AutoEncoderConfig): The autoencoder config.
+            init_weights (bool, optional): If False, the parameters are allocated on the meta device
+                and left uninitialised. They must then be filled with load_state_dict(..., assign=True),
+                which is what load does. Defaults to True.
+        """
         super().__init__()
         d_dict = cfg.dict_size
         l1_coeff = cfg.l1_coeff
         dtype = DTYPES[cfg.enc_dtype]
+        param_device = None if init_weights else "meta"
         torch.manual_seed(cfg.seed)
-        self.W_enc = nn.Parameter(torch.nn.init.kaiming_uniform_(torch.empty(cfg.act_size, d_dict, dtype=dtype)))
-        self.W_dec = nn.Parameter(torch.nn.init.kaiming_uniform_(torch.empty(d_dict, cfg.act_size, dtype=dtype)))
-        self.b_enc = nn.Parameter(torch.zeros(d_dict, dtype=dtype))
-        self.b_dec = nn.Parameter(torch.zeros(cfg.act_size, dtype=dtype))
-
-        self.W_dec.data[:] = self.W_dec / self.W_dec.norm(dim=-1, keepdim=True)
+        self.W_enc = nn.Parameter(torch.empty(cfg.act_size, d_dict, dtype=dtype, device=param_device))
+        self.W_dec = nn.Parameter(torch.empty(d_dict, cfg.act_size, dtype=dtype, device=param_device))
+        self.b_enc = nn.Parameter(torch.zeros(d_dict, dtype=dtype, device=param_device))
+        self.b_dec = nn.Parameter(torch.zeros(cfg.act_size, dtype=dtype, device=param_device))
+        if init_weights:
+            torch.nn.init.kaiming_uniform_(self.W_enc.data)
+            torch.nn.init.kaiming_uniform_(self.W_dec.data)
+            self.W_dec.data[:] = self.W_dec / self.W_dec.norm(dim=-1, keepdim=True)
         self.step_num = 0
         self.d_dict = d_dict
         self.l1_coeff = l1_coeff
@@ -38,7 +49,8 @@ class AutoEncoder(nn.Module):
         self.l1_loss_cached = None
         self.l0_norm_cached = None
         self.cfg = cfg      
-        self.to(cfg.device)
+        if init_weights:
+            self.to(cfg.device)
         self.cached_acts = None
         self.nonlinearity = novel_nonlinearities.cfg_to_nonlinearity(cfg)
         self.activation_frequency = torch.zeros(self.d_dict, dtype=torch.float32).to(cfg.device)
@@ -91,8 +103,13 @@ class AutoEncoder(nn.Module):
         return self.unscale(x_reconstruct) / self.cfg.data_rescale
     
 
-    def get_loss(self):
-        self.step_num += 1
+    def get_loss(self, advance_step=True):
+        """
+        Loss from the values cached by the last forward. When accumulating gradients over micro batches,
+        pass advance_step=False for all but the first one so that the l1 schedule counts optimizer steps.
+        """
+        if advance_step:
+            self.step_num += 1
         if self.cfg.cosine_l1 is None:
             l1_coeff = self.l1_coeff
         else:
@@ -109,6 +126,8 @@ class AutoEncoder(nn.Module):
         # var = (x_cent ** 2).sum(dim=-1)
         # std = torch.sqrt(var).mean()
         std = x_cent.norm(dim=-1).mean()
+        # under data parallel training every rank has to agree on the scale
+        std = distributed.all_reduce_mean(std)
         self.std_dev_accumulation += std #x_cent.std(dim=0).mean() is p diferent I believe
         self.std_dev_accumulation_steps += 1
         self.scaling_factor = self.std_dev_accumulation / self.std_dev_accumulation_steps
@@ -139,8 +158,16 @@ class AutoEncoder(nn.Module):
 
     @torch.no_grad()
     def re_init_neurons_gram_shmidt_precise_topk(self, x_diff):
-        t = self.cfg.gram_shmidt_trail
         n_reset = min(x_diff.shape[0], self.cfg.act_size // 2, self.cfg.num_to_resample)
+        self.reset_neurons(self.gram_shmidt_topk_directions(x_diff, n_reset))
+
+    @torch.no_grad()
+    def gram_shmidt_topk_directions(self, x_diff, n_reset):
+        """
+        Orthonormalised directions from the n_reset rows of x_diff with the largest norm.
+        May return fewer than n_reset if the residuals run out of independent directions.
+        """
+        t = self.cfg.gram_shmidt_trail
         v_orth = torch.zeros_like(x_diff)
         # print(x_diff.shape)
         # v_orth[0] = F.normalize(x_diff[0], dim=-1)
@@ -159,7 +186,7 @@ class AutoEncoder(nn.Module):
             # v_ = x_diff[i] - v_bar * torch.dot(v_bar, x_diff[i])
             # # print(v_.shape)
             # v_orth[i] = v_ / v_.norm(dim=-1, keepdim=True)
-        self.reset_neurons(v_orth[:n_succesfully_reset])
+        return v_orth[:n_succesfully_reset]
 
 
     
@@ -222,6 +249,8 @@ class AutoEncoder(nn.Module):
 
     @staticmethod
     def get_version():
+        if not SAVE_DIR.exists():
+            return 0
         version_list = [int(file.name.split("_")[0]) for file in list(SAVE_DIR.iterdir()) if "_cfg.json" in str(file)]
         if len(version_list):
             return 1 + max(version_list)
@@ -230,30 +259,53 @@ class AutoEncoder(nn.Module):
 
     def save(self, name=""):
         version = self.get_version()
+        SAVE_DIR.mkdir(parents=True, exist_ok=True)
         torch.save(self.state_dict(), SAVE_DIR/(str(version)+ "_" + name + ".pt"))
         with open(SAVE_DIR/(str(version)+ "_" + name + "_cfg.json"), "w") as f:
             json.dump(asdict(self.cfg), f)
         print("Saved as version", version)
 
     @classmethod
-    def load(cls, version, cfg = None, save_dir = None):
+    def load(cls, version, cfg = None, save_dir = None, lazy = True, verbose = False):
+        """
+        Loads a saved version.
+
+        Args:
+            version (int): The version number the autoencoder was saved under.
+            cfg (AutoEncoderConfig, optional): Overrides the saved config.
+            save_dir (str, optional): Defaults to SAVE_DIR.
+            lazy (bool, optional): Skip the random init and memory-map the weights straight
+                from the checkpoint instead of copying them into freshly initialised parameters.
+                Defaults to True.
+            verbose (bool, optional): Print the config. Defaults to False.
+        """
         save_dir = SAVE_DIR if save_dir is None else Path(save_dir)
         # get correct name with globbing
         import glob
         if cfg is None:
-            cfg_name = glob.glob(str(save_dir/(str(version)+"*_cfg.json")))
+            cfg_name = glob.glob(str(save_dir/(str(version)+"_*cfg.json")))
             cfg = json.load(open(cfg_name[0]))
             cfg = AutoEncoderConfig(**cfg)
-        pt_name = glob.glob(str(save_dir/(str(version)+"*.pt")))
-        pprint.pprint(cfg)
-        self = cls(cfg=cfg)
-        self.load_state_dict(torch.load(pt_name[0]))
+        pt_name = glob.glob(str(save_dir/(str(version)+"_*.pt")))
+        if verbose:
+            pprint.pprint(cfg)
+        if not lazy:
+            self = cls(cfg=cfg)
+            self.load_state_dict(torch.load(pt_name[0]))
+            return self
+        self = cls(cfg=cfg, init_weights=False)
+        # mmap'd storages are copy-on-write, so training a loaded model won't touch the file
+        state_dict = torch.load(pt_name[0], map_location=cfg.device, mmap=True, weights_only=True)
+        # assign keeps the saved dtype, so cast to the cfg's enc_dtype like the non-lazy path does
+        params = dict(self.named_parameters())
+        state_dict = {k: v.to(params[k].dtype) if k in params and v.dtype != params[k].dtype else v for k, v in state_dict.items()}
+        self.load_state_dict(state_dict, assign=True)
         return self
 
     @classmethod
-    def load_latest(cls, new_cfg = None):
+    def load_latest(cls, new_cfg = None, lazy = True):
         version = cls.get_version() - 1
-        ae = cls.load(version, new_cfg)
+        ae = cls.load(version, new_cfg, lazy=lazy)
         return ae
 
 
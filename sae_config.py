@@ -1,10 +1,48 @@
-import transformer_lens.utils as utils
-
-
+import re
+import torch
 from dataclasses import dataclass
 from typing import Dict, List, Optional, Union
 
 
+def get_act_name(name :str, layer :Optional[Union[int, str]] = None, layer_type :Optional[str] = None):
+    """
+    Copy of transformer_lens.utils.get_act_name, so that building a config (and therefore loading
+    an autoencoder) doesn't have to import transformer_lens.
+    """
+    if ("." in name or name.startswith("hook_")) and layer is None and layer_type is None:
+        return name
+    match = re.match(r"([a-z]+)(\d+)([a-z]?.*)", name)
+    if match is not None:
+        name, layer, layer_type = match.groups(0)
+    layer_type_alias = {"a": "attn", "m": "mlp", "b": "", "block": "", "blocks": "", "attention": "attn"}
+    act_name_alias = {
+        "attn": "pattern",
+        "attn_logits": "attn_scores",
+        "key": "k",
+        "query": "q",
+        "value": "v",
+        "mlp_pre": "pre",
+        "mlp_mid": "mid",
+        "mlp_post": "post",
+    }
+    name = act_name_alias.get(name, name)
+    full_act_name = ""
+    if layer is not None:
+        full_act_name += f"blocks.{layer}."
+    if name in ["k", "v", "q", "z", "rot_k", "rot_q", "result", "pattern", "attn_scores"]:
+        layer_type = "attn"
+    elif name in ["pre", "post", "mid", "pre_linear"]:
+        layer_type = "mlp"
+    elif layer_type in layer_type_alias:
+        layer_type = layer_type_alias[layer_type]
+    if layer_type:
+        full_act_name += f"{layer_type}."
+    full_act_name += f"hook_{name}"
+    if name in ["scale", "normalized"] and layer is None:
+        full_act_name = f"ln_final.{full_act_name}"
+    return full_act_name
+
+
 @dataclass
 class AutoEncoderConfig: #TODO some of these types are wrong. possibly some fields are unused, too
     seed :int = 49
@@ -21,7 +59,7 @@ class AutoEncoderConfig: #TODO some of these types are wrong. possibly some fiel
     enc_dtype :str = "fp32"
     model_name :str = "gelu-2l"
     site :str = "" # z?
-    device :str = "cuda"
+    device :str = "cuda" if torch.cuda.is_available() else "cpu"
     remove_rare_dir :bool = False
     act_size :int = -1
     flatten_heads :bool = True
@@ -39,17 +77,33 @@ class AutoEncoderConfig: #TODO some of these types are wrong. possibly some fiel
     num_to_resample :int = 128
     data_rescale :float = 1.0
     subshuffle :Optional[int] = None
+    profile :bool = False
+    profile_trace_steps :Optional[List[int]] = None # [start, stop) steps to record a torch.profiler trace for
+    num_threads :Optional[int] = None # intra-op threads, torch's default if None
+    num_interop_threads :Optional[int] = None
+    cpu_bf16 :Optional[bool] = None # autocast the model to bf16 on cpu. None: only if the cpu supports bf16 natively
+    ddp_bucket_cap_mb :int = 25 # gradient bucket size for data parallel training
+    micro_batch_size :Optional[int] = None # split each batch into chunks of this size and accumulate gradients over them
+    buffer_reuse :int = 1 # serve each buffered activation up to this many times, running the model about this many times less
+    buffer_max_age :Optional[int] = None # in reuse mode, also replace activations that have been in the buffer for this many refreshes
+    resample_mode :str = "batch" # "batch": dead neurons drip back from each batch's worst residuals every 200 steps. "reservoir": all at once, see resampling
+    resample_tokens :int = 2**21 # tokens streamed to fill the reservoir
+    resample_reservoir :int = 2**14 # residuals kept in the reservoir
+    memory_budget_gb :Optional[float] = None # if set, train_sae.main fits buffer_mult, model_batch_size and micro_batch_size to it, see memory_planner
 
     def __post_init__(self):
         print("Post init")
         self.post_init_cfg()
 
     def post_init_cfg(self):
+        if torch.device(self.device).type == "cuda" and not torch.cuda.is_available():
+            print(f"CUDA is not available, using the cpu instead of {self.device}")
+            self.device = "cpu"
         self.model_batch_size = self.batch_size // self.seq_len * 16
         self.buffer_size = self.batch_size * self.buffer_mult
         self.buffer_batches = self.buffer_size // self.seq_len
-        self.act_name = utils.get_act_name(self.site, self.layer)
-        self.dict_size = int(self.act_size * self.dict_mult)
+        self.act_name = get_act_name(self.site, self.layer)
+        self.dict_size = round(self.act_size * self.dict_mult)
         self.name = f"{self.model_name}_{self.layer}_{self.dict_size}_{self.site}"
         return self
 
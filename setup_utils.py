@@ -1,57 +1,125 @@
 from pathlib import Path
-from datasets import load_dataset
-from transformer_lens import HookedTransformer
+from typing import TYPE_CHECKING
 import torch
 import einops
 
+from token_store import TokenStore, tokenize_dataset
+
+# datasets and transformer_lens take seconds to import, so they are only imported
+# inside the functions that need them. Loading an autoencoder only needs torch.
+if TYPE_CHECKING:
+    from transformer_lens import HookedTransformer
+
 DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.float16, "bfp16" : torch.bfloat16}
 SAVE_DIR = Path.home() / "workspace"
-if not SAVE_DIR.exists():
-    SAVE_DIR.mkdir()
+# rows at the end of the saved (fixed) order that load_data keeps out of training, for evaluation
+HELD_OUT_SEQS = 2**12
 
 
 def get_model(cfg):
+    from transformer_lens import HookedTransformer
     model = HookedTransformer.from_pretrained(cfg.model_name).to(DTYPES[cfg.enc_dtype]).to(cfg.device)
     return model
 
 
+def get_random_model(cfg, n_layers=2, n_heads=4, d_vocab=1000, seed=0):
+    """
+    A small randomly initialised HookedTransformer with d_model = cfg.act_size, for benchmarks and
+    smoke tests that shouldn't need to download anything. Pair with get_random_tokens.
+    """
+    from transformer_lens import HookedTransformer, HookedTransformerConfig
+    model_cfg = HookedTransformerConfig(
+        n_layers=n_layers,
+        d_model=cfg.act_size,
+        d_head=cfg.act_size // n_heads,
+        n_heads=n_heads,
+        d_mlp=cfg.act_size * 4,
+        d_vocab=d_vocab,
+        n_ctx=cfg.seq_len,
+        act_fn="gelu",
+        normalization_type="LN",
+        seed=seed,
+        device=cfg.device,
+    )
+    return HookedTransformer(model_cfg).eval()
+
+
+def get_random_tokens(cfg, n_seqs, d_vocab=1000, bos_token_id=0):
+    tokens = torch.randint(1, d_vocab, (n_seqs, cfg.seq_len))
+    tokens[:, 0] = bos_token_id
+    return tokens
+
+
 def shuffle_documents(all_tokens): # assuming the shape[0] is documents
     # print("Shuffled data")
     return all_tokens[torch.randperm(all_tokens.shape[0])]
 
 
-def load_data(model :HookedTransformer, dataset = "NeelNanda/c4-code-tokenized-2b"):
-    import os
-    reshaped_name = dataset.split("/")[-1] + "_reshaped.pt"
-    dataset_reshaped_path = SAVE_DIR / "data" / reshaped_name
+def split_held_out(all_tokens, held_out :bool):
+    # the split is taken before any shuffling, so it's the same rows on every run
+    return all_tokens[-HELD_OUT_SEQS:] if held_out else all_tokens[:-HELD_OUT_SEQS]
+
+
+def get_token_store(dataset = "NeelNanda/c4-code-tokenized-2b", seq_len :int = 128):
+    """
+    The TokenStore load_data keeps a text dataset in. If it exists, load_data's rows are memory mapped from it.
+    """
+    return TokenStore(SAVE_DIR / "data" / f"{dataset.split('/')[-1]}_{seq_len}")
+
+
+def load_data(model :"HookedTransformer", dataset = "NeelNanda/c4-code-tokenized-2b", seq_len :int = 128, workers = None, held_out = False):
+    """
+    Token rows of seq_len for the dataset, cached under SAVE_DIR / "data". Pretokenised datasets
+    (a "tokens" column) are reshaped into rows and kept in memory. Text datasets are streamed through
+    token_store, tokenised by a pool of workers and packed into a memory mapped int32 store on disk.
+
+    The last HELD_OUT_SEQS rows of the saved order are never returned for training. held_out=True
+    returns just those, unshuffled, for evaluation.
+    """
+    from datasets import load_dataset, load_dataset_builder
+    name = dataset.split("/")[-1]
+    data_dir = SAVE_DIR / "data"
+    store = get_token_store(dataset, seq_len)
+    if store.exists():
+        print("loading token store:", store.bin_path)
+        return split_held_out(store.open(), held_out)
+    reshaped_name = name + "_reshaped.pt"
+    dataset_reshaped_path = data_dir / reshaped_name
     # if dataset exists loading_data_first_time=False
     loading_data_first_time = not dataset_reshaped_path.exists()
 
     print("first time:", loading_data_first_time)
     if loading_data_first_time:
+        # the builder reads the features from the dataset's metadata without loading any data
+        features = load_dataset_builder(dataset, cache_dir=SAVE_DIR / "cache/").info.features
+        if features is not None:
+            columns = list(features)
+        else:
+            # not every dataset declares its features, so look at a row
+            columns = list(next(iter(load_dataset(dataset, split="train", streaming=True))).keys())
+        if "tokens" not in columns and "text" in columns:
+            # rows are already packed and shuffled, so they don't need the reshaping below
+            tokenize_dataset(dataset, model.tokenizer, store.path, seq_len=seq_len, cache_dir=SAVE_DIR / "cache/", workers=workers)
+            return split_held_out(store.open(), held_out)
         data = load_dataset(dataset, split="train", cache_dir=SAVE_DIR / "cache/")
         # data.save_to_disk(os.path.join(SAVE_DIR / "data/", dataset.split("/")[-1]+".hf"))
-        if "tokens" not in data.column_names:
-            if "text" in data.column_names:
-                data.set_format(type="torch", columns=["text"])
-                data = data["text"]
-                # model.tokenizer.
-                all_tokens = model.tokenizer.tokenize(data["text"], return_tensors="pt", padding=True, truncation=True, max_length=128)
-        else:
-            data.set_format(type="torch", columns=["tokens"])
-            all_tokens = data["tokens"]
-        all_tokens.shape
-
+        data.set_format(type="torch", columns=["tokens"])
+        all_tokens = data["tokens"]
 
-        all_tokens_reshaped = einops.rearrange(all_tokens, "batch (x seq_len) -> (batch x) seq_len", x=8, seq_len=128)
+        all_tokens_reshaped = einops.rearrange(all_tokens, "batch (x seq_len) -> (batch x) seq_len", seq_len=seq_len)
         all_tokens_reshaped[:, 0] = model.tokenizer.bos_token_id
-        all_tokens_reshaped = all_tokens_reshaped[torch.randperm(all_tokens_reshaped.shape[0])]
+        # the saved order uses its own generator so the global rng is left as it would be on a later load
+        all_tokens_reshaped = all_tokens_reshaped[torch.randperm(all_tokens_reshaped.shape[0], generator=torch.Generator().manual_seed(0))]
         print("saving to:", dataset_reshaped_path)
+        dataset_reshaped_path.parent.mkdir(parents=True, exist_ok=True)
         torch.save(all_tokens_reshaped, dataset_reshaped_path)
         print("saved reshaped data")
+        all_tokens = all_tokens_reshaped
     else:
         # data = datasets.load_from_disk("/workspace/data/c4_code_tokenized_2b.hf")
         all_tokens = torch.load(dataset_reshaped_path)
-        all_tokens = shuffle_documents(all_tokens)
-    return all_tokens
-
+    # the first load and later ones end the same way, so processes seeded alike get the same order
+    # whether or not they made the file (train_sae_distributed shards on that)
+    if held_out:
+        return split_held_out(all_tokens, True)
+    return shuffle_documents(split_held_out(all_tokens, False))
@@ -0,0 +1,270 @@
+# Model parallel AutoEncoder for dictionaries too wide for one worker: the d_dict axis of W_enc, b_enc
+# and W_dec is split over the ranks of a torch.distributed process group (gloo works fine).
+# Every rank sees the same input batch, encodes its own slice of features, and the partial
+# reconstructions are summed with a single all-reduce. b_dec is replicated.
+import copy
+import json
+import math
+from dataclasses import asdict
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+import distributed
+from sae import AutoEncoder, AutoEncoderConfig
+from setup_utils import SAVE_DIR, DTYPES
+
+
+class _CopyToShards(torch.autograd.Function):
+    """Identity forward. Backward sums the gradient over the shards, for replicated inputs to the sharded encoder."""
+    @staticmethod
+    def forward(ctx, input):
+        return input
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.clone()
+        dist.all_reduce(grad_output)
+        return grad_output
+
+
+class _ReduceFromShards(torch.autograd.Function):
+    """
+    Sums the partial reconstructions over the shards. Every rank computes the same loss from the summed
+    output, so the gradient each rank needs for its partial is the output gradient it already has.
+    """
+    @staticmethod
+    def forward(ctx, input):
+        output = input.clone()
+        dist.all_reduce(output)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output
+
+
+class ShardedAutoEncoder(AutoEncoder):
+    """
+    AutoEncoder whose features are split evenly over the ranks. Rank r holds features
+    [shard_start, shard_start + d_dict) of the full dictionary. Per-feature state (l1, activation
+    frequency, to_be_reset) is per shard. self.cfg describes the shard; self.full_cfg describes the
+    whole dictionary.
+
+    All ranks must call forward with the same batch at the same time (see broadcast_batch).
+    """
+    model_parallel = True
+
+    def __init__(self, cfg :AutoEncoderConfig, init_weights=True):
+        world_size, rank = distributed.get_world_size(), distributed.get_rank()
+        assert cfg.dict_size % world_size == 0, f"dict_size {cfg.dict_size} doesn't split evenly over {world_size} ranks"
+        shard_size = cfg.dict_size // world_size
+        shard_cfg = copy.copy(cfg)
+        shard_cfg.dict_size = shard_size
+        super().__init__(shard_cfg, init_weights=False)
+        self.full_cfg = cfg
+        self.rank = rank
+        self.world_size = world_size
+        self.shard_start = rank * shard_size
+        if isinstance(self.l1_coeff, torch.Tensor):
+            self.l1_coeff = self.l1_coeff[self.shard_start:self.shard_start + shard_size]
+        if init_weights:
+            # same distributions as AutoEncoder's kaiming init of the full matrices, but each shard draws its own
+            dtype = DTYPES[cfg.enc_dtype]
+            g = torch.Generator().manual_seed(cfg.seed + rank)
+            enc_bound = math.sqrt(6 / cfg.dict_size)
+            dec_bound = math.sqrt(6 / cfg.act_size)
+            W_enc = torch.empty(cfg.act_size, shard_size, dtype=dtype).uniform_(-enc_bound, enc_bound, generator=g)
+            W_dec = torch.empty(shard_size, cfg.act_size, dtype=dtype).uniform_(-dec_bound, dec_bound, generator=g)
+            W_dec = W_dec / W_dec.norm(dim=-1, keepdim=True)
+            self.W_enc = nn.Parameter(W_enc.to(cfg.device))
+            self.W_dec = nn.Parameter(W_dec.to(cfg.device))
+            self.b_enc = nn.Parameter(torch.zeros(shard_size, dtype=dtype, device=cfg.device))
+            self.b_dec = nn.Parameter(torch.zeros(cfg.act_size, dtype=dtype, device=cfg.device))
+
+    def encode(self, x, cache_acts = False, cache_l0 = False, record_activation_frequency = False, rescaling = False):
+        """Activations of this rank's features only."""
+        x = x * self.cfg.data_rescale
+        if rescaling:
+            self.update_scaling(x)
+        x = self.scale(x)
+        x_cent = x - _CopyToShards.apply(self.b_dec)
+        return self.nonlinearity(x_cent @ self.W_enc + self.b_enc)
+
+    def forward(self, x, cache_l0 = True, cache_acts = False, record_activation_frequency = False, rescaling = False):
+        x = x * self.cfg.data_rescale
+        if rescaling:
+            self.update_scaling(x)
+        x = self.scale(x)
+        x_cent = x - _CopyToShards.apply(self.b_dec)
+        acts = self.nonlinearity(x_cent @ self.W_enc + self.b_enc)
+        x_reconstruct = _ReduceFromShards.apply(acts @ self.W_dec) + self.b_dec
+        x_diff = x_reconstruct.float() - x.float()
+        self.l1_loss_cached = acts.float().abs().mean(dim=(-2))
+        self.l2_loss_cached = (x_diff).pow(2).mean(-1).mean(0)
+
+        if cache_l0:
+            l0 = (acts > 0).float().sum(dim=-1)
+            dist.all_reduce(l0)
+            self.l0_norm_cached = l0.mean()
+        else:
+            self.l0_norm_cached = None
+        self.cached_acts = acts if cache_acts else None
+        if record_activation_frequency:
+            activated = torch.mean((acts > 0).float(), dim=0)
+            self.activation_frequency = activated + self.activation_frequency.detach()
+            self.steps_since_activation_frequency_reset += 1
+        return self.unscale(x_reconstruct) / self.cfg.data_rescale
+
+    @torch.no_grad()
+    def global_loss_dict(self, loss_dict):
+        """
+        train_sae.train's loss_dict over the whole dictionary. Its loss and l1_loss come from this shard's
+        get_loss and l1_loss_cached, which only cover this shard's features. l2 and l0 are already global.
+        """
+        l2 = loss_dict["l2_loss"]
+        sums = torch.tensor([loss_dict["loss"] - l2, loss_dict["l1_loss"]], dtype=torch.float64)
+        dist.all_reduce(sums)
+        # the shards are the same size, so the mean over all features is the mean of the shard means
+        return {**loss_dict, "loss": l2 + sums[0].item(), "l1_loss": sums[1].item() / self.world_size}
+
+    @torch.no_grad()
+    def neurons_to_reset(self, to_be_reset :torch.Tensor):
+        """
+        to_be_reset is the mask over this shard's features. Collective: every rank has to call this,
+        even with nothing to reset, because the alive encoder norm is averaged over all the shards.
+        """
+        self.to_be_reset = torch.argwhere(to_be_reset).squeeze(1) if to_be_reset.sum() > 0 else None
+        w_enc_norms = self.W_enc[:, ~ to_be_reset].norm(dim=0)
+        stats = torch.stack([w_enc_norms.sum(), torch.tensor(float(w_enc_norms.shape[0]), device=w_enc_norms.device)])
+        dist.all_reduce(stats)
+        self.alive_norm_along_feature_axis = stats[0] / stats[1]
+
+    @torch.no_grad()
+    def re_init_neurons(self, x_diff):
+        """
+        x_diff is the same on every rank, so every rank can compute the same set of new directions
+        and take a disjoint slice of them for its own dead features. Shards go in rank order.
+        """
+        pending = torch.tensor([0 if self.to_be_reset is None else self.to_be_reset.shape[0]])
+        counts = distributed.all_gather_cat(pending)
+        total = int(counts.sum())
+        if total == 0:
+            return
+        n_reset = min(x_diff.shape[0], self.cfg.act_size // 2, self.cfg.num_to_resample, total)
+        directions = self.gram_shmidt_topk_directions(x_diff, n_reset)
+        offset = int(counts[:self.rank].sum())
+        mine = directions[offset:offset + int(counts[self.rank])]
+        if self.to_be_reset is not None and mine.shape[0] > 0:
+            self.reset_neurons(mine)
+
+    def save(self, name=""):
+        """
+        Each rank writes its own shard next to a single config describing the full dictionary, so nothing
+        ever has to hold the whole dictionary. Returns the version.
+        """
+        version = torch.tensor([self.get_version() if self.rank == 0 else 0])
+        dist.broadcast(version, src=0)
+        version = int(version)
+        SAVE_DIR.mkdir(parents=True, exist_ok=True)
+        torch.save(self.state_dict(), SAVE_DIR/f"{version}_{name}_shard{self.rank}of{self.world_size}.pt")
+        if self.rank == 0:
+            with open(SAVE_DIR/(str(version)+ "_" + name + "_cfg.json"), "w") as f:
+                json.dump(asdict(self.full_cfg), f)
+            print("Saved as version", version)
+        dist.barrier()
+        return version
+
+    @classmethod
+    def load(cls, version, cfg = None, save_dir = None):
+        """Loads this rank's shard. The world size has to match the one the shards were saved with."""
+        save_dir = SAVE_DIR if save_dir is None else Path(save_dir)
+        if cfg is None:
+            cfg_name = next(save_dir.glob(f"{version}_*cfg.json"))
+            cfg = AutoEncoderConfig(**json.load(open(cfg_name)))
+        self = cls(cfg, init_weights=False)
+        pt_name = next(save_dir.glob(f"{version}_*_shard{self.rank}of{self.world_size}.pt"))
+        self.load_state_dict(torch.load(pt_name, map_location=cfg.device, mmap=True, weights_only=True), assign=True)
+        return self
+
+    @classmethod
+    def consolidate(cls, version, save_dir = None):
+        """
+        Builds a plain AutoEncoder from a sharded checkpoint, without a process group. Needs memory
+        for the whole dictionary.
+        """
+        save_dir = SAVE_DIR if save_dir is None else Path(save_dir)
+        cfg_name = next(save_dir.glob(f"{version}_*cfg.json"))
+        cfg = AutoEncoderConfig(**json.load(open(cfg_name)))
+        shards = sorted(save_dir.glob(f"{version}_*_shard*of*.pt"), key=lambda p: int(p.stem.split("_shard")[-1].split("of")[0]))
+        state_dicts = [torch.load(p, map_location=cfg.device, weights_only=True) for p in shards]
+        state_dict = {
+            "W_enc": torch.cat([sd["W_enc"] for sd in state_dicts], dim=1),
+            "W_dec": torch.cat([sd["W_dec"] for sd in state_dicts], dim=0),
+            "b_enc": torch.cat([sd["b_enc"] for sd in state_dicts], dim=0),
+            "b_dec": state_dicts[0]["b_dec"],
+        }
+        ae = AutoEncoder(cfg, init_weights=False)
+        ae.load_state_dict(state_dict, assign=True)
+        return ae
+
+
+def broadcast_batch(buffer, cfg):
+    """
+    Rank 0 draws the next batch from its buffer and sends it to the other ranks, which don't need a
+    buffer or the model at all (pass buffer=None there).
+    """
+    if distributed.is_main_process():
+        acts = buffer.next().contiguous()
+    else:
+        acts = torch.empty((cfg.batch_size, cfg.act_size), dtype=torch.float16, device=cfg.device)
+    dist.broadcast(acts, src=0)
+    return acts
+
+
+@torch.no_grad()
+def get_recons_loss_sharded(model, encoder :ShardedAutoEncoder, buffer, num_batches=1):
+    """
+    get_recons_loss for a sharded encoder. Rank 0 runs the model and sends the hooked activations
+    to the other ranks. Then all ranks reconstruct them together, and rank 0 patches the
+    reconstruction back in. Returns the same tuple as get_recons_loss on rank 0, and None on the
+    other ranks.
+    """
+    from calculations_on_sae import zero_ablate_hook
+    cfg = encoder.cfg
+    main_process = distributed.is_main_process()
+    loss_list = []
+    for _ in range(num_batches):
+        if main_process:
+            tokens = buffer.all_tokens[torch.randperm(len(buffer.all_tokens))[:cfg.model_batch_size]]
+            loss = model(tokens, return_type="loss")
+            zero_abl_loss = model.run_with_hooks(tokens, return_type="loss", fwd_hooks=[(cfg.act_name, zero_ablate_hook)])
+            _, cache = model.run_with_cache(tokens, stop_at_layer=cfg.layer + 1, names_filter=cfg.act_name)
+            acts = cache[cfg.act_name]
+            shape = torch.tensor(acts.shape)
+            acts = acts.reshape(-1, cfg.act_size).float().contiguous()
+            dims = torch.tensor([len(shape)])
+        else:
+            dims = torch.zeros(1, dtype=torch.long)
+        dist.broadcast(dims, src=0)
+        if not main_process:
+            shape = torch.zeros(int(dims), dtype=torch.long)
+        dist.broadcast(shape, src=0)
+        if not main_process:
+            acts = torch.empty((int(shape.prod()) // cfg.act_size, cfg.act_size), device=cfg.device)
+        dist.broadcast(acts, src=0)
+        reconstruction = encoder(acts)
+        if main_process:
+            reconstruction = reconstruction.reshape(*shape.tolist())
+            def replace_hook(act, hook):
+                return reconstruction.to(act.dtype)
+            recons_loss = model.run_with_hooks(tokens, return_type="loss", fwd_hooks=[(cfg.act_name, replace_hook)])
+            loss_list.append((loss, recons_loss, zero_abl_loss))
+    if not main_process:
+        return None
+    loss, recons_loss, zero_abl_loss = torch.tensor(loss_list).mean(0).tolist()
+    score = ((zero_abl_loss - recons_loss)/(zero_abl_loss - loss))
+    print(f"{score:.2%}")
+    return score, loss, recons_loss, zero_abl_loss
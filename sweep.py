@@ -0,0 +1,306 @@
+# Successive halving sweep: trains many AutoEncoderConfigs side by side on one shared activation stream.
+# The model runs once per batch and every surviving config trains on that batch, on a pool of worker threads.
+# At each rung every config is evaluated on the same eval tokens. Configs that are far from the
+# L0 vs recons score frontier get pruned, and the steps they would have taken go to the survivors.
+# Rung r ends after min_steps * eta**r steps, so the survivors of the last rung train for the full num_tokens.
+#
+#   python sweep.py --l1_coeff 2e-4 35e-5 5e-4 8e-4 --lr 3e-5 1e-4 3e-4 --workers 4 --num_threads 4
+# Smoke test with a small random transformer and random tokens:
+#   python sweep.py --random_model --num_tokens 400000 --buffer_mult 64 --min_steps 50
+import os
+import json
+import math
+import time
+import threading
+import dataclasses
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, TYPE_CHECKING
+
+import torch
+
+from buffer import Buffer
+from sae import AutoEncoder, AutoEncoderConfig
+from setup_utils import SAVE_DIR, get_model, load_data, get_random_model, get_random_tokens
+from calculations_on_sae import replacement_hook, zero_ablate_hook
+from device_utils import configure_threads
+from train_sae import new_optimizer, train_step, dead_neuron_step
+
+if TYPE_CHECKING:
+    from transformer_lens import HookedTransformer
+
+# every config in a sweep reads the same activations, so these have to agree
+STREAM_FIELDS = ["model_name", "site", "layer", "act_size", "flatten_heads", "batch_size", "seq_len", "device"]
+# filled in by post_init_cfg, so they never count as swept
+DERIVED_FIELDS = ["model_batch_size", "buffer_size", "buffer_batches", "act_name", "dict_size", "name"]
+
+_model_lock = threading.Lock()
+
+
+class Trial():
+    """
+    One config of the sweep: the encoder, its optimizer and its eval history. Steps go through
+    train_sae.train_step and dead_neuron_step, so a trial trains exactly like train_sae.train would.
+    model and tokens are only used by reservoir resampling.
+    """
+    def __init__(self, trial_id :int, cfg :AutoEncoderConfig, model :"HookedTransformer" = None, tokens :torch.Tensor = None):
+        self.id = trial_id
+        self.cfg = cfg
+        self.model = model
+        self.tokens = tokens
+        self.encoder = AutoEncoder(cfg)
+        self.optim = new_optimizer(self.encoder, cfg)
+        self.step = 0
+        self.evals = []
+        self.pruned_at = None
+        self.last_loss = None
+
+    def train_on(self, batches :List[torch.Tensor]):
+        for acts in batches:
+            self.train_step(acts)
+
+    def train_step(self, acts :torch.Tensor):
+        i = self.step
+        self.optim, losses, _ = train_step(self.encoder, self.encoder, self.optim, acts, self.cfg, i)
+        if i % 100 == 0:
+            self.last_loss = losses["loss"].item()
+        # trials run in lockstep, and reservoir resampling runs the shared model, which hooks can't share between threads
+        with _model_lock:
+            self.optim, _ = dead_neuron_step(self.encoder, self.optim, self.cfg, i, self.model, self.tokens)
+        self.step += 1
+
+    @property
+    def latest(self):
+        return self.evals[-1] if self.evals else {}
+
+
+class SharedEval():
+    """
+    Evaluates every config on the same tokens. The clean and zero ablation losses and the
+    activations at the hook point don't depend on the encoder, so they're computed once.
+    """
+    @torch.no_grad()
+    def __init__(self, model :"HookedTransformer", cfg :AutoEncoderConfig, tokens :torch.Tensor):
+        self.model = model
+        self.act_name = cfg.act_name
+        self.tokens = tokens
+        self.loss = model(tokens, return_type="loss").item()
+        self.zero_abl_loss = model.run_with_hooks(tokens, return_type="loss", fwd_hooks=[(cfg.act_name, zero_ablate_hook)]).item()
+        _, cache = model.run_with_cache(tokens, stop_at_layer=cfg.layer + 1, names_filter=cfg.act_name)
+        self.acts = cache[cfg.act_name].reshape(-1, cfg.act_size)
+
+    @torch.no_grad()
+    def __call__(self, trial :Trial):
+        encoder = trial.encoder
+        recons_loss = self.model.run_with_hooks(self.tokens, return_type="loss", fwd_hooks=[(self.act_name, partial(replacement_hook, encoder=encoder))]).item()
+        l0 = (encoder.encode(self.acts) > 0).float().sum(-1).mean().item()
+        freqs = encoder.activation_frequency / max(encoder.steps_since_activation_frequency_reset, 1)
+        return {
+            "step": trial.step,
+            "recons_score": (self.zero_abl_loss - recons_loss) / (self.zero_abl_loss - self.loss),
+            "recons_loss": recons_loss,
+            "l0_norm": l0,
+            "dead": (freqs == 0).float().mean().item(),
+            "loss": trial.last_loss,
+        }
+
+
+def pareto_fronts(points):
+    """
+    Non-dominated sorting of (l0, recons_score) points, where lower l0 and higher recons score are better.
+    Returns the front index of every point, 0 being the frontier itself.
+    """
+    fronts = [None] * len(points)
+    remaining = set(range(len(points)))
+    front = 0
+    while remaining:
+        current = [
+            a for a in remaining
+            if not any(
+                points[b][0] <= points[a][0] and points[b][1] >= points[a][1] and points[b] != points[a]
+                for b in remaining
+            )
+        ]
+        for a in current:
+            fronts[a] = front
+        remaining -= set(current)
+        front += 1
+    return fronts
+
+
+def select_survivors(trials :List[Trial], n_keep :int):
+    """
+    Keeps the n_keep trials closest to the L0 vs recons frontier. When a front only partially fits,
+    its trials are picked evenly along L0 (ends included) so the survivors still span the L0 range.
+    """
+    points = [(t.latest["l0_norm"], t.latest["recons_score"]) for t in trials]
+    fronts = pareto_fronts(points)
+    keep = []
+    for front in range(max(fronts) + 1):
+        members = sorted([t for t, f in zip(trials, fronts) if f == front], key=lambda t: t.latest["l0_norm"])
+        space = n_keep - len(keep)
+        if len(members) <= space:
+            keep += members
+        else:
+            if space == 1:
+                keep.append(max(members, key=lambda t: t.latest["recons_score"]))
+            else:
+                idx = sorted(set(round(k * (len(members) - 1) / (space - 1)) for k in range(space)))
+                keep += [members[k] for k in idx]
+            break
+        if len(keep) == n_keep:
+            break
+    return keep
+
+
+def rung_schedule(min_steps :int, eta :int, max_steps :int):
+    rungs = []
+    steps = min_steps
+    while steps < max_steps:
+        rungs.append(steps)
+        steps *= eta
+    return rungs + [max_steps]
+
+
+def swept_fields(cfgs :List[AutoEncoderConfig]):
+    dicts = [dataclasses.asdict(c) for c in cfgs]
+    return [k for k in dicts[0] if k not in DERIVED_FIELDS and any(d[k] != dicts[0][k] for d in dicts)]
+
+
+def results_table(trials :List[Trial], fields :List[str]):
+    rows = []
+    for t in trials:
+        row = {"id": t.id}
+        row.update({k: getattr(t.cfg, k) for k in fields})
+        row.update({"tokens": t.step * t.cfg.batch_size, "status": "alive" if t.pruned_at is None else f"pruned@{t.pruned_at}"})
+        row.update({k: t.latest.get(k) for k in ["recons_score", "l0_norm", "dead", "loss"]})
+        rows.append(row)
+    # survivors first, then by how long they lasted, then by recons score
+    return sorted(rows, key=lambda r: (-r["tokens"], -(r["recons_score"] or 0)))
+
+
+def print_table(rows):
+    def fmt(v):
+        if isinstance(v, float):
+            return f"{v:.4g}"
+        return str(v)
+    cols = list(rows[0].keys())
+    widths = {c: max(len(c), *(len(fmt(r[c])) for r in rows)) for c in cols}
+    print("  ".join(c.ljust(widths[c]) for c in cols))
+    for r in rows:
+        print("  ".join(fmt(r[c]).ljust(widths[c]) for c in cols))
+
+
+def sweep(cfgs :List[AutoEncoderConfig], buffer :Buffer, model :"HookedTransformer", min_steps=1000, eta=3,
+          workers=4, steps_per_round=25, eval_every=5000, eval_seqs=None, save=True):
+    """
+    Runs a successive halving sweep over cfgs, all trained from buffer. buffer.cfg sets the activation
+    stream and has to agree with every config on STREAM_FIELDS. Returns the results table, one row per config.
+
+    Args:
+        min_steps (int): Length of the first rung. Defaults to 1000.
+        eta (int): At each rung 1/eta of the configs survive and the next rung is eta times longer. Defaults to 3.
+        workers (int): Threads training configs in parallel. Defaults to 4.
+        steps_per_round (int): Batches handed to each worker at a time. Defaults to 25.
+        eval_every (int): Also evaluate between rungs every this many steps. Defaults to 5000.
+        eval_seqs (int, optional): Number of eval sequences. Defaults to cfg.model_batch_size.
+        save (bool, optional): Save the surviving encoders and the table. Defaults to True.
+    """
+    base = buffer.cfg
+    for cfg in cfgs:
+        for k in STREAM_FIELDS:
+            assert getattr(cfg, k) == getattr(base, k), f"every config has to share {k} with the buffer"
+    max_steps = base.num_tokens // base.batch_size
+    rungs = rung_schedule(min_steps, eta, max_steps)
+    fields = swept_fields(cfgs)
+    print(f"Sweeping {len(cfgs)} configs over {fields}, rungs at steps {rungs}")
+
+    # encoders seed the global rng on init, so build them here rather than on the workers
+    trials = [Trial(k, cfg, model, buffer.all_tokens) for k, cfg in enumerate(cfgs)]
+    eval_tokens = buffer.all_tokens[torch.randperm(len(buffer.all_tokens))[:eval_seqs or base.model_batch_size]]
+    evaluate = SharedEval(model, base, eval_tokens)
+    alive = list(trials)
+    t0 = time.time()
+    step = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for rung, rung_end in enumerate(rungs):
+            while step < rung_end:
+                n = min(steps_per_round, rung_end - step, eval_every - step % eval_every)
+                # clone, since a refresh overwrites the buffer in place when subshuffling
+                batches = [buffer.next().clone() for _ in range(n)]
+                for future in [pool.submit(t.train_on, batches) for t in alive]:
+                    future.result()
+                step += n
+                if step % eval_every == 0 and step != rung_end:
+                    for t in alive:
+                        t.evals.append(evaluate(t))
+                    print(f"step {step}:", {t.id: round(t.latest["recons_score"], 4) for t in alive})
+            for t in alive:
+                t.evals.append(evaluate(t))
+            if rung_end < max_steps and len(alive) > 1:
+                survivors = select_survivors(alive, max(1, math.ceil(len(alive) / eta)))
+                for t in alive:
+                    if t not in survivors:
+                        t.pruned_at = step
+                        # drop the weights and Adam state, only the eval history is needed from here on
+                        t.encoder = t.optim = None
+                alive = survivors
+            print(f"Rung {rung} done at step {step} ({time.time() - t0:.0f}s), {len(alive)} configs left")
+            print_table(results_table(trials, fields))
+
+    rows = results_table(trials, fields)
+    if save:
+        sweep_dir = SAVE_DIR/"sweeps"
+        sweep_dir.mkdir(parents=True, exist_ok=True)
+        path = sweep_dir/f"sweep_{int(time.time())}.json"
+        for t in alive:
+            t.encoder.save(name=f"sweep{t.id}")
+        with open(path, "w") as f:
+            json.dump({"fields": fields, "rungs": rungs, "rows": rows,
+                       "history": {t.id: t.evals for t in trials}}, f, default=str)
+        print("Saved the sweep results to", path)
+    return rows
+
+
+def main():
+    import train_sae
+    parser = ArgumentParser()
+    parser.add_argument("--l1_coeff", type=float, nargs="+", default=None)
+    parser.add_argument("--lr", type=float, nargs="+", default=None)
+    parser.add_argument("--min_steps", type=int, default=1000)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--steps_per_round", type=int, default=25)
+    parser.add_argument("--eval_every", type=int, default=5000)
+    parser.add_argument("--num_threads", type=int, default=None, help="intra-op threads. workers * num_threads should be about the number of cores")
+    parser.add_argument("--num_tokens", type=int, default=None)
+    parser.add_argument("--buffer_mult", type=int, default=None)
+    parser.add_argument("--random_model", action="store_true")
+    args = parser.parse_args()
+
+    overrides = {k: getattr(args, k) for k in ["num_tokens", "buffer_mult", "num_threads"] if getattr(args, k) is not None}
+    if args.num_threads is None:
+        overrides["num_threads"] = max(1, (os.cpu_count() or 1) // args.workers)
+    if args.random_model:
+        overrides["flatten_heads"] = False
+        overrides["site"] = "resid_pre"
+    base = dataclasses.replace(train_sae.cfg, **overrides)
+    configure_threads(base)
+    l1_coeffs = args.l1_coeff or [base.l1_coeff]
+    lrs = args.lr or [base.lr]
+    cfgs = [dataclasses.replace(base, l1_coeff=l1, lr=lr) for l1 in l1_coeffs for lr in lrs]
+
+    if args.random_model:
+        model = get_random_model(base)
+        all_tokens = get_random_tokens(base, base.buffer_batches * 4, d_vocab=model.cfg.d_vocab)
+    else:
+        model = get_model(base)
+        all_tokens = load_data(model)
+    buffer = Buffer(base, all_tokens, model=model)
+    sweep(cfgs, buffer, model, min_steps=args.min_steps, eta=args.eta, workers=args.workers,
+          steps_per_round=args.steps_per_round, eval_every=args.eval_every)
+
+
+if __name__ == "__main__":
+    main()
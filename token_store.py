@@ -0,0 +1,178 @@
+# Streaming tokenisation of text datasets into an on-disk token store.
+#
+# load_data used to tokenise a whole text dataset in one padded call and reshape it assuming
+# 8 chunks of 128 per row. Here the dataset is streamed in batches of documents, a process pool
+# tokenises them, and the main process packs the tokens back to back into seq_len rows:
+#   [BOS] doc_1 [EOS] doc_2 [EOS] ...     (seq_len - 1 tokens after the BOS, documents run across rows)
+# Rows go through a bounded shuffle buffer (documents in a dataset are often grouped by source) and
+# are appended to a flat int32 file, so memory stays bounded by the pool's in-flight batches and the
+# shuffle buffer whatever the dataset size.
+#
+# A store is <path>.bin (rows of int32 tokens) plus <path>.json (shape, tokenizer, ...). The json is
+# written last, so a store without one is an unfinished conversion and gets redone. TokenStore.open
+# memory maps the rows, which works as all_tokens anywhere in the repo.
+#
+#   python token_store.py --dataset NeelNanda/pile-10k --tokenizer gpt2 --workers 8
+import os
+import json
+import time
+import multiprocessing as mp
+from pathlib import Path
+from argparse import ArgumentParser
+from typing import Optional
+
+import numpy as np
+import torch
+
+_tokenizer = None
+_separator = None
+
+
+def _init_worker(tokenizer, separator):
+    global _tokenizer, _separator
+    _tokenizer = tokenizer
+    _separator = separator
+
+
+def _tokenize(texts):
+    ids = _tokenizer(texts, add_special_tokens=False)["input_ids"]
+    # every document followed by the separator, as one flat array, and the number of documents
+    return len(ids), np.concatenate([np.append(np.asarray(doc, dtype=np.int32), np.int32(_separator)) for doc in ids])
+
+
+class TokenStore():
+    """
+    Args:
+        path (Path): Store path without extension.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.bin_path = self.path.with_suffix(".bin")
+        self.header_path = self.path.with_suffix(".json")
+
+    def exists(self):
+        return self.header_path.exists()
+
+    def header(self):
+        with open(self.header_path) as f:
+            return json.load(f)
+
+    def open(self):
+        """
+        The rows as an (n_rows, seq_len) int32 tensor backed by the file. The mapping is copy on write,
+        so nothing writes back to the store.
+        """
+        h = self.header()
+        rows = np.memmap(self.bin_path, dtype=np.int32, mode="c", shape=(h["n_rows"], h["seq_len"]))
+        return torch.from_numpy(rows)
+
+    def write(self, texts, tokenizer, seq_len :int = 128, workers :Optional[int] = None, docs_per_batch :int = 1000,
+              shuffle_rows :int = 2**16, max_rows :Optional[int] = None, seed :int = 0, extra_header :Optional[dict] = None):
+        """
+        Tokenises and packs the documents from the iterable texts into the store.
+
+        Args:
+            texts: Iterable of strings, e.g. a streaming HF dataset's "text" column.
+            tokenizer: A HF tokenizer, pickled into the workers.
+            workers (int, optional): Tokenising processes. Defaults to os.cpu_count().
+            shuffle_rows (int, optional): Rows held in the shuffle buffer. 0 writes rows in order.
+            max_rows (int, optional): Stop after this many rows.
+        """
+        bos = tokenizer.bos_token_id
+        separator = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else bos
+        workers = workers or os.cpu_count()
+        rng = np.random.default_rng(seed)
+        self.bin_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.header_path.exists():
+            self.header_path.unlink()
+
+        def batches():
+            batch = []
+            for text in texts:
+                batch.append(text)
+                if len(batch) == docs_per_batch:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        carry = np.zeros(0, dtype=np.int32)
+        pending = np.zeros((0, seq_len), dtype=np.int32)
+        n_rows, n_docs, t0 = 0, 0, time.time()
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        with open(self.bin_path, "wb") as f, mp.Pool(workers, initializer=_init_worker, initargs=(tokenizer, separator)) as pool:
+            def flush(rows):
+                nonlocal n_rows
+                if max_rows is not None:
+                    rows = rows[:max_rows - n_rows]
+                f.write(rows.tobytes())
+                n_rows += len(rows)
+
+            # imap keeps the dataset order, so a store is the same for the same seed whatever the worker count
+            for batch_docs, tokens in pool.imap(_tokenize, batches(), chunksize=1):
+                n_docs += batch_docs
+                carry = np.concatenate([carry, tokens])
+                n_new = len(carry) // (seq_len - 1)
+                if n_new:
+                    new = np.empty((n_new, seq_len), dtype=np.int32)
+                    new[:, 0] = bos
+                    new[:, 1:] = carry[:n_new * (seq_len - 1)].reshape(n_new, seq_len - 1)
+                    carry = carry[n_new * (seq_len - 1):]
+                    pending = np.concatenate([pending, new])
+                if shuffle_rows == 0:
+                    flush(pending)
+                    pending = pending[:0]
+                elif len(pending) >= 2 * shuffle_rows:
+                    # write out all but shuffle_rows random rows
+                    pending = pending[rng.permutation(len(pending))]
+                    flush(pending[shuffle_rows:])
+                    pending = pending[:shuffle_rows].copy()
+                if max_rows is not None and n_rows >= max_rows:
+                    pool.terminate()
+                    break
+                if n_docs % (docs_per_batch * 100) == 0:
+                    print(f"{n_docs} documents, {n_rows} rows, {n_rows * seq_len / (time.time() - t0):.0f} tokens/s")
+            # the leftover partial row is dropped
+            if max_rows is None or n_rows < max_rows:
+                flush(pending[rng.permutation(len(pending))])
+        header = {"n_rows": n_rows, "n_docs": n_docs, "seq_len": seq_len, "dtype": "int32", "bos_token_id": bos,
+                  "separator_token_id": separator, "tokenizer": getattr(tokenizer, "name_or_path", None), **(extra_header or {})}
+        with open(self.header_path, "w") as f:
+            json.dump(header, f)
+        print(f"wrote {n_rows} rows of {seq_len} tokens from {n_docs} documents to {self.bin_path} in {time.time() - t0:.0f}s")
+        return header
+
+
+def tokenize_dataset(dataset :str, tokenizer, path, seq_len :int = 128, split :str = "train", text_column :str = "text",
+                     cache_dir=None, **kwargs):
+    """
+    Streams the HF dataset and writes it to a TokenStore at path, returning the store.
+    """
+    from datasets import load_dataset
+    data = load_dataset(dataset, split=split, streaming=True, cache_dir=cache_dir)
+    store = TokenStore(path)
+    store.write((row[text_column] for row in data), tokenizer, seq_len=seq_len, extra_header={"dataset": dataset, "split": split}, **kwargs)
+    return store
+
+
+def main():
+    from transformers import AutoTokenizer
+    from setup_utils import SAVE_DIR
+    parser = ArgumentParser()
+    parser.add_argument("--dataset", type=str, required=True)
+    parser.add_argument("--tokenizer", type=str, default="gpt2")
+    parser.add_argument("--split", type=str, default="train")
+    parser.add_argument("--text_column", type=str, default="text")
+    parser.add_argument("--seq_len", type=int, default=128)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max_rows", type=int, default=None)
+    parser.add_argument("--out", type=str, default=None, help="defaults to SAVE_DIR/data/<dataset>_<seq_len>")
+    args = parser.parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    out = args.out or SAVE_DIR / "data" / f"{args.dataset.split('/')[-1]}_{args.seq_len}"
+    tokenize_dataset(args.dataset, tokenizer, out, seq_len=args.seq_len, split=args.split, text_column=args.text_column,
+                     cache_dir=SAVE_DIR / "cache/", workers=args.workers, max_rows=args.max_rows)
+
+
+if __name__ == "__main__":
+    main()
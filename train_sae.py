@@ -1,94 +1,244 @@
 from buffer import Buffer
 from sae import AutoEncoder, AutoEncoderConfig
-from setup_utils import get_model, load_data
+from setup_utils import get_model, load_data, get_token_store
 from calculations_on_sae import get_recons_loss
-from transformer_lens import HookedTransformer
+from profiler import StepProfiler, NULL_PROFILER
+from device_utils import configure_threads, empty_cache
+import distributed
+import memory_planner
+from resampling import fill_reservoir, resample_all
+from sharded_sae import broadcast_batch, get_recons_loss_sharded
+from typing import TYPE_CHECKING
 
-import wandb
 import tqdm
 import torch
 import time
 
-def train(encoder :AutoEncoder, cfg :AutoEncoderConfig, buffer :Buffer, model :HookedTransformer):
-    wandb.login(key="0cb29a3826bf031cc561fd7447767a3d7920d888", relogin=True)
+if TYPE_CHECKING:
+    from transformer_lens import HookedTransformer
+
+def new_optimizer(encoder :AutoEncoder, cfg :AutoEncoderConfig):
+    return torch.optim.Adam(encoder.parameters(), lr=cfg.lr, betas=(cfg.beta1, cfg.beta2))
+
+
+def train_step(encoder :AutoEncoder, parallel_encoder, encoder_optim, acts :torch.Tensor, cfg :AutoEncoderConfig, i :int, profiler=NULL_PROFILER):
+    """
+    Step i of training on the batch acts: scale updates, the micro batched forward and backward, decoder
+    renorm, the optimizer step and, every 200 steps, resampling from the batch's residuals.
+    parallel_encoder is what the forward goes through (see distributed.wrap_data_parallel), or the encoder.
+
+    Returns:
+        (encoder_optim, losses, resample_log): the optimizer, which is a new one after neurons are reset,
+        the batch's detached losses, and what to log about the resampling, empty on other steps.
+    """
+    sharded = distributed.is_model_parallel(encoder)
+    n_micro_batches = 1 if cfg.micro_batch_size is None else cfg.batch_size // cfg.micro_batch_size
+    assert n_micro_batches * (cfg.micro_batch_size or cfg.batch_size) == cfg.batch_size, "micro_batch_size has to divide batch_size"
+    rescaling = i < 10 or (i < 10000 * cfg.batch_size / cfg.buffer_mult * cfg.buffer_refresh_ratio and i % 100 == 0)
+    # re_init_neurons of a sharded encoder is collective, so every shard goes in whether or not it has neurons waiting
+    resampling = i % 200 == 99 and (sharded or encoder.to_be_reset is not None) and cfg.resample_mode == "batch"
+    if n_micro_batches > 1 and rescaling:
+        # update the scale once from the whole batch so every micro batch uses the same one
+        encoder.update_scaling(acts * cfg.data_rescale)
+    loss, l2_loss, l1_loss, l0_norm = 0, 0, 0, 0
+    x_diffs = []
+    for j, micro_acts in enumerate(acts.chunk(n_micro_batches)):
+        # only all-reduce the gradients once they're accumulated over the whole batch
+        with distributed.no_sync(parallel_encoder, j < n_micro_batches - 1):
+            with profiler.phase("forward"):
+                x_reconstruct = parallel_encoder(micro_acts, record_activation_frequency=True, rescaling = rescaling and n_micro_batches == 1)
+                # if i % 100 == 99:
+                #     encoder.re_init_neurons_gram_shmidt(x.float() - x_reconstruct.float())
+                micro_loss = encoder.get_loss(advance_step = j == 0)
+                # every micro batch is the same size, so the batch means are the means of the micro batch means
+                loss += micro_loss.detach() / n_micro_batches
+                l2_loss += encoder.l2_loss_cached.mean().detach() / n_micro_batches
+                l1_loss += encoder.l1_loss_cached.mean().detach() / n_micro_batches
+                l0_norm += encoder.l0_norm_cached.mean() / n_micro_batches # TODO condisder turning this off if is slows down calculation
+            with profiler.phase("backward"):
+                # scaler.scale(loss).backward()
+                (micro_loss / n_micro_batches).backward()
+        if resampling:
+            x_diffs.append(micro_acts.float() - x_reconstruct.float().detach())
+        del micro_loss, x_reconstruct
+    with profiler.phase("decoder_renorm"):
+        encoder.make_decoder_weights_and_grad_unit_norm()
+    with profiler.phase("optimizer_step"):
+        # scaler.step(encoder_optim)
+        # scaler.update()
+        encoder_optim.step()
+        encoder_optim.zero_grad()
+    resample_log = {}
+    if resampling:
+        with profiler.phase("resampling"):
+            waiting = 0 if encoder.to_be_reset is None else encoder.to_be_reset.shape[0]
+            # gather the residuals so every rank picks the same new directions. Sharded ranks already share the batch
+            x_diff = torch.cat(x_diffs)
+            encoder.re_init_neurons(x_diff if sharded else distributed.all_gather_cat(x_diff))
+            distributed.broadcast_parameters(encoder)
+            if encoder.to_be_reset is not None:
+                num_reset = waiting - encoder.to_be_reset.shape[0]
+            else:
+                num_reset = waiting
+            resample_log = {"neurons_waiting_to_reset": waiting, "neurons_reset": num_reset}
+            encoder_optim = new_optimizer(encoder, cfg)
+            empty_cache(cfg.device)
+    losses = {"loss": loss, "l2_loss": l2_loss, "l1_loss": l1_loss, "l0_norm": l0_norm}
+    return encoder_optim, losses, resample_log
+
+
+def dead_neuron_step(encoder :AutoEncoder, encoder_optim, cfg :AutoEncoderConfig, i :int, model :"HookedTransformer", tokens :torch.Tensor, profiler=NULL_PROFILER):
+    """
+    The dead neuron schedule of step i: the activation frequencies are reset at step 13501, and every
+    15000 steps after that the features that barely fired are queued for resetting. In reservoir mode
+    they're all reset straight away from fill_reservoir's residuals over model and tokens, otherwise
+    train_step resets them a few at a time.
+
+    Returns:
+        (encoder_optim, log): the optimizer, a new one if neurons were reset, and what to log, empty on other steps.
+    """
+    if i == 13501:
+        encoder.reset_activation_frequencies()
+        return encoder_optim, {}
+    if not (i % 15000 == 13501 and i > 1500):
+        return encoder_optim, {}
+    main_process = distributed.is_main_process()
+    sharded = distributed.is_model_parallel(encoder)
+    log = {}
+    with profiler.phase("resampling"):
+        t1 = time.time()
+        distributed.sync_activation_frequency(encoder)
+        # freqs = get_freqs(model, encoder, buffer, 50, local_encoder=encoder)
+        freqs = encoder.activation_frequency / encoder.steps_since_activation_frequency_reset
+        to_be_reset = (freqs<10**(-5.5))
+        n_to_reset = to_be_reset.sum()
+        if sharded:
+            # every shard has to agree on whether to go into the collective neurons_to_reset
+            torch.distributed.all_reduce(n_to_reset)
+        if main_process:
+            print("Resetting neurons!", n_to_reset)
+        if n_to_reset > 0:
+            encoder.neurons_to_reset(to_be_reset)
+            # re_init(model, encoder, buffer, to_be_reset)
+            if cfg.resample_mode == "reservoir":
+                # rank 0 picks the directions and the others get them from the broadcast
+                num_reset = torch.zeros((), dtype=torch.long, device=cfg.device)
+                if main_process:
+                    reservoir = fill_reservoir(encoder, model, tokens, cfg.resample_tokens, cfg.resample_reservoir, seed=i)
+                    num_reset += resample_all(encoder, reservoir)
+                    log["neurons_reset"] = num_reset.item()
+                    log["reservoir_mean_sq_error"] = reservoir.total_weight / reservoir.seen
+                    del reservoir
+                distributed.broadcast_parameters(encoder)
+                if distributed.is_distributed():
+                    # neurons past the reservoir's capacity stay queued, the same ones on every rank
+                    torch.distributed.broadcast(num_reset, src=0)
+                    if not main_process:
+                        encoder.to_be_reset = encoder.to_be_reset[num_reset.item():]
+                        if encoder.to_be_reset.shape[0] == 0:
+                            encoder.to_be_reset = None
+                encoder_optim = new_optimizer(encoder, cfg)
+                empty_cache(cfg.device)
+        log.update({"reset_neurons": n_to_reset, "time_for_neuron_reset": time.time() - t1})
+        encoder.reset_activation_frequencies()
+    return encoder_optim, log
+
+
+def train(encoder :AutoEncoder, cfg :AutoEncoderConfig, buffer :Buffer, model :"HookedTransformer"):
+    """
+    Trains the encoder on activations from the buffer. If a torch.distributed process group is
+    initialised this runs data parallel: each rank should be given its own buffer over its own
+    token shard, cfg.batch_size is the per-rank batch and cfg.num_tokens is the global total.
+
+    A model parallel encoder (sharded_sae.ShardedAutoEncoder) trains on one batch at a time that rank 0
+    draws and broadcasts, so buffer and model are only needed on rank 0 and can be None elsewhere.
+    """
+    import wandb
+    main_process = distributed.is_main_process()
+    sharded = distributed.is_model_parallel(encoder)
+    assert not (sharded and cfg.resample_mode == "reservoir"), "reservoir resampling needs the whole dictionary on rank 0"
+    if main_process:
+        wandb.login(key="0cb29a3826bf031cc561fd7447767a3d7920d888", relogin=True)
     t0 = time.time()
+    profiler = StepProfiler.from_cfg(cfg)
     # buffer.freshen_buffer(fresh_factor=0.5)
     try:
-        run = wandb.init(project="autoencoders", entity="sae_all", config=cfg)
+        run = wandb.init(project="autoencoders", entity="sae_all", config=cfg, mode=None if main_process else "disabled")
         # run = wandb.init(project="autoencoders", entity="sae_all", config=cfg, mode="disabled")
 
-        num_batches = cfg.num_tokens // cfg.batch_size
+        num_batches = cfg.num_tokens // (cfg.batch_size * (1 if sharded else distributed.get_world_size()))
+        parallel_encoder = distributed.wrap_data_parallel(encoder, cfg)
         # model_num_batches = cfg.model_batch_size * num_batches
         # encoder_optim = torch.optim.Adam(encoder.parameters(), lr=cfg.lr, betas=(cfg.beta1, cfg.beta2))
-        encoder_optim = torch.optim.Adam(encoder.parameters(), lr=cfg.lr, betas=(cfg.beta1, cfg.beta2))
+        encoder_optim = new_optimizer(encoder, cfg)
         recons_scores = []
         act_freq_scores_list = []
-        for i in tqdm.trange(num_batches):
+        if buffer is not None:
+            buffer.profiler = profiler
+        for i in tqdm.trange(num_batches, disable=not main_process):
             # i = i % buffer.all_tokens.shape[0]
-            acts = buffer.next()
-            x_reconstruct = encoder(acts, record_activation_frequency=True, rescaling = i < 10 or (i < 10000 * cfg.batch_size / cfg.buffer_mult * cfg.buffer_refresh_ratio and i % 100 == 0))
-            # if i % 100 == 99:
-            #     encoder.re_init_neurons_gram_shmidt(x.float() - x_reconstruct.float())
-            loss = encoder.get_loss()
-            l2_loss = encoder.l2_loss_cached.mean()
-            l1_loss = encoder.l1_loss_cached.mean()
-            l0_norm = encoder.l0_norm_cached.mean() # TODO condisder turning this off if is slows down calculation
-            # scaler.scale(loss).backward()
-            loss.backward()
-            encoder.make_decoder_weights_and_grad_unit_norm()
-            # scaler.step(encoder_optim)
-            # scaler.update()
-            encoder_optim.step()
-            encoder_optim.zero_grad()
-            if i % 200 == 99 and encoder.to_be_reset is not None:
-                waiting = encoder.to_be_reset.shape[0]
-                wandb.log({"neurons_waiting_to_reset": encoder.to_be_reset.shape[0]})
-                encoder.re_init_neurons(acts.float() - x_reconstruct.float())
-                if encoder.to_be_reset is not None:
-                    num_reset = waiting - encoder.to_be_reset.shape[0]
-                else:
-                    num_reset = waiting
-                wandb.log({"neurons_reset": num_reset})
-                encoder_optim = torch.optim.Adam(encoder.parameters(), lr=cfg.lr, betas=(cfg.beta1, cfg.beta2))
-                torch.cuda.empty_cache()
-            loss_dict = {"loss": loss.item(), "l2_loss": l2_loss.item(), "l1_loss": l1_loss.sum().item(), "l0_norm": l0_norm.item()}
-            del loss, x_reconstruct, l2_loss, l1_loss, acts, l0_norm
-            if (i) % 100 == 0:
-                wandb.log(loss_dict)
-                print(loss_dict, run.name)
+            with profiler.phase("data_fetch"):
+                acts = broadcast_batch(buffer, cfg) if sharded else buffer.next()
+            encoder_optim, losses, resample_log = train_step(encoder, parallel_encoder, encoder_optim, acts, cfg, i, profiler)
+            if resample_log:
+                wandb.log(resample_log)
+            with profiler.phase("logging"):
+                loss_dict = {"loss": losses["loss"].item(), "l2_loss": losses["l2_loss"].item(), "l1_loss": losses["l1_loss"].sum().item(), "l0_norm": losses["l0_norm"].item()}
+                del losses, acts
+                if (i) % 100 == 0 and sharded:
+                    loss_dict = encoder.global_loss_dict(loss_dict)
+                if (i) % 100 == 0 and main_process:
+                    wandb.log(loss_dict)
+                    print(loss_dict, run.name)
+                    if profiler.enabled:
+                        wandb.log(profiler.summary())
             if (i) % 5000 == 0:
-                x = (get_recons_loss(model, encoder, buffer, local_encoder=encoder, num_batches=1))
-                print("Reconstruction:", x)
-                recons_scores.append(x[0])
-                
-                # freqs = get_freqs(model, encoder, buffer, 5, local_encoder=encoder)
-                freqs = encoder.activation_frequency / encoder.steps_since_activation_frequency_reset
-                act_freq_scores_list.append(freqs)
-                # histogram(freqs.log10(), marginal="box",h istnorm="percent", title="Frequencies")
-                wandb.log({
-                    "recons_score": x[0],
-                    "dead": (freqs==0).float().mean().item(),
-                    "below_1e-6": (freqs<1e-6).float().mean().item(),
-                    "below_1e-5": (freqs<1e-5).float().mean().item(),
-                    "time spent shuffling": buffer.time_shuffling,
-                    "total time" : time.time() - t0,
-                })
-            if i == 13501:
-                encoder.reset_activation_frequencies()    
-            elif i % 15000 == 13501 and i > 1500:
-                encoder.save(name=run.name)
-                t1 = time.time()
-                # freqs = get_freqs(model, encoder, buffer, 50, local_encoder=encoder)
-                freqs = encoder.activation_frequency / encoder.steps_since_activation_frequency_reset
-                to_be_reset = (freqs<10**(-5.5))
-                print("Resetting neurons!", to_be_reset.sum())
-                if to_be_reset.sum() > 0:
-                    encoder.neurons_to_reset(to_be_reset)
-                    # re_init(model, encoder, buffer, to_be_reset)
-                wandb.log({"reset_neurons": to_be_reset.sum(), "time_for_neuron_reset": time.time() - t1})
-                encoder.reset_activation_frequencies()
+                distributed.sync_activation_frequency(encoder)
+            if (i) % 5000 == 0 and (main_process or sharded):
+                with profiler.phase("eval"):
+                    if sharded:
+                        x = get_recons_loss_sharded(model, encoder, buffer)
+                    else:
+                        x = (get_recons_loss(model, encoder, buffer, local_encoder=encoder, num_batches=1))
+                    # freqs = get_freqs(model, encoder, buffer, 5, local_encoder=encoder)
+                    freqs = encoder.activation_frequency / encoder.steps_since_activation_frequency_reset
+                    dead = torch.stack([(freqs==0).float().sum(), (freqs<1e-6).float().sum(), (freqs<1e-5).float().sum()])
+                    if sharded:
+                        torch.distributed.all_reduce(dead)
+                    dead = (dead / (encoder.full_cfg if sharded else cfg).dict_size).tolist()
+                if main_process:
+                    print("Reconstruction:", x)
+                    recons_scores.append(x[0])
+                    act_freq_scores_list.append(freqs)
+                    # histogram(freqs.log10(), marginal="box",h istnorm="percent", title="Frequencies")
+                    wandb.log({
+                        "recons_score": x[0],
+                        "dead": dead[0],
+                        "below_1e-6": dead[1],
+                        "below_1e-5": dead[2],
+                        "time spent shuffling": buffer.time_shuffling,
+                        **buffer.reuse_stats(),
+                        "total time" : time.time() - t0,
+                    })
+                if profiler.enabled and i > 0 and main_process:
+                    profiler.print_summary()
+                    # so every summary covers the steps since the last one
+                    profiler.reset()
+            # a sharded save is collective
+            if i % 15000 == 13501 and i > 1500 and (main_process or sharded):
+                with profiler.phase("checkpoint"):
+                    encoder.save(name=run.name)
+            encoder_optim, dead_log = dead_neuron_step(encoder, encoder_optim, cfg, i, model, None if buffer is None else buffer.all_tokens, profiler)
+            if dead_log:
+                wandb.log(dead_log)
+            profiler.step(cfg.batch_size)
+        if sharded:
+            # collective, so only on a clean exit: after an exception on one rank the others would wait in it forever
+            encoder.save()
     finally:
-        encoder.save()
+        profiler.close()
+        if main_process and not sharded:
+            encoder.save()
 
 def linspace_l1(ae, l1_radius):
     cfg = ae.cfg
@@ -111,8 +261,17 @@ def main():
     #                                  nonlinearity=("undying_relu", {"l" : 0.001, "k" : 0.1}), 
     #                                  lr=1e-4) #original 3e-4 8e-4 or same but 1e-3 on l1
     # cfg = sae.post_init_cfg(ae_cfg)
+    global cfg
+    configure_threads(cfg)
     model = get_model(cfg)
     all_tokens = load_data(model)
+    # load_data memory maps the rows of a token store rather than loading them
+    corpus_mapped = get_token_store().exists()
+    if cfg.memory_budget_gb is not None:
+        cfg, plan = memory_planner.plan(cfg, model, all_tokens, budget_gb=cfg.memory_budget_gb, corpus_mapped=corpus_mapped)
+    else:
+        plan = memory_planner.estimate(cfg, model, all_tokens, corpus_mapped=corpus_mapped)
+    plan.print()
     encoder = AutoEncoder(cfg)
     # linspace_l1(encoder, 0.2)
     # dataloader, buffer = buffer_dataset.get_dataloader(cfg, all_tokens, model=model, device=torch.device("cpu"))
@@ -0,0 +1,89 @@
+# Data parallel training over torch.distributed with the gloo backend, so it runs on cpu nodes.
+# Each rank trains on its own shard of the tokens with its own Buffer, and DDP all-reduces the gradients.
+#
+# One machine, 4 local processes:
+#   python train_sae_distributed.py --world_size 4
+# Several nodes: launch one process per node (or more) with torchrun, which sets RANK / WORLD_SIZE / MASTER_ADDR:
+#   torchrun --nnodes 2 --nproc_per_node 1 --rdzv_endpoint host:29500 train_sae_distributed.py
+# Smoke test with a small random transformer and random tokens:
+#   python train_sae_distributed.py --world_size 2 --random_model --num_tokens 500000 --buffer_mult 64
+import os
+import dataclasses
+from argparse import ArgumentParser
+
+import torch
+import torch.multiprocessing as mp
+
+import distributed
+import train_sae
+from buffer import Buffer
+from device_utils import configure_threads
+from sae import AutoEncoder
+from setup_utils import get_model, load_data, get_random_model, get_random_tokens
+
+
+def get_cfg(args):
+    overrides = {k: getattr(args, k) for k in ["num_tokens", "buffer_mult", "batch_size", "num_threads"] if getattr(args, k) is not None}
+    overrides["device"] = "cpu"
+    if args.random_model:
+        overrides["flatten_heads"] = False
+        overrides["site"] = "resid_pre"
+    return dataclasses.replace(train_sae.cfg, **overrides)
+
+
+def run(args):
+    cfg = get_cfg(args)
+    configure_threads(cfg)
+    # every rank has to load the tokens in the same order, or the shards would overlap
+    torch.manual_seed(cfg.seed)
+    if args.random_model:
+        model = get_random_model(cfg)
+        all_tokens = get_random_tokens(cfg, cfg.buffer_batches * 4 * distributed.get_world_size(), d_vocab=model.cfg.d_vocab)
+    else:
+        model = get_model(cfg)
+        # the first load preprocesses and saves the dataset, so let rank 0 do that alone
+        if not distributed.is_main_process():
+            torch.distributed.barrier()
+        all_tokens = load_data(model)
+        if distributed.is_main_process():
+            torch.distributed.barrier()
+    tokens = distributed.shard_tokens(all_tokens)
+    encoder = AutoEncoder(cfg)
+    buffer = Buffer(cfg, tokens, model=model)
+    train_sae.train(encoder, cfg, buffer, model)
+
+
+def worker(rank, world_size, args):
+    distributed.init_process_group(rank, world_size, master_port=args.port)
+    try:
+        run(args)
+    finally:
+        distributed.destroy_process_group()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--world_size", type=int, default=None,
+                        help="number of local processes to spawn. Leave unset when launching with torchrun")
+    parser.add_argument("--port", type=int, default=29500)
+    parser.add_argument("--num_threads", type=int, default=None, help="intra-op threads per process")
+    parser.add_argument("--num_tokens", type=int, default=None)
+    parser.add_argument("--buffer_mult", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=None, help="per process batch size")
+    parser.add_argument("--random_model", action="store_true")
+    args = parser.parse_args()
+
+    if args.world_size is None:
+        distributed.init_process_group()
+        try:
+            run(args)
+        finally:
+            distributed.destroy_process_group()
+    else:
+        if args.num_threads is None:
+            args.num_threads = max(1, (os.cpu_count() or 1) // args.world_size)
+        mp.spawn(worker, args=(args.world_size, args), nprocs=args.world_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Model parallel training of a ShardedAutoEncoder: the dictionary is split over the ranks, so each
+# process holds 1/world_size of W_enc, W_dec and their Adam state. Rank 0 owns the model and the
+# activation buffer and broadcasts every batch. The other ranks only hold their shard.
+#
+# One machine, 4 local gloo processes:
+#   python train_sae_sharded.py --world_size 4
+# Smoke test with a small random transformer and random tokens:
+#   python train_sae_sharded.py --world_size 2 --random_model --num_tokens 200000 --buffer_mult 64
+import os
+import dataclasses
+from argparse import ArgumentParser
+
+import torch.multiprocessing as mp
+
+import distributed
+import train_sae
+from buffer import Buffer
+from device_utils import configure_threads
+from setup_utils import get_model, load_data, get_random_model, get_random_tokens
+from sharded_sae import ShardedAutoEncoder
+
+
+def run(args):
+    overrides = {k: getattr(args, k) for k in ["num_tokens", "buffer_mult", "batch_size", "dict_mult", "num_threads"] if getattr(args, k) is not None}
+    overrides["device"] = "cpu"
+    if args.random_model:
+        overrides["flatten_heads"] = False
+        overrides["site"] = "resid_pre"
+    cfg = dataclasses.replace(train_sae.cfg, **overrides)
+    configure_threads(cfg)
+    model, buffer = None, None
+    if distributed.is_main_process():
+        if args.random_model:
+            model = get_random_model(cfg)
+            all_tokens = get_random_tokens(cfg, cfg.buffer_batches * 4, d_vocab=model.cfg.d_vocab)
+        else:
+            model = get_model(cfg)
+            all_tokens = load_data(model)
+    encoder = ShardedAutoEncoder(cfg)
+    if distributed.is_main_process():
+        buffer = Buffer(cfg, all_tokens, model=model)
+    # train handles the model parallel encoder: rank 0 broadcasts every batch and the collectives run on every rank
+    train_sae.train(encoder, cfg, buffer, model)
+
+
+def worker(rank, world_size, args):
+    distributed.init_process_group(rank, world_size, master_port=args.port)
+    try:
+        run(args)
+    finally:
+        distributed.destroy_process_group()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--world_size", type=int, default=None,
+                        help="number of local processes to spawn. Leave unset when launching with torchrun")
+    parser.add_argument("--port", type=int, default=29500)
+    parser.add_argument("--num_threads", type=int, default=None, help="intra-op threads per process")
+    parser.add_argument("--num_tokens", type=int, default=None)
+    parser.add_argument("--buffer_mult", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=None)
+    parser.add_argument("--dict_mult", type=int, default=None)
+    parser.add_argument("--random_model", action="store_true")
+    args = parser.parse_args()
+
+    if args.world_size is None:
+        distributed.init_process_group()
+        try:
+            run(args)
+        finally:
+            distributed.destroy_process_group()
+    else:
+        if args.num_threads is None:
+            args.num_threads = max(1, (os.cpu_count() or 1) // args.world_size)
+        mp.spawn(worker, args=(args.world_size, args), nprocs=args.world_size)
+
+
+if __name__ == "__main__":
+    main()
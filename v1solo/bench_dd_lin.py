@@ -0,0 +1,98 @@
+# Compares the dd_lin variants of osae.AutoEncoder on the synthetic task from osae.main:
+# parameter memory, step time, peak memory on cuda, and the losses after a fixed number of steps.
+# From the repo root:
+#   python -m v1solo.bench_dd_lin --steps 2000
+import time
+import json
+from argparse import ArgumentParser
+
+import torch
+
+from v1solo.osae import AutoEncoder, AutoEncoderConfig
+from v1solo.synthetic_data import make_synthetic_task, feature_recovery
+
+VARIANTS = {
+    "dense": {},
+    "low_rank_64": {"dd_lin": "low_rank", "dd_lin_rank": 64},
+    "low_rank_256": {"dd_lin": "low_rank", "dd_lin_rank": 256},
+    "block_diagonal_8": {"dd_lin": "block_diagonal", "dd_lin_blocks": 8},
+    "block_diagonal_32": {"dd_lin": "block_diagonal", "dd_lin_blocks": 32},
+    "monarch": {"dd_lin": "monarch"},
+    "identity": {"dd_lin": "identity"},
+}
+
+
+def run_variant(name, overrides, args, device, generator):
+    torch.manual_seed(0)
+    cfg = AutoEncoderConfig(lr=3e-4, d_act=args.d_act, d_dict=args.d_act * args.dict_mult, l1_coeff=0.2,
+                            l0l1_coeff=0, lo_coeff=100, l1_half_coeff=0, device=str(device), **overrides)
+    ae = AutoEncoder(cfg).to(device)
+    optim = torch.optim.Adam(ae.parameters(), lr=cfg.lr)
+    dd_params = sum(p.numel() for p in ae.dd_lin.parameters())
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    torch.manual_seed(1)
+    times = []
+    for i in range(args.steps):
+        x, _ = generator.batch(args.batch_size)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        y = ae(x)
+        l2 = torch.mean(torch.pow(y - x, 2))
+        lo, l1 = ae.penalties(lo=True)
+        loss = l2 + lo + l1
+        loss.backward()
+        optim.step()
+        optim.zero_grad()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - t0)
+    # the losses on a fresh batch, averaged over a few to take out the noise
+    with torch.no_grad():
+        l2s, l0s = [], []
+        for _ in range(10):
+            x, _ = generator.batch(args.batch_size)
+            y = ae(x)
+            l2s.append(torch.mean(torch.pow(y - x, 2)).item())
+            l0s.append(ae.get_l0_loss().sum().item())
+    warm = times[min(10, len(times) // 2):]
+    return {
+        "variant": name,
+        "dd_lin_params": dd_params,
+        # weights + grads + 2 Adam moments
+        "dd_lin_train_mb": dd_params * 4 * 4 / 2**20,
+        "step_ms": 1000 * sum(warm) / len(warm),
+        "peak_memory_mb": torch.cuda.max_memory_allocated() / 2**20 if device.type == "cuda" else None,
+        "final_l2": sum(l2s) / len(l2s),
+        "final_l0": sum(l0s) / len(l0s),
+        **feature_recovery(ae, generator),
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--variants", nargs="+", default=list(VARIANTS))
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--batch_size", type=int, default=250)
+    parser.add_argument("--d_act", type=int, default=400)
+    parser.add_argument("--dict_mult", type=int, default=8)
+    parser.add_argument("--n_features", type=int, default=2000)
+    parser.add_argument("--avg_n_features", type=int, default=10)
+    parser.add_argument("--out", type=str, default=None, help="also write the results here as json lines")
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    generator = make_synthetic_task(args.d_act, args.n_features, args.avg_n_features, device)
+    results = []
+    for name in args.variants:
+        r = run_variant(name, VARIANTS[name], args, device, generator)
+        print(json.dumps(r))
+        results.append(r)
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            for r in results:
+                f.write(json.dumps(r) + "\n")
+
+
+if __name__ == "__main__":
+    main()
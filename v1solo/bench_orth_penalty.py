@@ -0,0 +1,70 @@
+# Variance and speed of the hutchinson orth_stacked_penalty against the exact one.
+# For each shape and probe count: the relative bias and standard deviation of the value over many
+# draws, the cosine between the estimated and the exact gradient (one draw, and averaged over draws),
+# and the time of a forward + backward.
+# From the repo root:
+#   python -m v1solo.bench_orth_penalty --shapes 400x400 400x3200 --probes 1 4 16 64
+import time
+import json
+from argparse import ArgumentParser
+
+import torch
+import torch.nn.functional as F
+
+from v1solo.orthonormal import orth_stacked_penalty
+
+
+def time_call(fn, repeats):
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return 1000 * (time.perf_counter() - t0) / repeats
+
+
+def bench_shape(n_out, n_in, probes, row, draws, repeats, device):
+    torch.manual_seed(0)
+    # near orthogonal, like a trained layer, plus noise so the penalty isn't ~0
+    mat = torch.nn.init.orthogonal_(torch.empty(n_out, n_in, device=device)) + 0.05 * torch.randn(n_out, n_in, device=device) / n_out ** 0.5
+    mat.requires_grad_(True)
+
+    def penalty_and_grad(**kwargs):
+        l = orth_stacked_penalty(mat, row=row, **kwargs)
+        grad, = torch.autograd.grad(l, mat)
+        return l.detach(), grad
+
+    exact, exact_grad = penalty_and_grad()
+    results = [{"shape": f"{n_out}x{n_in}", "row": row, "mode": "exact", "n_probes": None,
+                "ms": time_call(lambda: penalty_and_grad(), repeats)}]
+    for p in probes:
+        values, grads = zip(*[penalty_and_grad(mode="hutchinson", n_probes=p) for _ in range(draws)])
+        values = torch.stack(values)
+        mean_grad = torch.stack(grads).mean(0)
+        results.append({
+            "shape": f"{n_out}x{n_in}", "row": row, "mode": "hutchinson", "n_probes": p,
+            "ms": time_call(lambda: penalty_and_grad(mode="hutchinson", n_probes=p), repeats),
+            "rel_bias": ((values.mean() - exact) / exact).item(),
+            "rel_std": (values.std() / exact).item(),
+            "grad_cos_single": F.cosine_similarity(grads[0].flatten(), exact_grad.flatten(), dim=0).item(),
+            "grad_cos_mean": F.cosine_similarity(mean_grad.flatten(), exact_grad.flatten(), dim=0).item(),
+        })
+    return results
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--shapes", nargs="+", default=["400x400", "400x3200", "1024x1024"])
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--row", action="store_true", help="include the per block row penalty")
+    parser.add_argument("--draws", type=int, default=200)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    for shape in args.shapes:
+        n_out, n_in = map(int, shape.split("x"))
+        for r in bench_shape(n_out, n_in, args.probes, args.row, args.draws, args.repeats, device):
+            print(json.dumps(r))
+
+
+if __name__ == "__main__":
+    main()
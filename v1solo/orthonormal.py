@@ -26,7 +26,15 @@ def orth_penalty(mat):
     print(opmat1.shape)
     return torch.mean(torch.pow(opmat1, 2)) + torch.mean(torch.pow(opmat2, 2)) * 0
     
-def orth_stacked_penalty(mat, row = False, col = True):
+def orth_stacked_penalty(mat, row = False, col = True, mode = "exact", n_probes = 8):
+    """
+    mean((mat^T mat - I)^2), plus with row=True the same for mat_j mat_j^T of each square block mat_j.
+
+    mode="hutchinson" estimates each mean((A - I)^2) = ||A - I||_F^2 / n^2 as ||(A - I) z||^2 / n^2 with
+    n_probes random sign vectors z, so A is never formed. That's O(n_out n_in n_probes) instead of
+    O(n_out n_in^2). The probes are drawn independently of mat, so both the value and the gradient
+    are unbiased estimates of the exact ones.
+    """
     n_out, n_in = mat.shape[-2:]
     # m, n = n_out, n_i
     assert n_in >= n_out
@@ -34,20 +42,34 @@ def orth_stacked_penalty(mat, row = False, col = True):
     i = n_in // n_out
     l = 0
     if row:
-        for j in range(i):
-            matj = mat[:, j*n_out:(j+1)*n_out]
-            opmat_row = matj @ matj.transpose(-1, -2) - torch.eye(matj.shape[-2], device=matj.device)
-            l += torch.mean(torch.pow(opmat_row, 2))
+        # (i, n_out, n_out), blocks[j] = mat[:, j*n_out:(j+1)*n_out]
+        blocks = mat.reshape(n_out, i, n_out).transpose(0, 1)
+        if mode == "exact":
+            opmat_row = blocks @ blocks.transpose(-1, -2) - torch.eye(n_out, device=mat.device)
+            l += torch.pow(opmat_row, 2).mean(dim=(-1, -2)).sum()
+        else:
+            z = rademacher((i, n_out, n_probes), mat)
+            opz = blocks @ (blocks.transpose(-1, -2) @ z) - z
+            l += torch.pow(opz, 2).sum(dim=-2).mean(dim=-1).sum() / n_out ** 2
         # l += torch.mean(torch.abs(opmat_row))
     if col:
-        opmat_col = mat.transpose(-1, -2) @ mat - torch.eye(mat.shape[-1], device=mat.device)
-        l += torch.mean(torch.pow(opmat_col, 2))
+        if mode == "exact":
+            opmat_col = mat.transpose(-1, -2) @ mat - torch.eye(mat.shape[-1], device=mat.device)
+            l += torch.mean(torch.pow(opmat_col, 2))
+        else:
+            z = rademacher((n_in, n_probes), mat)
+            opz = mat.transpose(-1, -2) @ (mat @ z) - z
+            l += torch.pow(opz, 2).sum(dim=-2).mean() / n_in ** 2
     # return torch.mean(torch.pow(opmat2, 2))
     if torch.isnan(l):
         raise ValueError("nan")
     return l
 
 
+def rademacher(shape, like):
+    return torch.randint(0, 2, shape, device=like.device).to(like.dtype) * 2 - 1
+
+
 def main():
     # omat = nn.utils.parametrizations.orthogonal(m, "weight")
     omat = nn.Linear(d1, d2, bias=False)
@@ -119,16 +141,19 @@ class OrthAEConfig:
 
 
 class OrthPenalizedLinear(nn.Module):
-    def __init__(self, in_features, out_features, bias=False):
+    def __init__(self, in_features, out_features, bias=False, penalty_mode="exact", n_probes=8):
         super(OrthPenalizedLinear, self).__init__()
         assert in_features % out_features == 0
         self.linear = nn.Linear(in_features, out_features, bias=bias)
+        self.penalty_mode = penalty_mode
+        self.n_probes = n_probes
 
     def forward(self, x):
         return self.linear(x)
     
     def penalty(self):
-        return orth_stacked_penalty(self.linear.weight)
+        # getattr so that modules pickled before penalty_mode existed still load
+        return orth_stacked_penalty(self.linear.weight, mode=getattr(self, "penalty_mode", "exact"), n_probes=getattr(self, "n_probes", 8))
 
 
 class RowNormPenalizedLinear(nn.Module):
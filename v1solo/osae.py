@@ -7,18 +7,26 @@ import os
 import json
 from dataclasses import dataclass
 import v1solo.orthonormal as orthonormal
+import v1solo.structured_linear as structured_linear
+from v1solo.synthetic_data import make_synthetic_task
+import v1solo.spectral as spectral
 @dataclass
 class AutoEncoderConfig:
     lr :Union[float, torch.Tensor]
     d_act :int
     d_dict :int
     l1_coeff :Optional[Union[float, torch.Tensor]]
-    device :str = "cuda"
+    device :str = "cuda" if torch.cuda.is_available() else "cpu"
     ae_id :str = "no-id"
     l0l1 :bool = True
     l0l1_coeff :float = 0.01
     lo_coeff :float = 10
     l1_half_coeff :float = 0
+    dd_lin :str = "dense" # dense, low_rank, block_diagonal, monarch or identity, see structured_linear.py
+    dd_lin_rank :int = 64
+    dd_lin_blocks :Optional[int] = None
+    orth_penalty_mode :str = "exact" # or "hutchinson", see orthonormal.orth_stacked_penalty
+    orth_penalty_probes :int = 8
 
 
 
@@ -37,11 +45,12 @@ class AutoEncoder(nn.Module):
         super(AutoEncoder, self).__init__()
         self.project_in = nn.Linear(cfg.d_act, cfg.d_act, bias=False)
         self.encoder = nn.Linear(cfg.d_act, cfg.d_dict, bias=False)
-        self.dd_lin = nn.Linear(cfg.d_dict, cfg.d_dict, bias=False)
+        self.dd_lin = structured_linear.make_dd_lin(cfg)
         # self.decoder = orthonormal.OrthLinearStack(cfg.d_dict, cfg.d_act, bias=False)
         # self.project_out = orthonormal.OrthLinearStack(cfg.d_act, cfg.d_act, bias=False)
         self.decoder = orthonormal.RowNormPenalizedLinear(cfg.d_dict, cfg.d_act, bias=False)
-        self.project_out = orthonormal.OrthPenalizedLinear(cfg.d_act, cfg.d_act, bias=False)
+        self.project_out = orthonormal.OrthPenalizedLinear(cfg.d_act, cfg.d_act, bias=False,
+                                                           penalty_mode=cfg.orth_penalty_mode, n_probes=cfg.orth_penalty_probes)
         # self.project_out = orthonormal.NoOpModule()
 
         self.cfg :AutoEncoderConfig = cfg
@@ -177,35 +186,17 @@ class AutoEncoder(nn.Module):
 
 
 def find_maximizing_vec_length(ae, d_dict, device):
-    v_2max = F.normalize(torch.randn(10, d_dict, device=device), dim=-1)
-    v_2max.requires_grad = True
-    # m = nn.Linear(d_dict, d_dict, bias=False).to(device)
-    # mo = torch.nn.utils.parametrizations.orthogonal(m, "weight")
-
-    # optim = torch.optim.SGD(m.parameters(), lr=0.01, momentum=0.75)
-    # ae.train(False)
-    optim = torch.optim.SGD([v_2max], lr=0.05, momentum=0.9)
-    for i in range(2000):
-        # v = m(v_2max)
-        loss = -1 * torch.mean(ae.decode(F.normalize(v_2max, dim=-1)).norm(dim=-1))
-        if i % 100 == 0:
-            print(-1 * loss.item())
-        
-        # loss += torch.mean(torch.pow(v_2max.norm(dim=-1) - 1, 2))
-        # loss = torch.mean(torch.pow(ae.decode(v) - 1, 2))
-        loss.backward()
-        optim.step()
-        optim.zero_grad()
-    print("norm", ae.decode(F.normalize(v_2max, dim=-1)).norm(dim=-1))
-    print(ae.cfg.l1_coeff)
-    vv = ae.decode(F.normalize(v_2max, dim=-1)).norm(dim=-1)
-    return torch.max(vv).item()
+    """
+    max ||ae.decode(v)|| over unit v. This used to be estimated with 2000 SGD steps on 10 random
+    vectors, and is now solved exactly from the decoder's svd, see v1solo/spectral.py.
+    """
+    return spectral.max_decode_norm(ae)
 
 def show_heatmap_of_similarity(m, ae, encoder = True):
     import seaborn as sns
     import torch
     import matplotlib.pyplot as plt
-    v = torch.eye(ae.cfg.d_dict, device="cuda")    
+    v = torch.eye(ae.cfg.d_dict, device=ae.cfg.device)    
     f = ae.decode(v)
     # features, d_act -> features, d_dict
     if encoder:
@@ -228,7 +219,7 @@ def show_heatmap_of_similarity(m, ae, encoder = True):
 def main():
     import time
     # import matplotlib.pyplot as plt
-    device = torch.device("cuda")
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     d_act = 400
     n_features = 2000
     d_dict = d_act * 8
@@ -239,34 +230,21 @@ def main():
     ae = AutoEncoder(cfg)
     ae.l1_coeffs = l1_coeffs * cfg.l1_coeff
     ae.to(device)
-    m = torch.randn(n_features, d_act, device=device) * 5
-    # m = F.normalize(m, dim=-2)
-    # m = m * 2
+    # draws the feature occurrences sparsely, so making the data no longer costs as much as training on it
+    generator = make_synthetic_task(d_act, n_features, avg_n_features, device)
+    m = generator.features
     optim = torch.optim.Adam(ae.parameters(), lr=cfg.lr)
     # optim = torch.optim.SGD(ae.parameters(), lr=cfg.lr, momentum=0.96)
     # optim = torch.optim.Adam(ae.parameters(), lr=0.02, weight_decay=0.01)
     t0 = time.time()
     torch.set_printoptions(precision=3)
     n = 5000000
-    d = {"max_vec": {}, "l2": {}, "l1": {}, "l0l1": {}, "l0": {}, "lo": {}}
+    d = {"max_vec": {}, "spectral_norm": {}, "nonnegative_gain": {}, "l2": {}, "l1": {}, "l0l1": {}, "l0": {}, "lo": {}}
     # plt.ion()
     # plt.show()
-    p_feature = avg_n_features / n_features
-    p_feature_variability_radius = 0.5
-    p_feature_distribution = torch.linspace(p_feature * (1 + p_feature_variability_radius), p_feature * (1 - p_feature_variability_radius), n_features, device=device)
     for i in range(n):
-        x = torch.rand(250, n_features, device=device)
-        b = 100
-        # x = F.dropout(x, p=(1 - p_feature), training=True) * (p_feature)
-        mask = torch.rand(x.shape, device=device) < p_feature_distribution
-        x = x * mask
-        # for j in range(n_features // b):
-        #     p_feature = p_feature * 0.5
-        #     x[j*b : (j + 1) * b] = F.dropout(x[j*b : (j + 1) * b], p=(1 - p_feature), training=True) * (p_feature)
-
-        # x = F.relu(x)
-        x_nonzero = torch.count_nonzero(x, dim=-1).float().mean().item()
-        x = x @ m
+        x, coeffs = generator.batch(250)
+        x_nonzero = coeffs._nnz() / x.shape[0]
         y = ae(x)
         l2 = torch.mean(torch.pow(y - x, 2))
         lo, l1 = ae.penalties(lo=True)
@@ -289,6 +267,11 @@ def main():
             d["l0l1"][i] = l0l1.item()
             d["l0"][i] = ae.get_l0_loss().sum().item()
             d["lo"][i] = lo.item() / cfg.lo_coeff
+            # exact and cheap now, so it's logged with everything else
+            gains = spectral.decoder_gain_stats(ae)
+            d["max_vec"][i] = gains["max_decode_norm"]
+            d["spectral_norm"][i] = gains["spectral_norm"]
+            d["nonnegative_gain"][i] = gains["nonnegative_gain"]
 
         # if i % 3000 == 1500 and i > 0:
         #     show_heatmap_of_similarity(m, ae, encoder = i % 6000 == 1500)
@@ -331,7 +314,6 @@ def main():
             # plt.pause(1)
 
         if i % 10000 == 0 and i > 0:
-            d["max_vec"][i] = find_maximizing_vec_length(ae, d_dict, device)
             ae.save("/home/g/mats/sae/models", 2, {"d":d, "m" : m.tolist(), "i":i})
             optim.zero_grad()
     ae.save("/home/g/mats/sae/models", 2)
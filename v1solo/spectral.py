@@ -0,0 +1,173 @@
+# Norm amplification of an autoencoder's decoder, computed directly instead of with
+# osae.find_maximizing_vec_length's 2000 SGD steps.
+#
+# decode(v) = A v + b_d for a linear A (decoder then project_out in osae), so the largest
+# ||decode(v) - b_d|| over unit v is the top singular value of A. singular_values gets the top k
+# singular values and vectors by one of:
+#   "svd"         materialise A with d_dict decodes of the identity and solve the eigenproblem of the
+#                 small (d_act x d_act) Gram matrix A A^T exactly
+#   "power"       block power (subspace) iteration with matvecs through decode and its vjp
+#   "randomized"  randomised range finder + svd of the small projected matrix (Halko et al. 2011)
+# Power and randomized never form A, so they work for decoders too big to materialise.
+#
+# Dictionary activations are nonnegative, so the max over v >= 0 is the one that can actually
+# happen. That problem (nonnegative PCA) has no closed form. max_nonnegative_gain runs batched
+# projected power iteration from several starts, which gives a lower bound that is tight in practice.
+#
+# With the bias, max ||A v + b_d|| over unit v (the quantity find_maximizing_vec_length estimated) is a
+# trust region subproblem, which max_decode_norm solves exactly from the svd.
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+
+
+class DecoderOperator():
+    """
+    The linear part of ae.decode as matvec / rmatvec on batches: forward maps (n, d_dict) -> (n, d_act).
+    """
+    def __init__(self, ae):
+        self.ae = ae
+        self.d_dict = ae.cfg.d_dict
+        self.device = next(ae.parameters()).device
+        with torch.no_grad():
+            self.offset = ae.decode(torch.zeros(1, self.d_dict, device=self.device))
+
+    def forward(self, v :torch.Tensor):
+        with torch.no_grad():
+            return self.ae.decode(v) - self.offset
+
+    def transpose(self, u :torch.Tensor):
+        # A^T u through the vjp of decode, which is exact since decode is affine
+        v = torch.zeros(u.shape[0], self.d_dict, device=self.device, requires_grad=True)
+        with torch.enable_grad():
+            out = self.ae.decode(v)
+            v_grad, = torch.autograd.grad(out, v, grad_outputs=u)
+        return v_grad
+
+    def matrix(self):
+        """
+        A^T, (d_dict, d_act), row i being what latent i writes.
+        """
+        return self.forward(torch.eye(self.d_dict, device=self.device))
+
+
+def singular_values(ae, k :int = 1, method :str = "svd", iters :int = 30, oversample :int = 10, power_iters :int = 4, seed :int = 0):
+    """
+    Top k singular values of the linear part of ae.decode, with the input (d_dict) and output
+    (d_act) singular vectors.
+
+    Returns:
+        (S, V, U): S (k,), V (k, d_dict), U (k, d_act), with decode(V[i]) - decode(0) = S[i] U[i].
+    """
+    op = DecoderOperator(ae)
+    if method == "svd":
+        M = op.matrix().double()
+        # d_act is the small side, so eigh of A A^T is much cheaper than an svd of A
+        evals, evecs = torch.linalg.eigh(M.T @ M)
+        S = evals.flip(0)[:k].clamp(min=0).sqrt()
+        U = evecs.flip(1)[:, :k].T
+        V = (U @ M.T) / S.clamp(min=1e-30)[:, None]
+        return S.float(), V.float(), U.float()
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    if method == "power":
+        V = torch.randn(k, op.d_dict, generator=generator).to(op.device)
+        for _ in range(iters):
+            V = torch.linalg.qr(op.transpose(op.forward(V)).T).Q.T
+        # Rayleigh-Ritz on the converged subspace, so the vectors come out sorted and orthogonal
+        B = op.forward(V)
+        U_, S, Wh = torch.linalg.svd(B.T, full_matrices=False)
+        return S, Wh @ V, U_.T
+    if method == "randomized":
+        # range finder on the output side, with a couple of power iterations for accuracy
+        Omega = torch.randn(k + oversample, op.d_dict, generator=generator).to(op.device)
+        Y = op.forward(Omega)
+        for _ in range(power_iters):
+            Y = torch.linalg.qr(Y.T).Q.T
+            Y = op.forward(op.transpose(Y))
+        Q = torch.linalg.qr(Y.T).Q.T
+        # small matrix Q A = (A^T Q^T)^T
+        B = op.transpose(Q)
+        Ub, S, Vh = torch.linalg.svd(B, full_matrices=False)
+        U = (Q.T @ Ub).T
+        return S[:k], Vh[:k], U[:k]
+    raise ValueError(f"unknown method {method}")
+
+
+def spectral_norm(ae, method :str = "svd", **kwargs):
+    return singular_values(ae, 1, method, **kwargs)[0][0].item()
+
+
+def max_nonnegative_gain(ae, n_starts :int = 32, iters :int = 100, init :Optional[torch.Tensor] = None, seed :int = 0):
+    """
+    max ||decode(v) - decode(0)|| over nonnegative unit v, by projected power iteration
+    v <- normalize(relu(A^T A v)) from n_starts starts at once. The starts are the positive and
+    negative parts of the top singular vectors plus random nonnegative vectors.
+
+    Returns:
+        (gain, v): the best gain found and the v that reached it.
+    """
+    op = DecoderOperator(ae)
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    starts = [torch.rand(n_starts, op.d_dict, generator=generator).to(op.device)]
+    if init is None:
+        _, init, _ = singular_values(ae, k=min(4, op.d_dict), method="power", iters=20, seed=seed)
+    starts += [F.relu(init), F.relu(-init)]
+    V = F.normalize(torch.cat(starts), dim=-1)
+    for _ in range(iters):
+        V_next = F.relu(op.transpose(op.forward(V)))
+        # a start whose projection died stays where it was
+        dead = V_next.norm(dim=-1) == 0
+        V = torch.where(dead[:, None], V, F.normalize(V_next, dim=-1))
+    gains = op.forward(V).norm(dim=-1)
+    best = gains.argmax()
+    return gains[best].item(), V[best]
+
+
+def full_svd(ae):
+    op = DecoderOperator(ae)
+    return singular_values(ae, k=min(op.d_dict, op.offset.shape[-1]), method="svd")
+
+
+@torch.no_grad()
+def max_decode_norm(ae, svd :Optional[tuple] = None):
+    """
+    max ||decode(v)|| over unit v, exactly. With A = U S V^T and c = U^T b, the maximiser is
+    v = V w with w_i = s_i c_i / (lam - s_i^2) for the lam > s_1^2 that makes ||w|| = 1, found by bisection.
+    svd is full_svd(ae), if it's already been computed.
+    """
+    op = DecoderOperator(ae)
+    S, V, U = (t.double() for t in (full_svd(ae) if svd is None else svd))
+    b = op.offset[0].double()
+    c = U @ b
+    s2 = S ** 2
+    def w_of(lam):
+        return S * c / (lam - s2)
+    # ||w(lam)|| falls from infinity at s_1^2 to 0, bracket the crossing of 1
+    lo, hi = s2[0], s2[0] + S[0] * c.norm() + 1
+    if c[0].abs() < 1e-12 * (c.norm() + 1e-30):
+        # the "hard case": the top direction is orthogonal to the bias, so the max is at least s_1 along it
+        lo = s2[0] * (1 + 1e-12)
+    for _ in range(200):
+        mid = (lo + hi) / 2
+        if w_of(mid).norm() > 1:
+            lo = mid
+        else:
+            hi = mid
+    w = w_of(hi)
+    # any norm left over goes along the top singular direction, which only matters in the hard case
+    w[0] += (1 - w.norm().clamp(max=1) ** 2).sqrt() * torch.sign(c[0] + (c[0] == 0).double())
+    v = (w @ V).float()
+    return max(ae.decode(v[None]).norm().item(), ae.decode(-v[None]).norm().item(), (S[0] ** 2 + b.norm() ** 2).sqrt().item())
+
+
+def decoder_gain_stats(ae):
+    """
+    Cheap summary to log every eval: the spectral norm, the gain over nonnegative inputs, and
+    max ||decode(v)|| over unit v including b_d, which is what find_maximizing_vec_length estimated.
+    One svd covers all three.
+    """
+    S, V, U = full_svd(ae)
+    nonneg, _ = max_nonnegative_gain(ae, init=V[:4])
+    return {"spectral_norm": S[0].item(), "sigma_2": S[1].item() if len(S) > 1 else None,
+            "nonnegative_gain": nonneg, "max_decode_norm": max_decode_norm(ae, svd=(S, V, U))}
@@ -0,0 +1,96 @@
+# Structured stand-ins for the dense d_dict x d_dict dd_lin in osae.AutoEncoder.
+# A dense d x d layer costs d^2 parameters and multiply-adds per token. These cost:
+#   LowRankLinear        2 d r
+#   BlockDiagonalLinear  d^2 / n_blocks
+#   MonarchLinear        d (n_blocks + d / n_blocks), i.e. 2 d sqrt(d) at n_blocks = sqrt(d)
+# dd_lin is not penalised, whichever kind it is: AutoEncoder.penalties only covers the decoder layers.
+import math
+
+import torch
+import torch.nn as nn
+
+
+def uniform_init_(weight :torch.Tensor, fan_in :int, gain :float = 1.0):
+    # gain 1 is the bound nn.Linear uses. A second factor gets gain sqrt(3) so that it preserves the
+    # variance, and the product scales outputs like a dense nn.Linear would
+    bound = gain / math.sqrt(fan_in)
+    nn.init.uniform_(weight, -bound, bound)
+
+
+class LowRankLinear(nn.Module):
+    def __init__(self, features, rank):
+        super(LowRankLinear, self).__init__()
+        self.down = nn.Parameter(torch.empty(features, rank))
+        self.up = nn.Parameter(torch.empty(rank, features))
+        uniform_init_(self.down, features)
+        uniform_init_(self.up, rank, gain=math.sqrt(3))
+
+    def forward(self, x):
+        return (x @ self.down) @ self.up
+
+
+class BlockDiagonalLinear(nn.Module):
+    def __init__(self, features, n_blocks):
+        super(BlockDiagonalLinear, self).__init__()
+        assert features % n_blocks == 0
+        self.n_blocks = n_blocks
+        self.block_size = features // n_blocks
+        self.blocks = nn.Parameter(torch.empty(n_blocks, self.block_size, self.block_size))
+        uniform_init_(self.blocks, self.block_size)
+
+    def forward(self, x):
+        x = x.reshape(*x.shape[:-1], self.n_blocks, self.block_size)
+        x = torch.einsum("...ki,kio->...ko", x, self.blocks)
+        return x.flatten(-2)
+
+
+class MonarchLinear(nn.Module):
+    """
+    Monarch matrix (Dao et al. 2022): a block diagonal layer, a transpose of the (n_blocks, block_size)
+    grid, then a second block diagonal layer over the other axis. Two layers are enough for every
+    output to depend on every input.
+    """
+    def __init__(self, features, n_blocks=None):
+        super(MonarchLinear, self).__init__()
+        if n_blocks is None:
+            n_blocks = largest_divisor_at_most(features, int(math.sqrt(features)))
+        assert features % n_blocks == 0
+        self.n_blocks = n_blocks
+        self.block_size = features // n_blocks
+        self.blocks_1 = nn.Parameter(torch.empty(n_blocks, self.block_size, self.block_size))
+        self.blocks_2 = nn.Parameter(torch.empty(self.block_size, n_blocks, n_blocks))
+        uniform_init_(self.blocks_1, self.block_size)
+        uniform_init_(self.blocks_2, n_blocks, gain=math.sqrt(3))
+
+    def forward(self, x):
+        x = x.reshape(*x.shape[:-1], self.n_blocks, self.block_size)
+        x = torch.einsum("...ki,kio->...ko", x, self.blocks_1)
+        x = x.transpose(-1, -2)
+        x = torch.einsum("...ki,kio->...ko", x, self.blocks_2)
+        return x.transpose(-1, -2).flatten(-2)
+
+
+def largest_divisor_at_most(n, k):
+    for d in range(max(1, k), 0, -1):
+        if n % d == 0:
+            return d
+
+
+def make_dd_lin(cfg):
+    """
+    The dd_lin layer that cfg.dd_lin asks for: "dense" (the original nn.Linear), "low_rank",
+    "block_diagonal", "monarch" or "identity". dd_lin_blocks defaults to 8 blocks for block_diagonal
+    and about sqrt(d_dict) for monarch.
+    """
+    kind = cfg.dd_lin
+    if kind == "dense":
+        return nn.Linear(cfg.d_dict, cfg.d_dict, bias=False)
+    if kind == "low_rank":
+        return LowRankLinear(cfg.d_dict, cfg.dd_lin_rank)
+    if kind == "block_diagonal":
+        return BlockDiagonalLinear(cfg.d_dict, cfg.dd_lin_blocks or 8)
+    if kind == "monarch":
+        return MonarchLinear(cfg.d_dict, cfg.dd_lin_blocks)
+    if kind == "identity":
+        return nn.Identity()
+    raise ValueError(f"unknown dd_lin {kind}")
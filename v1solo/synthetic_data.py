@@ -0,0 +1,268 @@
+# Toy data for SAE experiments: activations that are sparse sums of known feature directions.
+# Feature occurrences are drawn sparsely (a binomial count per feature, then the rows they land on)
+# instead of masking a dense (batch, n_features) draw, and x = coeffs @ features is a sparse-dense
+# product, so generating a batch costs about batch * active features * d_act rather than
+# batch * n_features * d_act.
+#
+# Each feature fires with its own probability. Features can also be grouped so that the members of a
+# group tend to fire together. Magnitudes come from a uniform, exponential, lognormal or constant
+# distribution, scaled per feature.
+#
+# From the repo root, to train a couple of variants on the toy task and score their feature recovery:
+#   python -m v1solo.synthetic_data --steps 3000
+import time
+import json
+from argparse import ArgumentParser
+from typing import Optional, Union
+
+import torch
+import torch.nn.functional as F
+
+
+class SparseFeatureGenerator():
+    """
+    Args:
+        d_act (int): Dimension of the activations.
+        n_features (int): Number of ground truth features.
+        p_feature (float or torch.Tensor): Firing probability, one for all features or one per feature.
+        magnitude (str, optional): "uniform" (U(0, 1), what osae.main used), "exponential",
+            "lognormal" or "constant". Defaults to "uniform".
+        magnitude_scale (float or torch.Tensor, optional): Per feature multiplier on the magnitudes. Defaults to 1.
+        lognormal_sigma (float, optional): Defaults to 1.
+        n_groups (int, optional): Split the features into this many groups of consecutive features that
+            fire together. Defaults to 0, no correlations.
+        p_group (float, optional): Probability a group fires on a row. Defaults to 0.01.
+        p_in_group (float, optional): Probability each member fires when its group does. Defaults to 0.5.
+        features (torch.Tensor, optional): (n_features, d_act) directions. Defaults to
+            torch.randn * feature_scale like osae.main.
+    """
+    def __init__(self, d_act :int, n_features :int, p_feature :Union[float, torch.Tensor], magnitude :str = "uniform",
+                 magnitude_scale :Union[float, torch.Tensor] = 1.0, lognormal_sigma :float = 1.0, n_groups :int = 0,
+                 p_group :float = 0.01, p_in_group :float = 0.5, features :Optional[torch.Tensor] = None,
+                 feature_scale :float = 5.0, device = "cpu", seed :int = 0):
+        self.d_act = d_act
+        self.n_features = n_features
+        self.device = device
+        self.generator = torch.Generator(device=device).manual_seed(seed)
+        if features is None:
+            features = torch.randn(n_features, d_act, device=device, generator=self.generator) * feature_scale
+        self.features = features
+        self.p_feature = torch.as_tensor(p_feature, dtype=torch.float32, device=device).expand(n_features).contiguous()
+        self.magnitude = magnitude
+        self.magnitude_scale = torch.as_tensor(magnitude_scale, dtype=torch.float32, device=device).expand(n_features).contiguous()
+        self.lognormal_sigma = lognormal_sigma
+        self.n_groups = n_groups
+        self.p_group = p_group
+        self.p_in_group = p_in_group
+        if n_groups:
+            self.group_of = torch.arange(n_features, device=device) * n_groups // n_features
+            self.group_start = torch.searchsorted(self.group_of, torch.arange(n_groups, device=device))
+            self.group_size = torch.bincount(self.group_of, minlength=n_groups)
+
+    def sample_occurrences(self, batch_size :int, p :torch.Tensor):
+        """
+        (row, column) pairs where each column fires on each row with probability p[column].
+        A column's count is binomial and its rows are drawn uniformly. The rare repeated row is
+        dropped, which undercounts by a fraction of about p / 2, negligible for sparse features.
+        """
+        counts = torch.binomial(torch.full_like(p, batch_size), p, generator=self.generator).long()
+        cols = torch.repeat_interleave(torch.arange(len(p), device=self.device), counts)
+        rows = torch.randint(0, batch_size, (len(cols),), device=self.device, generator=self.generator)
+        return rows, cols
+
+    def sample_magnitudes(self, features :torch.Tensor):
+        n = len(features)
+        if self.magnitude == "uniform":
+            m = torch.rand(n, device=self.device, generator=self.generator)
+        elif self.magnitude == "exponential":
+            m = torch.empty(n, device=self.device).exponential_(generator=self.generator)
+        elif self.magnitude == "lognormal":
+            m = torch.empty(n, device=self.device).log_normal_(0, self.lognormal_sigma, generator=self.generator)
+        elif self.magnitude == "constant":
+            m = torch.ones(n, device=self.device)
+        else:
+            raise ValueError(f"unknown magnitude distribution {self.magnitude}")
+        return m * self.magnitude_scale[features]
+
+    def sample_coeffs(self, batch_size :int):
+        """
+        The ground truth feature coefficients for a batch, as a coalesced sparse (batch_size, n_features) tensor.
+        """
+        rows, cols = self.sample_occurrences(batch_size, self.p_feature)
+        if self.n_groups:
+            g_rows, groups = self.sample_occurrences(batch_size, torch.full((self.n_groups,), self.p_group, device=self.device))
+            # expand every group occurrence to its members and keep each with p_in_group
+            sizes = self.group_size[groups]
+            member_rows = torch.repeat_interleave(g_rows, sizes)
+            offsets = torch.arange(int(sizes.sum()), device=self.device) - torch.repeat_interleave(sizes.cumsum(0) - sizes, sizes)
+            members = torch.repeat_interleave(self.group_start[groups], sizes) + offsets
+            keep = torch.rand(len(members), device=self.device, generator=self.generator) < self.p_in_group
+            rows, cols = torch.cat([rows, member_rows[keep]]), torch.cat([cols, members[keep]])
+        # coalesce sums duplicates, so dedupe the positions first and then draw one magnitude per position
+        flat = torch.unique(rows * self.n_features + cols)
+        rows, cols = flat // self.n_features, flat % self.n_features
+        values = self.sample_magnitudes(cols)
+        return torch.sparse_coo_tensor(torch.stack([rows, cols]), values, (batch_size, self.n_features),
+                                       is_coalesced=True, check_invariants=False)
+
+    def batch(self, batch_size :int = 250):
+        """
+        Returns x (batch_size, d_act) and the sparse coefficients that made it.
+        """
+        coeffs = self.sample_coeffs(batch_size)
+        return torch.sparse.mm(coeffs, self.features), coeffs
+
+    def dense_batch(self, batch_size :int = 250):
+        # how osae.main used to make its data, for comparison
+        x = torch.rand(batch_size, self.n_features, device=self.device)
+        x = x * (torch.rand(x.shape, device=self.device) < self.p_feature)
+        return x @ self.features, x
+
+
+def make_synthetic_task(d_act :int, n_features :int, avg_n_features :float, device = "cpu", p_feature_variability_radius :float = 0.5, **kwargs):
+    """
+    The toy task osae.main trains on: n_features random directions in d_act, each firing with its own
+    probability, spread linearly by p_feature_variability_radius around avg_n_features / n_features,
+    with a uniform random magnitude. kwargs go to SparseFeatureGenerator.
+    """
+    p_feature = avg_n_features / n_features
+    p_feature_distribution = torch.linspace(p_feature * (1 + p_feature_variability_radius), p_feature * (1 - p_feature_variability_radius), n_features, device=device)
+    return SparseFeatureGenerator(d_act, n_features, p_feature_distribution, device=device, **kwargs)
+
+
+def best_match(A :torch.Tensor, B :torch.Tensor, block_size :int = 4096):
+    """
+    Best cosine similarity of every row of A to the rows of B and its index, a block of A at a time so
+    the full similarity matrix is never built. feature_matching.blockwise_topk does the same for the
+    repo's dictionaries. This keeps v1solo free of the root modules.
+    """
+    A, B = F.normalize(A.float(), dim=-1), F.normalize(B.float(), dim=-1)
+    values = torch.empty(A.shape[0], device=A.device)
+    indices = torch.empty(A.shape[0], dtype=torch.long, device=A.device)
+    for start in range(0, A.shape[0], block_size):
+        a = A[start:start + block_size]
+        best_v = torch.full((a.shape[0],), -float("inf"), device=A.device)
+        best_i = torch.zeros(a.shape[0], dtype=torch.long, device=A.device)
+        for b_start in range(0, B.shape[0], block_size):
+            v, i = (a @ B[b_start:b_start + block_size].T).max(dim=1)
+            better = v > best_v
+            best_v = torch.where(better, v, best_v)
+            best_i = torch.where(better, i + b_start, best_i)
+        values[start:start + block_size], indices[start:start + block_size] = best_v, best_i
+    return values, indices
+
+
+def decoder_directions(ae):
+    """
+    The direction each latent writes to: W_dec for sae.AutoEncoder, and decode(e_i) - decode(0)
+    for anything else with a decode, like osae.AutoEncoder.
+    """
+    if hasattr(ae, "W_dec"):
+        return ae.W_dec.detach()
+    d_dict = ae.cfg.d_dict
+    device = next(ae.parameters()).device
+    with torch.no_grad():
+        return ae.decode(torch.eye(d_dict, device=device)) - ae.decode(torch.zeros(1, d_dict, device=device))
+
+
+@torch.no_grad()
+def feature_recovery(ae, generator :SparseFeatureGenerator, threshold :float = 0.9, batch_size :int = 1000):
+    """
+    How well the ae's latents recover the ground truth features.
+    mmcs is the mean over true features of the best cosine similarity to any decoder direction,
+    recovered the fraction with a best cosine above threshold. activation_corr is the mean correlation
+    between each true feature's coefficients and its best matching latent's activations on a fresh batch.
+    """
+    directions = decoder_directions(ae)
+    best_cos, best_latent = best_match(generator.features, directions)
+    x, coeffs = generator.batch(batch_size)
+    acts = ae.encode(x)
+    if isinstance(acts, tuple):
+        acts = acts[0]
+    true = coeffs.to_dense()
+    matched = acts[:, best_latent]
+    true_c, matched_c = true - true.mean(0), matched - matched.mean(0)
+    corr = (true_c * matched_c).sum(0) / (true_c.norm(dim=0) * matched_c.norm(dim=0)).clamp(min=1e-12)
+    # features that never fired in the batch don't say anything about activations
+    fired = (true != 0).any(0)
+    return {
+        "mmcs": best_cos.mean().item(),
+        "recovered": (best_cos > threshold).float().mean().item(),
+        "activation_corr": corr[fired].mean().item(),
+        "latents_used": len(torch.unique(best_latent)) / directions.shape[0],
+    }
+
+
+def train_toy(ae, generator :SparseFeatureGenerator, steps :int = 3000, batch_size :int = 250, lr :float = 3e-4, log_every :int = 500):
+    """
+    Trains an osae.AutoEncoder (l2 + its penalties) or a sae.AutoEncoder (its get_loss) on the
+    generator's data. Returns the average step time and the final losses.
+    """
+    optim = torch.optim.Adam(ae.parameters(), lr=lr)
+    t_data, t_train = 0, 0
+    for i in range(steps):
+        t0 = time.perf_counter()
+        x, _ = generator.batch(batch_size)
+        t1 = time.perf_counter()
+        if hasattr(ae, "get_loss"):
+            ae(x)
+            loss = ae.get_loss()
+            l2 = ae.l2_loss_cached.mean()
+        else:
+            y = ae(x)
+            l2 = torch.mean(torch.pow(y - x, 2))
+            lo, l1 = ae.penalties(lo=True)
+            loss = l2 + lo + l1
+        loss.backward()
+        if hasattr(ae, "make_decoder_weights_and_grad_unit_norm"):
+            ae.make_decoder_weights_and_grad_unit_norm()
+        optim.step()
+        optim.zero_grad()
+        t_data += t1 - t0
+        t_train += time.perf_counter() - t1
+        if i % log_every == 0:
+            print(i, {"loss": loss.item(), "l2": l2.item()})
+    return {"data_ms": 1000 * t_data / steps, "train_ms": 1000 * t_train / steps, "final_loss": loss.item(), "final_l2": l2.item()}
+
+
+def main():
+    from v1solo.osae import AutoEncoder as OAutoEncoder, AutoEncoderConfig as OAutoEncoderConfig
+    from sae import AutoEncoder as SAutoEncoder
+    from sae_config import AutoEncoderConfig as SAutoEncoderConfig
+    parser = ArgumentParser()
+    parser.add_argument("--d_act", type=int, default=400)
+    parser.add_argument("--n_features", type=int, default=2000)
+    parser.add_argument("--avg_n_features", type=float, default=10)
+    parser.add_argument("--dict_mult", type=int, default=8)
+    parser.add_argument("--magnitude", type=str, default="uniform")
+    parser.add_argument("--n_groups", type=int, default=0)
+    parser.add_argument("--steps", type=int, default=3000)
+    parser.add_argument("--batch_size", type=int, default=250)
+    args = parser.parse_args()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    gen = make_synthetic_task(args.d_act, args.n_features, args.avg_n_features, device, magnitude=args.magnitude, n_groups=args.n_groups)
+
+    for name, make in [("sparse", gen.batch), ("dense", gen.dense_batch)]:
+        make(args.batch_size)
+        t0 = time.perf_counter()
+        for _ in range(50):
+            make(args.batch_size)
+        print(f"{name} data: {1000 * (time.perf_counter() - t0) / 50:.2f}ms per batch")
+
+    d_dict = args.d_act * args.dict_mult
+    variants = {
+        "osae": lambda: OAutoEncoder(OAutoEncoderConfig(lr=3e-4, d_act=args.d_act, d_dict=d_dict, l1_coeff=0.2, l0l1_coeff=0,
+                                                        lo_coeff=100, l1_half_coeff=0, device=device)),
+        "sae": lambda: SAutoEncoder(SAutoEncoderConfig(act_size=args.d_act, dict_mult=args.dict_mult, l1_coeff=8e-4,
+                                                       site="resid_pre", device=device)),
+    }
+    for name, make_ae in variants.items():
+        torch.manual_seed(0)
+        ae = make_ae().to(device)
+        stats = train_toy(ae, gen, steps=args.steps, batch_size=args.batch_size)
+        stats.update(feature_recovery(ae, gen))
+        print(json.dumps({"variant": name, **stats}))
+
+
+if __name__ == "__main__":
+    main()